@@ -6,7 +6,6 @@ ComfyFlowApp 主页模块
 import streamlit as st
 import os
 from loguru import logger
-from streamlit_extras.row import row
 from modules import page
 
 # 初始化页面环境和布局
@@ -19,7 +18,7 @@ if 'username' not in st.session_state:
 
 with st.container():
     # 创建页面头部布局
-    header_row = row([0.87, 0.13], vertical_align="bottom")
+    header_row = page.row([0.87, 0.13], vertical_align="bottom")
     header_row.title("""
         Welcome to ComfyFlowApp
         From comfyui workflow to web application in seconds, and share with others.
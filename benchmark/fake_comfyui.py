@@ -0,0 +1,626 @@
+"""
+A stand-in comfyui server for benchmarking ComfyFlowApp without a GPU.
+
+It speaks the parts of the comfyui api the client uses, /prompt, /queue, /interrupt,
+/history, /view, /upload/image, /object_info and /ws, and runs queued prompts one at a
+time like comfyui: nodes needed by the output nodes in dependency order, nodes whose
+inputs are unchanged since the previous prompt reported as cached, each executed node
+taking its configured latency. Samplers, nodes with a steps input, send progress and a
+binary jpeg preview frame per step. Output nodes produce png images of the configured
+size, served by /view.
+
+With a recording of a real comfyui run, see modules/recorder.py, queued prompts replay
+the recorded prompts in turn instead: their websocket messages at the recorded pace,
+divided by speed, then their history and output images.
+
+Tornado is used because streamlit already depends on it. The server runs in a thread
+of the benchmark process with start_server, or standalone.
+
+usage, from the project root:
+    python benchmark/fake_comfyui.py --port 8188
+    python benchmark/fake_comfyui.py --latency KSampler=0.1 --latency VAEDecode=0.3 --output-size 1024x1024
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import mimetypes
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
+import tornado.websocket
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# seconds a node without a configured latency runs
+DEFAULT_NODE_LATENCY = 0.01
+# seconds per sampler step, for nodes with a steps input and no configured latency
+DEFAULT_STEP_LATENCY = 0.02
+DEFAULT_PREVIEW_SIZE = 256
+DEFAULT_OUTPUT_SIZE = (512, 512)
+CHECKPOINT_NAME = "fake-model.safetensors"
+
+# object_info of the nodes of the benchmark apps, see sample_apps.py
+DEFAULT_OBJECT_INFO = {
+    "CheckpointLoaderSimple": {
+        "input": {"required": {"ckpt_name": [[CHECKPOINT_NAME]]}},
+        "output": ["MODEL", "CLIP", "VAE"], "output_node": False,
+    },
+    "CLIPTextEncode": {
+        "input": {"required": {"text": ["STRING", {"multiline": True}], "clip": ["CLIP"]}},
+        "output": ["CONDITIONING"], "output_node": False,
+    },
+    "EmptyLatentImage": {
+        "input": {"required": {"width": ["INT", {"default": 512, "min": 16, "max": 8192, "step": 8}],
+                               "height": ["INT", {"default": 512, "min": 16, "max": 8192, "step": 8}],
+                               "batch_size": ["INT", {"default": 1, "min": 1, "max": 64}]}},
+        "output": ["LATENT"], "output_node": False,
+    },
+    "KSampler": {
+        "input": {"required": {"model": ["MODEL"], "seed": ["INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff}],
+                               "steps": ["INT", {"default": 20, "min": 1, "max": 10000}],
+                               "cfg": ["FLOAT", {"default": 8.0, "min": 0.0, "max": 100.0}],
+                               "sampler_name": [["euler", "euler_ancestral", "dpmpp_2m"]],
+                               "scheduler": [["normal", "karras"]],
+                               "positive": ["CONDITIONING"], "negative": ["CONDITIONING"], "latent_image": ["LATENT"],
+                               "denoise": ["FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0}]}},
+        "output": ["LATENT"], "output_node": False,
+    },
+    "VAEDecode": {
+        "input": {"required": {"samples": ["LATENT"], "vae": ["VAE"]}},
+        "output": ["IMAGE"], "output_node": False,
+    },
+    "VAEEncode": {
+        "input": {"required": {"pixels": ["IMAGE"], "vae": ["VAE"]}},
+        "output": ["LATENT"], "output_node": False,
+    },
+    "LoadImage": {
+        "input": {"required": {"image": [[]]}},
+        "output": ["IMAGE", "MASK"], "output_node": False,
+    },
+    "SaveImage": {
+        "input": {"required": {"images": ["IMAGE"], "filename_prefix": ["STRING", {"default": "ComfyUI"}]}},
+        "output": [], "output_node": True,
+    },
+    "PreviewImage": {
+        "input": {"required": {"images": ["IMAGE"]}},
+        "output": [], "output_node": True,
+    },
+}
+
+
+def noise_image(size, format):
+    # random pixels don't compress, so the bytes are those of a detailed render
+    from PIL import Image
+
+    width, height = size
+    image = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def parse_size(text):
+    width, _, height = text.lower().partition('x')
+    return int(width), int(height or width)
+
+
+class FakeComfyUI:
+    def __init__(self, latencies=None, node_latency=DEFAULT_NODE_LATENCY, step_latency=DEFAULT_STEP_LATENCY,
+                 preview_size=DEFAULT_PREVIEW_SIZE, output_size=DEFAULT_OUTPUT_SIZE, output_count=1,
+                 error_rate=0.0, object_info=None, recording=None, speed=1.0) -> None:
+        # class type -> seconds a node runs, all its steps for samplers
+        self.latencies = latencies or {}
+        self.node_latency = node_latency
+        self.step_latency = step_latency
+        self.output_count = output_count
+        self.error_rate = error_rate
+        self.speed = speed
+        # recorded prompts replayed in turn, and the output images they fetched by filename
+        self.replay_prompts = []
+        self.replay_images = {}
+        if recording is not None:
+            from modules.recorder import load_recording
+
+            # the prompts queued only pick the recording to replay, the benchmark apps are accepted
+            # as they are, other apps need the object_info of the recorded comfyui
+            _, prompts, self.replay_images = load_recording(recording)
+            self.replay_prompts = list(prompts.values())
+            if len(self.replay_prompts) == 0:
+                raise ValueError(f"no prompt in recording {recording}")
+        self.object_info = object_info or DEFAULT_OBJECT_INFO
+        self.preview_frame = noise_image((preview_size, preview_size), 'JPEG') if preview_size > 0 else None
+        self.output_image = noise_image(output_size, 'PNG')
+
+        self.lock = threading.Lock()
+        self.io_loop = None
+        # client id -> websocket handler
+        self.sockets = {}
+        self.pending = []
+        self.running = None
+        self.interrupted = False
+        self.history = {}
+        # (subfolder, name) -> size of the uploaded image
+        self.uploads = {}
+        self.number = 0
+        self.output_number = 0
+        # node signature -> outputs, the cache of the previous prompt
+        self.cache = {}
+        self.work = queue.Queue()
+        self.worker = threading.Thread(target=self._prompt_worker, daemon=True)
+        self.worker.start()
+
+    # -- api
+
+    def queue_prompt(self, prompt, client_id, extra_data):
+        missing = sorted({node['class_type'] for node in prompt.values()} - set(self.object_info))
+        if len(missing) > 0:
+            return None, {"type": "invalid_prompt", "message": f"Cannot execute because node {missing[0]} does not exist."}
+        outputs = [node_id for node_id, node in prompt.items() if self.object_info[node['class_type']].get('output_node')]
+        if len(outputs) == 0:
+            return None, {"type": "prompt_no_outputs", "message": "Prompt has no outputs"}
+        with self.lock:
+            self.number += 1
+            item = [self.number, str(uuid.uuid4()), prompt, dict(extra_data, client_id=client_id), outputs]
+            self.pending.append(item)
+        self.work.put(item)
+        self.send_status()
+        return {"prompt_id": item[1], "number": item[0], "node_errors": {}}, None
+
+    def queue_remaining(self):
+        with self.lock:
+            return len(self.pending) + (1 if self.running is not None else 0)
+
+    def get_queue(self):
+        with self.lock:
+            running = [self.running] if self.running is not None else []
+            return {"queue_running": running, "queue_pending": list(self.pending)}
+
+    def delete_queued(self, prompt_ids):
+        with self.lock:
+            self.pending = [item for item in self.pending if item[1] not in prompt_ids]
+        self.send_status()
+
+    def interrupt(self):
+        self.interrupted = True
+
+    def get_history(self, prompt_id=None, max_items=None):
+        with self.lock:
+            if prompt_id is not None:
+                return {prompt_id: self.history[prompt_id]} if prompt_id in self.history else {}
+            items = list(self.history.items())
+        return dict(items[-max_items:] if max_items else items)
+
+    def delete_history(self, prompt_ids=None):
+        with self.lock:
+            if prompt_ids is None:
+                self.history.clear()
+            for prompt_id in prompt_ids or []:
+                self.history.pop(prompt_id, None)
+
+    def upload_image(self, name, data, subfolder, overwrite):
+        with self.lock:
+            if not overwrite:
+                base, ext = os.path.splitext(name)
+                index = 1
+                while (subfolder, name) in self.uploads:
+                    name = f"{base} ({index}){ext}"
+                    index += 1
+            self.uploads[(subfolder, name)] = len(data)
+        return {"name": name, "subfolder": subfolder, "type": "input"}
+
+    # -- websocket
+
+    def connect(self, client_id, handler):
+        with self.lock:
+            self.sockets[client_id] = handler
+        self.send_status(client_id)
+
+    def disconnect(self, client_id, handler):
+        with self.lock:
+            if self.sockets.get(client_id) is handler:
+                self.sockets.pop(client_id)
+
+    def send(self, message, client_id=None):
+        # called from the prompt worker, websocket writes belong to the io loop thread
+        if self.io_loop is not None:
+            self.io_loop.add_callback(self._write, message, client_id)
+
+    def _write(self, message, client_id):
+        with self.lock:
+            handlers = list(self.sockets.values()) if client_id is None else [self.sockets.get(client_id)]
+        for handler in handlers:
+            if handler is None:
+                continue
+            try:
+                handler.write_message(message, binary=isinstance(message, bytes))
+            except tornado.websocket.WebSocketClosedError:
+                pass
+
+    def send_json(self, event, data, client_id=None):
+        self.send(json.dumps({"type": event, "data": data}), client_id)
+
+    def send_status(self, client_id=None):
+        status = {"status": {"exec_info": {"queue_remaining": self.queue_remaining()}}}
+        if client_id is not None:
+            status["sid"] = client_id
+        self.send_json("status", status, client_id)
+
+    # -- execution
+
+    def signature(self, prompt, node_id, signatures):
+        # a node is cached while its class, inputs and upstream nodes are unchanged
+        if node_id not in signatures:
+            node = prompt[node_id]
+            inputs = []
+            for name, value in sorted(node['inputs'].items()):
+                if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                    value = (self.signature(prompt, value[0], signatures), value[1])
+                inputs.append((name, json.dumps(value, sort_keys=True) if not isinstance(value, tuple) else value))
+            signatures[node_id] = (node['class_type'], tuple(inputs))
+        return signatures[node_id]
+
+    def execution_order(self, prompt, outputs):
+        order = []
+        visited = set()
+
+        def visit(node_id):
+            if node_id in visited:
+                return
+            visited.add(node_id)
+            for value in prompt[node_id]['inputs'].values():
+                if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and value[0] in prompt:
+                    visit(value[0])
+            order.append(node_id)
+
+        for node_id in outputs:
+            visit(node_id)
+        return order
+
+    def latency(self, node):
+        steps = node['inputs'].get('steps')
+        steps = steps if isinstance(steps, int) and steps > 0 else None
+        if node['class_type'] in self.latencies:
+            latency = self.latencies[node['class_type']]
+        elif steps is not None:
+            latency = self.step_latency * steps
+        else:
+            latency = self.node_latency
+        return latency, steps
+
+    def _prompt_worker(self):
+        while True:
+            item = self.work.get()
+            with self.lock:
+                if item not in self.pending:
+                    # deleted from the queue
+                    continue
+                self.pending.remove(item)
+                self.running = item
+                self.interrupted = False
+            try:
+                if len(self.replay_prompts) > 0:
+                    self._replay(item)
+                else:
+                    self._execute(item)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.running = None
+                self.send_status()
+
+    def _execute(self, item):
+        number, prompt_id, prompt, extra_data, outputs = item
+        client_id = extra_data.get('client_id')
+        messages = []
+
+        def send(event, data):
+            messages.append([event, data])
+            self.send_json(event, data, client_id)
+
+        send("execution_start", {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)})
+        signatures = {}
+        order = self.execution_order(prompt, outputs)
+        cache = {}
+        cached = []
+        for node_id in order:
+            key = self.signature(prompt, node_id, signatures)
+            if key in self.cache:
+                cached.append(node_id)
+                cache[key] = self.cache[key]
+        send("execution_cached", {"nodes": cached, "prompt_id": prompt_id, "timestamp": int(time.time() * 1000)})
+        fail_node = random.choice(order) if random.random() < self.error_rate else None
+
+        history_outputs = {}
+        status = "success"
+        executed = list(cached)
+        for node_id in order:
+            key = signatures[node_id]
+            node = prompt[node_id]
+            if key not in cache:
+                self.send_json("executing", {"node": node_id, "prompt_id": prompt_id}, client_id)
+                if not self._run_node(prompt_id, node, client_id):
+                    send("execution_interrupted", {"prompt_id": prompt_id, "node_id": node_id,
+                                                   "node_type": node['class_type'], "executed": executed})
+                    status = "error"
+                    break
+                if node_id == fail_node:
+                    send("execution_error", {"prompt_id": prompt_id, "node_id": node_id, "node_type": node['class_type'],
+                                             "executed": executed, "exception_message": "fake comfyui error",
+                                             "exception_type": "RuntimeError", "traceback": [],
+                                             "current_inputs": {}, "current_outputs": {}})
+                    status = "error"
+                    break
+                cache[key] = self._node_output(node)
+                executed.append(node_id)
+            if cache[key] is not None:
+                history_outputs[node_id] = cache[key]
+                self.send_json("executed", {"node": node_id, "output": cache[key], "prompt_id": prompt_id}, client_id)
+        if status == "success":
+            # like comfyui, only the outputs of the last prompt stay cached
+            self.cache = cache
+        with self.lock:
+            self.history[prompt_id] = {
+                "prompt": [number, prompt_id, prompt, extra_data, outputs],
+                "outputs": history_outputs,
+                "status": {"status_str": status, "completed": status == "success",
+                           "messages": messages},
+            }
+        self.send_json("executing", {"node": None, "prompt_id": prompt_id}, client_id)
+
+    def _replay(self, item):
+        number, prompt_id, prompt, extra_data, outputs = item
+        client_id = extra_data.get('client_id')
+        recorded = self.replay_prompts[(number - 1) % len(self.replay_prompts)]
+        started_at = time.monotonic()
+        for offset, message in recorded.messages:
+            if self.speed > 0:
+                time.sleep(max(offset / self.speed - (time.monotonic() - started_at), 0))
+            if self.interrupted:
+                self.send_json("execution_interrupted", {"prompt_id": prompt_id, "node_id": None, "executed": []}, client_id)
+                self.send_json("executing", {"node": None, "prompt_id": prompt_id}, client_id)
+                break
+            if isinstance(message, str):
+                message = message.replace(recorded.prompt_id, prompt_id)
+            self.send(message, client_id)
+        history = recorded.history or {"outputs": {}, "status": {"status_str": "success", "completed": True, "messages": []}}
+        history = json.loads(json.dumps(history).replace(recorded.prompt_id, prompt_id))
+        history["prompt"] = [number, prompt_id, prompt, extra_data, outputs]
+        with self.lock:
+            self.history[prompt_id] = history
+
+    def image(self, filename):
+        return self.replay_images.get(filename, self.output_image)
+
+    def _run_node(self, prompt_id, node, client_id):
+        latency, steps = self.latency(node)
+        if steps is None:
+            time.sleep(latency)
+            return not self.interrupted
+        for step in range(1, steps + 1):
+            time.sleep(latency / steps)
+            if self.interrupted:
+                return False
+            self.send_json("progress", {"value": step, "max": steps, "prompt_id": prompt_id}, client_id)
+            if self.preview_frame is not None:
+                # event 1 preview image, image type 1 jpeg
+                self.send((1).to_bytes(4, 'big') + (1).to_bytes(4, 'big') + self.preview_frame, client_id)
+        return True
+
+    def _node_output(self, node):
+        info = self.object_info[node['class_type']]
+        if not info.get('output_node'):
+            return None
+        folder_type = "output" if node['class_type'] != 'PreviewImage' else "temp"
+        images = []
+        for _ in range(self.output_count):
+            with self.lock:
+                self.output_number += 1
+                filename = f"ComfyUI_{self.output_number:05}_.png"
+            images.append({"filename": filename, "subfolder": "", "type": folder_type})
+        return {"images": images}
+
+
+class ApiHandler(tornado.web.RequestHandler):
+    def initialize(self, server):
+        self.server = server
+
+    def json_body(self):
+        try:
+            return json.loads(self.request.body or b'{}')
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+    def write_json(self, data, status=200):
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(data))
+
+
+class PromptHandler(ApiHandler):
+    def get(self):
+        self.write_json({"exec_info": {"queue_remaining": self.server.queue_remaining()}})
+
+    def post(self):
+        body = self.json_body()
+        if 'prompt' not in body:
+            self.write_json({"error": {"type": "no_prompt", "message": "No prompt provided"}, "node_errors": []}, 400)
+            return
+        result, error = self.server.queue_prompt(body['prompt'], body.get('client_id'), body.get('extra_data', {}))
+        if error is not None:
+            self.write_json({"error": error, "node_errors": []}, 400)
+        else:
+            self.write_json(result)
+
+
+class QueueHandler(ApiHandler):
+    def get(self):
+        self.write_json(self.server.get_queue())
+
+    def post(self):
+        body = self.json_body()
+        if body.get('clear'):
+            self.server.delete_queued([item[1] for item in self.server.get_queue()['queue_pending']])
+        if 'delete' in body:
+            self.server.delete_queued(body['delete'])
+        self.finish()
+
+
+class InterruptHandler(ApiHandler):
+    def post(self):
+        self.server.interrupt()
+        self.finish()
+
+
+class HistoryHandler(ApiHandler):
+    def get(self, prompt_id=None):
+        max_items = self.get_query_argument('max_items', None)
+        self.write_json(self.server.get_history(prompt_id, int(max_items) if max_items else None))
+
+    def post(self, prompt_id=None):
+        body = self.json_body()
+        if body.get('clear'):
+            self.server.delete_history()
+        if 'delete' in body:
+            self.server.delete_history(body['delete'])
+        self.finish()
+
+
+class ViewHandler(ApiHandler):
+    def get(self):
+        filename = self.get_query_argument('filename', '')
+        if not filename or '..' in filename:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        self.finish(self.server.image(filename))
+
+
+class UploadHandler(ApiHandler):
+    def post(self):
+        files = self.request.files.get('image')
+        if not files:
+            raise tornado.web.HTTPError(400)
+        overwrite = self.get_body_argument('overwrite', 'false').lower() == 'true'
+        subfolder = self.get_body_argument('subfolder', '')
+        self.write_json(self.server.upload_image(files[0]['filename'], files[0]['body'], subfolder, overwrite))
+
+
+class ObjectInfoHandler(ApiHandler):
+    def get(self):
+        self.write_json(self.server.object_info)
+
+
+class WebSocketHandler(tornado.websocket.WebSocketHandler):
+    def initialize(self, server):
+        self.server = server
+        self.client_id = None
+
+    def open(self):
+        self.client_id = self.get_query_argument('clientId', None) or uuid.uuid4().hex
+        self.server.connect(self.client_id, self)
+
+    def on_close(self):
+        self.server.disconnect(self.client_id, self)
+
+
+def make_app(server):
+    args = {"server": server}
+    return tornado.web.Application([
+        (r"/prompt", PromptHandler, args),
+        (r"/queue", QueueHandler, args),
+        (r"/interrupt", InterruptHandler, args),
+        (r"/history", HistoryHandler, args),
+        (r"/history/([^/]+)", HistoryHandler, args),
+        (r"/view", ViewHandler, args),
+        (r"/upload/image", UploadHandler, args),
+        (r"/object_info", ObjectInfoHandler, args),
+        (r"/ws", WebSocketHandler, args),
+    ], websocket_max_message_size=64 * 1024 * 1024)
+
+
+def start_server(server, address='127.0.0.1', port=0):
+    """
+    serve a FakeComfyUI from a daemon thread, return its address, e.g. http://127.0.0.1:43123
+    """
+    sockets = tornado.netutil.bind_sockets(port, address)
+    # a line per request would drown the benchmark output
+    logging.getLogger("tornado.access").setLevel(logging.WARNING)
+    started = threading.Event()
+
+    def serve():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        http_server = tornado.httpserver.HTTPServer(make_app(server), max_buffer_size=256 * 1024 * 1024)
+        http_server.add_sockets(sockets)
+        server.io_loop = tornado.ioloop.IOLoop.current()
+        started.set()
+        server.io_loop.start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    started.wait()
+    return f"http://{address}:{sockets[0].getsockname()[1]}"
+
+
+def parse_latencies(items):
+    latencies = {}
+    for item in items or []:
+        class_type, _, seconds = item.rpartition("=")
+        latencies[class_type] = float(seconds)
+    return latencies
+
+
+def add_server_arguments(parser):
+    parser.add_argument("--latency", action="append", help="seconds a node class runs, class=seconds, repeatable")
+    parser.add_argument("--node-latency", type=float, default=DEFAULT_NODE_LATENCY, help="seconds of other nodes")
+    parser.add_argument("--step-latency", type=float, default=DEFAULT_STEP_LATENCY, help="seconds per sampler step")
+    parser.add_argument("--preview-size", type=int, default=DEFAULT_PREVIEW_SIZE, help="preview frame pixels, 0 for none")
+    parser.add_argument("--output-size", type=parse_size, default=DEFAULT_OUTPUT_SIZE, help="output image WxH")
+    parser.add_argument("--output-count", type=int, default=1, help="images per output node")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of prompts failing at a random node")
+    parser.add_argument("--object-info", help="object_info json file, default the nodes of the benchmark apps")
+    parser.add_argument("--replay", help="recording of a comfyui run to replay, see modules/recorder.py")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 4 for 4x, 0 as fast as possible")
+
+
+def server_from_args(args):
+    object_info = None
+    if args.object_info:
+        with open(args.object_info, encoding="utf-8") as f:
+            object_info = json.load(f)
+    return FakeComfyUI(latencies=parse_latencies(args.latency), node_latency=args.node_latency,
+                       step_latency=args.step_latency, preview_size=args.preview_size, output_size=args.output_size,
+                       output_count=args.output_count, error_rate=args.error_rate, object_info=object_info,
+                       recording=args.replay, speed=args.speed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake comfyui server for benchmarks")
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    # the recording reader of the project, for --replay
+    sys.path.insert(0, PROJECT_PATH)
+    server_addr = start_server(server_from_args(args), args.address, args.port)
+    print(f"fake comfyui on {server_addr}, set COMFYUI_SERVER_ADDR={server_addr}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
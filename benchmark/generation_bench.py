@@ -0,0 +1,244 @@
+"""
+Throughput and latency of the generation flow against the fake comfyui server.
+
+Two suites, each run against a FakeComfyUI started in this process unless --server
+points at a running comfyui:
+
+- client, ComfyClient alone: queue_prompt, websocket events until the prompt is done,
+  then history and output downloads, with --concurrency prompts in flight
+- app, the Comfyflow page in the streamlit test harness: set a new seed, press the
+  generate button and wait until the outputs are shown, through the job scheduler,
+  gallery and preview encoding
+
+The page runs in a temporary workspace with its own sqlite database and gallery, so a
+benchmark leaves the project's data alone. Seeds change on every run, so comfyui caches
+only the nodes before the sampler.
+
+usage, from the project root:
+    python benchmark/generation_bench.py
+    python benchmark/generation_bench.py client --runs 50 --concurrency 4 --step-latency 0.05
+    python benchmark/generation_bench.py app --runs 10 --batch 4 --output-size 1024x1024
+    python benchmark/generation_bench.py app --replay recording.jsonl --speed 4
+"""
+import argparse
+import json
+import os
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fake_comfyui
+from sample_apps import SAMPLE_APPS
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# seconds a prompt may take before the run counts as failed
+RUN_TIMEOUT = 300
+
+APP_SCRIPT = """
+import sys
+sys.path.insert(0, {project_path!r})
+from modules import get_comfy_client
+from modules.comfyflow import Comfyflow
+
+Comfyflow(comfy_client=get_comfy_client(), api_data={api_data!r}, app_data={app_data!r}).create_ui(show_header=True)
+"""
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    index = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def print_latencies(name, values, unit="ms", scale=1000):
+    if len(values) == 0:
+        print(f"  {name:<24} no samples")
+        return
+    print(f"  {name:<24} p50 {percentile(values, 50) * scale:9.1f}  p95 {percentile(values, 95) * scale:9.1f}  "
+          f"p99 {percentile(values, 99) * scale:9.1f}  max {max(values) * scale:9.1f} {unit}  (n={len(values)})")
+
+
+def setup_workspace():
+    """
+    a temporary working directory for the page, call before streamlit is imported: streamlit
+    reads .streamlit/secrets.toml from the working directory at import time
+    """
+    workspace = tempfile.mkdtemp(prefix="comfyflow-bench-")
+    os.makedirs(os.path.join(workspace, ".streamlit"))
+    with open(os.path.join(workspace, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write('[connections.comfyflow_db]\nurl = "sqlite:///bench.db"\n')
+    # the page shows public/images/output-none.png before the first generation
+    shutil.copytree(os.path.join(PROJECT_PATH, "public"), os.path.join(workspace, "public"))
+    os.environ.setdefault("COMFYFLOW_GALLERY_DIR", os.path.join(workspace, ".gallery"))
+    os.chdir(workspace)
+    sys.path.insert(0, PROJECT_PATH)
+    return workspace
+
+
+def patch_app_test():
+    # the streamlit 1.28 test harness asserts on blocks without a type, such as the
+    # placeholders of st.empty the page replaces while generating, read them as containers
+    from streamlit.testing.v1 import element_tree
+
+    def block_init(self, proto, root):
+        self.children = {}
+        self.proto = proto
+        self.root = root
+        self.type = (proto.WhichOneof("type") if proto else None) or "container"
+
+    element_tree.Block.__init__ = block_init
+
+
+def write_app_script(workspace, app):
+    api_data, app_data = SAMPLE_APPS[app]
+    script_path = os.path.join(workspace, f"{app}_app.py")
+    with open(script_path, "w", encoding="utf-8") as f:
+        f.write(APP_SCRIPT.format(project_path=PROJECT_PATH, api_data=json.dumps(api_data), app_data=json.dumps(app_data)))
+    return script_path
+
+
+def run_prompt(client, prompt):
+    """
+    queue a prompt, wait for its events and fetch its outputs, return the stage timings
+    """
+    timings = {"previews": 0}
+    started_at = time.perf_counter()
+    events = queue.Queue()
+    prompt_id = client.gen_images(prompt, events)
+    timings["queue_prompt"] = time.perf_counter() - started_at
+    error = None
+    while True:
+        event = events.get(timeout=RUN_TIMEOUT)
+        if event["type"] == "execution_start":
+            timings["first_event"] = time.perf_counter() - started_at
+        elif event["type"] == "b_preview":
+            timings["previews"] += 1
+            timings.setdefault("first_preview", time.perf_counter() - started_at)
+        elif event["type"] == "execution_error":
+            error = event["data"].get("exception_message")
+        elif event["type"] == "executing" and event["data"] is None:
+            break
+    timings["execution"] = time.perf_counter() - started_at
+
+    fetch_started_at = time.perf_counter()
+    history = client.get_history(prompt_id).get(prompt_id, {})
+    output_bytes = 0
+    for node_output in history.get("outputs", {}).values():
+        for image in node_output.get("images", []):
+            output_bytes += len(client.get_image(image["filename"], image["subfolder"], image["type"]))
+    timings["output_fetch"] = time.perf_counter() - fetch_started_at
+    timings["end_to_end"] = time.perf_counter() - started_at
+    timings["output_bytes"] = output_bytes
+    timings["error"] = error
+    return timings
+
+
+def bench_client(server_addr, args):
+    from modules.comfyclient import ComfyClient
+
+    client = ComfyClient(server_addr)
+    api_data, _ = SAMPLE_APPS[args.app]
+    prompts = []
+    for _ in range(args.runs):
+        prompt = json.loads(json.dumps(api_data))
+        prompt["3"]["inputs"]["seed"] = random.randint(0, 2 ** 32)
+        prompts.append(prompt)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda prompt: run_prompt(client, prompt), prompts))
+    elapsed = time.perf_counter() - started_at
+
+    errors = [result for result in results if result["error"] is not None]
+    print(f"client: {args.runs} prompts of {args.app}, concurrency {args.concurrency}, {elapsed:.2f}s, "
+          f"{args.runs / elapsed:.2f} prompts/s, {len(errors)} errors")
+    for stage in ("queue_prompt", "first_event", "first_preview", "execution", "output_fetch", "end_to_end"):
+        print_latencies(stage, [result[stage] for result in results if stage in result])
+    previews = sum(result["previews"] for result in results)
+    output_bytes = sum(result["output_bytes"] for result in results)
+    print(f"  previews {previews} ({previews / elapsed:.1f}/s), outputs {output_bytes / 1024 / 1024:.1f} MB "
+          f"({output_bytes / 1024 / 1024 / elapsed:.1f} MB/s)")
+    return len(errors) == 0
+
+
+def bench_app(workspace, args):
+    from streamlit.testing.v1 import AppTest
+    from modules import metrics
+
+    patch_app_test()
+    at = AppTest.from_file(write_app_script(workspace, args.app), default_timeout=RUN_TIMEOUT).run()
+    if len(at.exception) > 0:
+        print(f"app failed to load: {at.exception[0].message}")
+        return False
+    at.session_state["batch_count"] = args.batch
+
+    latencies = []
+    failures = 0
+    started_at = time.perf_counter()
+    for _ in range(args.runs):
+        at.session_state["3_seed"] = random.randint(0, 2 ** 32)
+        run_started_at = time.perf_counter()
+        [button for button in at.button if button.label == "生成"][0].click().run()
+        latencies.append(time.perf_counter() - run_started_at)
+        progress = at.get("progress")
+        if len(at.exception) > 0 or len(at.error) > 0 or len(progress) == 0 or progress[0].proto.text != "生成完成":
+            failures += 1
+    elapsed = time.perf_counter() - started_at
+
+    images = args.runs * args.batch
+    print(f"app: {args.runs} generations of {args.app}, batch {args.batch}, {elapsed:.2f}s, "
+          f"{images / elapsed:.2f} images/s, {failures} failed")
+    print_latencies("generate", latencies)
+    # stage means from the scheduler's prometheus histograms
+    for histogram in (metrics.QUEUE_WAIT, metrics.EXECUTION, metrics.OUTPUT_FETCH, metrics.END_TO_END):
+        for key, (_, total, count) in histogram.values.items():
+            print(f"  {histogram.name:<36} mean {total / count * 1000:9.1f} ms  (n={count})")
+    return failures == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ComfyFlowApp generation benchmark")
+    parser.add_argument("suites", nargs="*", help="suites to run, client and app, default both")
+    parser.add_argument("--app", choices=sorted(SAMPLE_APPS), default="txt2img", help="benchmark app")
+    parser.add_argument("--runs", type=int, default=20, help="prompts or generations per suite")
+    parser.add_argument("--concurrency", type=int, default=1, help="prompts in flight, client suite")
+    parser.add_argument("--batch", type=int, default=1, help="images per generation, app suite")
+    parser.add_argument("--server", help="a running comfyui instead of the fake server")
+    fake_comfyui.add_server_arguments(parser)
+    args = parser.parse_args()
+    unknown = [suite for suite in args.suites if suite not in ("client", "app")]
+    if unknown:
+        parser.error(f"unknown suites {unknown}, choose from client and app")
+
+    workspace = setup_workspace()
+    server_addr = args.server or fake_comfyui.start_server(fake_comfyui.server_from_args(args))
+    os.environ["COMFYUI_SERVER_ADDR"] = server_addr
+    # keep the per-event debug logs out of the measurement
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    passed = True
+    try:
+        for suite in args.suites or ["client", "app"]:
+            if suite == "client":
+                passed = bench_client(server_addr, args) and passed
+            elif suite == "app":
+                if args.app == "img2img":
+                    print("app: the streamlit test harness can't upload files, use the client suite for img2img")
+                    continue
+                passed = bench_app(workspace, args) and passed
+    finally:
+        os.chdir(PROJECT_PATH)
+        shutil.rmtree(workspace, ignore_errors=True)
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+Import-time budget for ComfyFlowApp pages and modules.
+
+Every target is imported in a fresh interpreter with `-X importtime`, after the
+baseline that a streamlit server has loaded anyway (streamlit, loguru). The cost
+on top of the baseline is compared with the budget, and the slowest imported
+modules are listed so a regression can be traced to its import.
+
+usage, from the project root:
+    python benchmark/import_time.py
+    python benchmark/import_time.py --repeat 5 --budget modules.comfyflow=200 --scale 1.5
+"""
+import argparse
+import ast
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BASELINE_IMPORTS = "import streamlit, loguru"
+BASELINE_MARKER = "comfyflow-import-baseline-done"
+
+# milliseconds on top of the baseline, pages are measured by their top-level imports
+IMPORT_BUDGETS_MS = {
+    "Home.py": 150,
+    "pages/1_📱_My Apps.py": 150,
+    "pages/3_📚_Workspace.py": 150,
+    "modules": 30,
+    "modules.comfyclient": 150,
+    "modules.comfyflow": 200,
+    "modules.new_app": 200,
+    "manager.app_manager": 200,
+}
+
+
+def import_snippet(target):
+    # pages are scripts that render on import, only their import statements are timed
+    if target.endswith(".py"):
+        with open(os.path.join(PROJECT_PATH, target), encoding="utf-8") as f:
+            tree = ast.parse(f.read())
+        nodes = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+        return ast.unparse(ast.Module(body=nodes, type_ignores=[]))
+    return f"import {target}"
+
+
+def measure(target):
+    code = "\n".join([
+        BASELINE_IMPORTS,
+        "import sys, time",
+        f"sys.stderr.write('{BASELINE_MARKER}\\n')",
+        "sys.stderr.flush()",
+        "start = time.perf_counter()",
+        import_snippet(target),
+        "print((time.perf_counter() - start) * 1000)",
+    ])
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=PROJECT_PATH,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {target} failed\n{result.stderr.splitlines()[-1]}")
+
+    elapsed_ms = float(result.stdout.strip().splitlines()[-1])
+    modules = []
+    lines = result.stderr.split(BASELINE_MARKER, 1)[-1].splitlines()
+    for line in lines:
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue
+        modules.append((int(self_us) / 1000, int(cumulative_us) / 1000, name.strip()))
+    return elapsed_ms, modules
+
+
+def parse_budgets(items):
+    budgets = dict(IMPORT_BUDGETS_MS)
+    for item in items or []:
+        target, _, budget = item.rpartition("=")
+        budgets[target] = float(budget)
+    return budgets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ComfyFlowApp import-time budget")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per target, the median is used")
+    parser.add_argument("--top", type=int, default=5, help="slowest modules shown per target")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply all budgets, for slow machines")
+    parser.add_argument("--budget", action="append", help="override a budget, target=ms")
+    parser.add_argument("targets", nargs="*", help="targets to measure, default all budgets")
+    args = parser.parse_args()
+
+    budgets = parse_budgets(args.budget)
+    targets = args.targets or list(budgets.keys())
+    exceeded = []
+    for target in targets:
+        runs = [measure(target) for _ in range(args.repeat)]
+        elapsed_ms = statistics.median(run[0] for run in runs)
+        budget_ms = budgets.get(target)
+        if budget_ms is None:
+            status = "-"
+        elif elapsed_ms > budget_ms * args.scale:
+            status = "OVER"
+            exceeded.append(target)
+        else:
+            status = "ok"
+        budget_text = f"{budget_ms * args.scale:.0f}" if budget_ms is not None else "-"
+        print(f"{status:>4} {target:<32} {elapsed_ms:8.1f} ms  (budget {budget_text} ms)")
+
+        _, modules = runs[-1]
+        for self_ms, cumulative_ms, name in sorted(modules, key=lambda m: m[0], reverse=True)[:args.top]:
+            print(f"       self {self_ms:7.1f} ms  cumulative {cumulative_ms:7.1f} ms  {name}")
+
+    if exceeded:
+        print(f"import budget exceeded: {', '.join(exceeded)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,355 @@
+"""
+Concurrent-session load test of an app page against the fake comfyui server.
+
+The benchmark app runs in a real streamlit server process, started in a temporary
+workspace, and every simulated user is a browser session speaking the streamlit
+websocket protocol: it opens the app, changes the seed and prompt, uploads an input
+image for img2img, presses the generate button and waits until the outputs are shown,
+--generations times with --think-time seconds between actions.
+
+Sessions are stepped up through the --users levels against the same server. Per level
+the p50/p95/p99 of opening the app, uploading and generating are reported, together
+with the peak threads, RSS, open file descriptors and sockets of the server process,
+sampled every --sample-interval seconds. The first level over --max-p95 or
+--max-error-rate is reported as the concurrency ceiling.
+
+usage, from the project root:
+    python benchmark/load_test.py --users 1,4,16,32
+    python benchmark/load_test.py --app img2img --users 8 --generations 5 --step-latency 0.1
+"""
+import argparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import fake_comfyui
+from generation_bench import RUN_TIMEOUT, percentile, print_latencies, setup_workspace, write_app_script
+from sample_apps import SAMPLE_APPS
+
+# seconds to wait for the streamlit server to come up
+SERVER_START_TIMEOUT = 60
+SERVER_OPTIONS = [
+    "--server.headless", "true",
+    "--server.fileWatcherType", "none",
+    "--server.enableXsrfProtection", "false",
+    "--server.enableCORS", "false",
+    "--browser.gatherUsageStats", "false",
+]
+PROMPTS = ["a photo of a cat", "a watercolor of a harbor", "a castle at dawn", "a robot reading a book"]
+
+
+class SessionError(Exception):
+    pass
+
+
+class BrowserSession:
+    """
+    one browser tab: a streamlit websocket session with the widget values it sends
+    """
+
+    def __init__(self, base_url) -> None:
+        import websocket
+
+        self.base_url = base_url
+        self.ws = websocket.create_connection(f"{base_url.replace('http', 'ws', 1)}/_stcore/stream",
+                                              subprotocols=["streamlit"], timeout=RUN_TIMEOUT)
+        self.session_id = None
+        # label -> (element type, widget id) of the widgets on the page
+        self.widgets = {}
+        # widget id -> WidgetState, sent with every rerun like the browser does
+        self.states = {}
+
+    def close(self):
+        self.ws.close()
+
+    def recv(self):
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        msg = ForwardMsg()
+        msg.ParseFromString(self.ws.recv())
+        if msg.WhichOneof("type") == "new_session":
+            self.session_id = msg.new_session.initialize.session_id
+        return msg
+
+    def send(self, back_msg):
+        self.ws.send_binary(back_msg.SerializeToString())
+
+    def run(self, triggers=()):
+        """
+        rerun the script with the current widget values and the given triggered widgets,
+        return the progress texts and errors shown until the script finished
+        """
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        back_msg = BackMsg()
+        back_msg.rerun_script.query_string = ""
+        back_msg.rerun_script.widget_states.widgets.extend(self.states.values())
+        for widget_id in triggers:
+            back_msg.rerun_script.widget_states.widgets.append(WidgetState(id=widget_id, trigger_value=True))
+        self.send(back_msg)
+
+        progress = []
+        errors = []
+        while True:
+            msg = self.recv()
+            msg_type = msg.WhichOneof("type")
+            if msg_type == "script_finished":
+                if msg.script_finished != msg.FINISHED_EARLY_FOR_RERUN:
+                    return progress, errors
+            elif msg_type == "delta" and msg.delta.WhichOneof("type") == "new_element":
+                element = msg.delta.new_element
+                element_type = element.WhichOneof("type")
+                proto = getattr(element, element_type) if element_type else None
+                if element_type == "progress":
+                    progress.append(proto.text)
+                elif element_type == "exception":
+                    errors.append(proto.message)
+                elif element_type == "alert" and proto.format == proto.ERROR:
+                    errors.append(proto.body)
+                elif proto is not None and hasattr(proto, "id") and hasattr(proto, "label"):
+                    self.widgets[proto.label] = (element_type, proto.id)
+
+    def widget_id(self, label):
+        if label not in self.widgets:
+            raise SessionError(f"no widget {label} on the page")
+        return self.widgets[label][1]
+
+    def set_value(self, label, field, value):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        state = WidgetState(id=self.widget_id(label))
+        setattr(state, field, value)
+        self.states[state.id] = state
+
+    def upload(self, label, filename, data, content_type="image/png"):
+        """
+        upload a file to a file_uploader like the browser: ask for an upload url, put the
+        file there and rerun with the widget pointing at it
+        """
+        import requests
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.Common_pb2 import UploadedFileInfo
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        widget_id = self.widget_id(label)
+        request_id = uuid.uuid4().hex
+        back_msg = BackMsg()
+        back_msg.file_urls_request.request_id = request_id
+        back_msg.file_urls_request.file_names.append(filename)
+        back_msg.file_urls_request.session_id = self.session_id or ""
+        self.send(back_msg)
+        while True:
+            msg = self.recv()
+            if msg.WhichOneof("type") == "file_urls_response" and msg.file_urls_response.response_id == request_id:
+                break
+        if msg.file_urls_response.error_msg:
+            raise SessionError(msg.file_urls_response.error_msg)
+        file_urls = msg.file_urls_response.file_urls[0]
+        resp = requests.put(f"{self.base_url}{file_urls.upload_url}", files={"file": (filename, data, content_type)},
+                            timeout=RUN_TIMEOUT)
+        if resp.status_code >= 300:
+            raise SessionError(f"upload failed, {resp.status_code} {resp.reason}")
+
+        state = WidgetState(id=widget_id)
+        state.file_uploader_state_value.uploaded_file_info.append(
+            UploadedFileInfo(file_id=file_urls.file_id, name=filename, size=len(data), file_urls=file_urls))
+        self.states[widget_id] = state
+        return self.run()
+
+
+def user_session(base_url, args, upload_data, results):
+    """
+    one simulated user, timings and errors are appended to results
+    """
+    try:
+        started_at = time.perf_counter()
+        session = BrowserSession(base_url)
+        _, errors = session.run()
+        results["open"].append(time.perf_counter() - started_at)
+        if errors:
+            raise SessionError(errors[0])
+    except Exception as e:
+        results["errors"].append(f"open: {e}")
+        return
+
+    try:
+        for _ in range(args.generations):
+            time.sleep(random.uniform(0, args.think_time * 2))
+            session.set_value("seed", "int_value", random.randint(0, 2 ** 32))
+            session.set_value("prompt", "string_value", random.choice(PROMPTS))
+            if args.app == "img2img":
+                started_at = time.perf_counter()
+                _, errors = session.upload("image", f"input-{uuid.uuid4().hex[:8]}.png", upload_data)
+                results["upload"].append(time.perf_counter() - started_at)
+                if errors:
+                    raise SessionError(errors[0])
+
+            started_at = time.perf_counter()
+            progress, errors = session.run(triggers=[session.widget_id("生成")])
+            results["generate"].append(time.perf_counter() - started_at)
+            if errors or "生成完成" not in progress:
+                results["errors"].append(f"generate: {errors[0] if errors else 'not finished'}")
+    except Exception as e:
+        results["errors"].append(f"session: {e}")
+    finally:
+        session.close()
+
+
+class ProcessMonitor:
+    """
+    samples threads, rss, file descriptors and sockets of a process in the background
+    """
+
+    def __init__(self, pid, interval) -> None:
+        import psutil
+
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample_loop, daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        with self.process.oneshot():
+            return {
+                "threads": self.process.num_threads(),
+                "rss_mb": self.process.memory_info().rss / 1024 / 1024,
+                "fds": self.process.num_fds() if hasattr(self.process, "num_fds") else self.process.num_handles(),
+                "sockets": len(self.process.connections(kind="inet")),
+            }
+
+    def _sample_loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.samples.append(self.sample())
+            except Exception:
+                return
+
+    def window(self):
+        # samples since the last call
+        samples, self.samples = self.samples, []
+        return samples
+
+    def stop(self):
+        self.stopped.set()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_streamlit(script_path, workspace, port):
+    import requests
+
+    log = open(os.path.join(workspace, "streamlit.log"), "w", encoding="utf-8")
+    process = subprocess.Popen([sys.executable, "-m", "streamlit", "run", script_path, "--server.port", str(port),
+                                "--server.address", "127.0.0.1", *SERVER_OPTIONS],
+                               cwd=workspace, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"streamlit exited with {process.returncode}, see {log.name}")
+        try:
+            if requests.get(f"{base_url}/_stcore/health", timeout=1).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"streamlit didn't start in {SERVER_START_TIMEOUT}s, see {log.name}")
+
+
+def run_level(base_url, users, args, upload_data, monitor):
+    results = {"open": [], "upload": [], "generate": [], "errors": []}
+    threads = []
+    monitor.window()
+    started_at = time.perf_counter()
+    for index in range(users):
+        thread = threading.Thread(target=user_session, args=(base_url, args, upload_data, results), daemon=True)
+        thread.start()
+        threads.append(thread)
+        if args.ramp_up > 0 and index < users - 1:
+            time.sleep(args.ramp_up / users)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+    # the server after the level, sessions closed and generations done
+    time.sleep(args.sample_interval * 2)
+    samples = monitor.window() or [monitor.sample()]
+
+    generations = users * args.generations
+    error_rate = len(results["errors"]) / max(generations, 1)
+    print(f"{users} users: {elapsed:.1f}s, {len(results['generate'])} generations, "
+          f"{len(results['generate']) / elapsed:.2f} generations/s, {len(results['errors'])} errors ({error_rate:.0%})")
+    for name in ("open", "upload", "generate"):
+        if results[name]:
+            print_latencies(name, results[name])
+    peak = {key: max(sample[key] for sample in samples) for key in samples[0]}
+    last = samples[-1]
+    print(f"  server peak: threads {peak['threads']}, rss {peak['rss_mb']:.0f} MB, fds {peak['fds']}, "
+          f"sockets {peak['sockets']}; after the level: threads {last['threads']}, rss {last['rss_mb']:.0f} MB, "
+          f"fds {last['fds']}, sockets {last['sockets']}")
+    for error in sorted(set(results["errors"]))[:5]:
+        print(f"  error: {error}")
+    p95 = percentile(results["generate"], 95)
+    return error_rate <= args.max_error_rate and (args.max_p95 <= 0 or p95 <= args.max_p95)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ComfyFlowApp concurrent-session load test")
+    parser.add_argument("--users", default="1,4,16", help="concurrent users per level, comma separated")
+    parser.add_argument("--app", choices=sorted(SAMPLE_APPS), default="txt2img", help="benchmark app")
+    parser.add_argument("--generations", type=int, default=3, help="generations per user")
+    parser.add_argument("--think-time", type=float, default=1.0, help="mean seconds between actions of a user")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="seconds to start the users of a level")
+    parser.add_argument("--upload-size", type=int, default=512, help="pixels of the uploaded square image")
+    parser.add_argument("--max-p95", type=float, default=0, help="generate p95 seconds of the ceiling, 0 for none")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="error rate of the ceiling")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="seconds between server samples")
+    parser.add_argument("--server", help="a running comfyui instead of the fake server")
+    fake_comfyui.add_server_arguments(parser)
+    args = parser.parse_args()
+    levels = [int(users) for users in args.users.split(",")]
+
+    workspace = setup_workspace()
+    server_addr = args.server or fake_comfyui.start_server(fake_comfyui.server_from_args(args))
+    os.environ["COMFYUI_SERVER_ADDR"] = server_addr
+    upload_data = fake_comfyui.noise_image((args.upload_size, args.upload_size), "PNG")
+    process, base_url = start_streamlit(write_app_script(workspace, args.app), workspace, free_port())
+    monitor = ProcessMonitor(process.pid, args.sample_interval)
+    print(f"{args.app} on {base_url}, pid {process.pid}, comfyui {server_addr}, workspace {workspace}")
+    print(f"  idle server: {monitor.sample()}")
+
+    ceiling = None
+    try:
+        for users in levels:
+            if not run_level(base_url, users, args, upload_data, monitor):
+                ceiling = users
+                break
+    finally:
+        monitor.stop()
+        process.terminate()
+        process.wait(timeout=30)
+        os.chdir(fake_comfyui.PROJECT_PATH)
+
+    if ceiling is not None:
+        print(f"concurrency ceiling: {ceiling} users exceeded the limits, logs in {workspace}")
+        return 1
+    print(f"no ceiling up to {levels[-1]} users")
+    shutil.rmtree(workspace, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Replay a recorded comfyui run through ComfyClient's event path, without a comfyui.
+
+Record a real run first: start ComfyFlowApp with COMFYFLOW_RECORD_DIR set, generate
+with the app to benchmark, e.g. a 200 step AnimateDiff workflow, and stop it. Each
+client leaves a comfyui-<pid>-<client>.jsonl recording, see modules/recorder.py.
+
+The recorded websocket messages are fed to ComfyClient._handle_message at the recorded
+pace divided by --speed, 0 for as fast as possible, with a queue subscribed to every
+recorded prompt like the scheduler's jobs. A consumer thread drains the queue like the
+page does, decoding and re-encoding every preview frame as st.image would. Reported:
+the time _handle_message takes per message, the delay until the consumer gets an event,
+and how far the feeding falls behind the recorded pace.
+
+To replay through the scheduler and the page instead, serve the recording from the fake
+comfyui: python benchmark/generation_bench.py app --replay <recording> --speed 4
+
+usage, from the project root:
+    python benchmark/replay.py recordings/comfyui-1234-0a1b2c3d.jsonl
+    python benchmark/replay.py recordings/comfyui-1234-0a1b2c3d.jsonl --speed 0 --repeat 5
+"""
+import argparse
+import io
+import os
+import queue
+import sys
+import threading
+import time
+
+from generation_bench import PROJECT_PATH, print_latencies
+
+
+class TimedQueue:
+    # the subscriber ComfyClient dispatches to, events are stamped when they are put
+    def __init__(self) -> None:
+        self.events = queue.Queue()
+
+    def put(self, event):
+        self.events.put((time.perf_counter(), event))
+
+
+def consume(events, prompts, stats):
+    finished = 0
+    while finished < prompts:
+        put_at, event = events.get()
+        if event['type'] == 'b_preview':
+            started_at = time.perf_counter()
+            image = event['data']
+            buffer = io.BytesIO()
+            image.save(buffer, format=image.format or 'PNG')
+            stats['preview_encode'].append(time.perf_counter() - started_at)
+        elif event['type'] == 'progress':
+            stats['progress'] += 1
+        elif event['type'] == 'executing' and event['data'] is None:
+            finished += 1
+        stats['delivery'].append(time.perf_counter() - put_at)
+        stats['events'] += 1
+
+
+def replay(items, prompt_ids, speed):
+    from modules.comfyclient import ComfyClient
+
+    # never connects, messages are handed to the client directly
+    client = ComfyClient("http://replay.invalid")
+    events = TimedQueue()
+    for prompt_id in prompt_ids:
+        client.subscribe(prompt_id, events)
+    stats = {'handle': [], 'delivery': [], 'preview_encode': [], 'lag': [], 'events': 0, 'progress': 0, 'messages': 0}
+    consumer = threading.Thread(target=consume, args=(events.events, len(prompt_ids), stats), daemon=True)
+    consumer.start()
+
+    messages = [item for item in items if item['kind'] in ('ws', 'ws_binary')]
+    first_at = messages[0]['t'] if len(messages) > 0 else 0
+    started_at = time.perf_counter()
+    for item in messages:
+        if speed > 0:
+            due_at = started_at + (item['t'] - first_at) / speed
+            time.sleep(max(due_at - time.perf_counter(), 0))
+            stats['lag'].append(max(time.perf_counter() - due_at, 0))
+        handle_started_at = time.perf_counter()
+        client._handle_message(item['text'] if item['kind'] == 'ws' else item['data'])
+        stats['handle'].append(time.perf_counter() - handle_started_at)
+        stats['messages'] += 1
+    consumer.join(timeout=60)
+    stats['elapsed'] = time.perf_counter() - started_at
+    stats['finished'] = not consumer.is_alive()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded comfyui run through ComfyClient")
+    parser.add_argument("recording", help="recording of a comfyui run, see modules/recorder.py")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 4 for 4x, 0 as fast as possible")
+    parser.add_argument("--repeat", type=int, default=1, help="replays of the recording")
+    args = parser.parse_args()
+
+    sys.path.insert(0, PROJECT_PATH)
+    from loguru import logger
+    from modules.recorder import load_recording
+
+    # keep the per-message debug logs out of the measurement
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    items, prompts, _ = load_recording(os.path.abspath(args.recording))
+    if len(prompts) == 0:
+        print(f"no prompt in recording {args.recording}")
+        return 1
+    recorded_duration = max(item['t'] for item in items) - min(item['t'] for item in items)
+    print(f"{args.recording}: {len(prompts)} prompts, {len(items)} items, {recorded_duration:.1f}s recorded, speed {args.speed or 'max'}")
+
+    passed = True
+    for run in range(args.repeat):
+        stats = replay(items, list(prompts), args.speed)
+        print(f"run {run + 1}: {stats['messages']} messages in {stats['elapsed']:.2f}s, "
+              f"{stats['messages'] / stats['elapsed']:.0f} messages/s, {stats['events']} events, "
+              f"{len(stats['preview_encode'])} previews, {stats['progress']} progress")
+        print_latencies("handle_message", stats['handle'])
+        print_latencies("event_delivery", stats['delivery'])
+        print_latencies("preview_encode", stats['preview_encode'])
+        if args.speed > 0:
+            print_latencies("schedule_lag", stats['lag'])
+        if not stats['finished']:
+            print("  the consumer didn't see every prompt finish")
+            passed = False
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
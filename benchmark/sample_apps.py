@@ -0,0 +1,61 @@
+"""
+Apps for the benchmarks, an api prompt and its app config as created on the new app page.
+
+The nodes are those of fake_comfyui.DEFAULT_OBJECT_INFO, so the apps run on the fake
+server; on a real comfyui, install a checkpoint named fake_comfyui.CHECKPOINT_NAME.
+"""
+from fake_comfyui import CHECKPOINT_NAME
+
+TXT2IMG_PROMPT = {
+    "3": {"class_type": "KSampler", "inputs": {
+        "seed": 42, "steps": 20, "cfg": 7.0, "sampler_name": "euler", "scheduler": "normal", "denoise": 1.0,
+        "model": ["4", 0], "positive": ["6", 0], "negative": ["7", 0], "latent_image": ["5", 0]}},
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": CHECKPOINT_NAME}},
+    "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 512, "height": 512, "batch_size": 1}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a photo of a cat", "clip": ["4", 1]}},
+    "7": {"class_type": "CLIPTextEncode", "inputs": {"text": "blurry", "clip": ["4", 1]}},
+    "8": {"class_type": "VAEDecode", "inputs": {"samples": ["3", 0], "vae": ["4", 2]}},
+    "9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "ComfyUI", "images": ["8", 0]}},
+}
+
+TXT2IMG_APP = {
+    "name": "bench-txt2img",
+    "description": "txt2img benchmark app",
+    "inputs": {
+        "6": {"inputs": {"text": {"type": "TEXT", "name": "prompt", "help": "", "default": "a photo of a cat", "max": 500}}},
+        "3": {"inputs": {
+            "seed": {"type": "NUMBER", "name": "seed", "help": "", "default": 42, "min": 0, "max": 4503599627370496, "step": 1},
+            "steps": {"type": "NUMBER", "name": "steps", "help": "", "default": 20, "min": 1, "max": 100, "step": 1}}},
+    },
+    "outputs": {"9": {"outputs": {}, "name": "image", "help": ""}},
+}
+
+IMG2IMG_PROMPT = {
+    "3": {"class_type": "KSampler", "inputs": {
+        "seed": 42, "steps": 20, "cfg": 7.0, "sampler_name": "euler", "scheduler": "normal", "denoise": 0.6,
+        "model": ["4", 0], "positive": ["6", 0], "negative": ["7", 0], "latent_image": ["11", 0]}},
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": CHECKPOINT_NAME}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a painting of a cat", "clip": ["4", 1]}},
+    "7": {"class_type": "CLIPTextEncode", "inputs": {"text": "blurry", "clip": ["4", 1]}},
+    "8": {"class_type": "VAEDecode", "inputs": {"samples": ["3", 0], "vae": ["4", 2]}},
+    "9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "ComfyUI", "images": ["8", 0]}},
+    "10": {"class_type": "LoadImage", "inputs": {"image": "example.png"}},
+    "11": {"class_type": "VAEEncode", "inputs": {"pixels": ["10", 0], "vae": ["4", 2]}},
+}
+
+IMG2IMG_APP = {
+    "name": "bench-img2img",
+    "description": "img2img benchmark app",
+    "inputs": {
+        "10": {"inputs": {"image": {"type": "UPLOADIMAGE", "name": "image", "help": ""}}},
+        "6": {"inputs": {"text": {"type": "TEXT", "name": "prompt", "help": "", "default": "a painting of a cat", "max": 500}}},
+        "3": {"inputs": {
+            "seed": {"type": "NUMBER", "name": "seed", "help": "", "default": 42, "min": 0, "max": 4503599627370496, "step": 1}}},
+    },
+    "outputs": {"9": {"outputs": {}, "name": "image", "help": ""}},
+}
+
+SAMPLE_APPS = {
+    "txt2img": (TXT2IMG_PROMPT, TXT2IMG_APP),
+    "img2img": (IMG2IMG_PROMPT, IMG2IMG_APP),
+}
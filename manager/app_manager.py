@@ -1,12 +1,20 @@
 import os
+import sys
+import atexit
+import socket
 from loguru import logger
 import threading
 import subprocess
-import psutil
 import shutil
-from modules.workspace_model import AppStatus
+import streamlit as st
+from modules import AppStatus
 from streamlit.runtime.scriptrunner import add_script_run_ctx
 
+# a pool worker serves the app whose id is written to this file in its home
+WORKER_APP_FILE = ".worker_app"
+# seconds to wait for the health check of a warming worker
+WORKER_HEALTH_TIMEOUT = 0.5
+
 class CommandThread(threading.Thread):
     def __init__(self, path, command):
         super(CommandThread, self).__init__()
@@ -26,6 +34,7 @@ def is_process_running(app_name, args):
     """
     ['/usr/local/anaconda3/bin/python', '/usr/local/anaconda3/bin/streamlit', 'run', 'comfyflow_app.py', '--server.port', '8198', '--server.address', 'localhost', '--', '--app', '11']
     """
+    import psutil
     for process in psutil.process_iter(attrs=['pid', 'cmdline']):
         if process.info['cmdline']:
             cmdline = process.info['cmdline']
@@ -39,6 +48,7 @@ def kill_all_process(app_name, args):
     """
     ['/usr/local/anaconda3/bin/python', '/usr/local/anaconda3/bin/streamlit', 'run', 'comfyflow_app.py', '--server.port', '8198', '--server.address', 'localhost', '--', '--app', '11']
     """
+    import psutil
     for process in psutil.process_iter(attrs=['pid', 'cmdline']):
         if process.info['cmdline']:
             cmdline = process.info['cmdline']
@@ -47,6 +57,14 @@ def kill_all_process(app_name, args):
                 logger.info(f"Kill process {app_name}, pid: {process.info['pid']}")
                 process.kill()
 
+def copy_app_tree(app_path):
+    # cp comfyflow_app.py, comfyflow.db, public, modules, .streamlit to app_path
+    shutil.copyfile("./manager/comfyflow_app.py", os.path.join(app_path, "comfyflow_app.py"))
+    shutil.copyfile("./comfyflow.db", os.path.join(app_path, "comfyflow.db"))
+    shutil.copytree("./public", os.path.join(app_path, "public"))
+    shutil.copytree("./modules", os.path.join(app_path, "modules"))
+    shutil.copytree("./.streamlit", os.path.join(app_path, ".streamlit"))
+
 def make_app_home(app_name):
     # remove app home first
     remove_app_home(app_name)
@@ -57,13 +75,7 @@ def make_app_home(app_name):
         logger.info(f"make App {app_name} dir, {app_path}")
 
     try:
-        # cp comfyflow_app.py, comfyflow.db, public, modules, .streamlit to app_path
-        shutil.copyfile("./manager/comfyflow_app.py", os.path.join(app_path, "comfyflow_app.py"))
-        shutil.copyfile("./comfyflow.db", os.path.join(app_path, "comfyflow.db"))
-        shutil.copytree("./public", os.path.join(app_path, "public"))
-        shutil.copytree("./modules", os.path.join(app_path, "modules"))
-        shutil.copytree("./.streamlit", os.path.join(app_path, ".streamlit"))
-
+        copy_app_tree(app_path)
         logger.info(f"App {app_name} generated, path: {app_path}")
         return app_path
     except Exception as e:
@@ -80,6 +92,153 @@ def remove_app_home(app_name):
         logger.info(f"App {app_name} does not exist, path: {app_path}")
         return False
 
+class AppWorker:
+    def __init__(self, path, address, port, process) -> None:
+        self.path = path
+        self.address = address
+        self.port = port
+        self.process = process
+        self.app_id = None
+        self.ready = False
+
+    @property
+    def url(self):
+        return f"http://{self.address}:{self.port}"
+
+    def is_ready(self):
+        # the worker serves http only after its imports are done
+        if not self.ready:
+            import requests
+            try:
+                self.ready = requests.get(f"{self.url}/_stcore/health", timeout=WORKER_HEALTH_TIMEOUT).ok
+            except requests.RequestException:
+                pass
+        return self.ready
+
+    def assign(self, app_id):
+        # refresh the apps db, the worker reads it on the first session of the app
+        shutil.copyfile("./comfyflow.db", os.path.join(self.path, "comfyflow.db"))
+        with open(os.path.join(self.path, WORKER_APP_FILE), "w") as f:
+            f.write(str(app_id))
+        self.app_id = str(app_id)
+        logger.info(f"Worker {self.url} assigned app {app_id}")
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+        logger.info(f"Worker {self.url} killed, path: {self.path}")
+
+
+class AppWorkerPool:
+    """
+    keep a few idle app processes with imports done, so starting an app is a handoff
+    to a running worker instead of copying the tree and cold-booting streamlit
+    """
+    def __init__(self, address, size) -> None:
+        self.address = address
+        self.size = size
+        self.pool_path = os.path.join(os.getcwd(), ".apps", ".pool")
+        self.lock = threading.Lock()
+        self.idle = []
+        self.assigned = {}
+        atexit.register(self.shutdown)
+
+    def _free_port(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind((self.address, 0))
+            return s.getsockname()[1]
+
+    def _spawn_worker(self):
+        port = self._free_port()
+        worker_path = os.path.join(self.pool_path, str(port))
+        if os.path.exists(worker_path):
+            shutil.rmtree(worker_path)
+        os.makedirs(worker_path)
+        copy_app_tree(worker_path)
+        shutil.copyfile("./manager/app_worker.py", os.path.join(worker_path, "app_worker.py"))
+
+        command = [sys.executable, "app_worker.py", "--server.port", str(port),
+                   "--server.address", self.address, "--server.headless", "true"]
+        process = subprocess.Popen(command, cwd=worker_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        logger.info(f"Spawn app worker, port: {port}, pid: {process.pid}")
+        return AppWorker(worker_path, self.address, port, process)
+
+    def fill(self):
+        with self.lock:
+            # drop workers that died while idle
+            self.idle = [worker for worker in self.idle if worker.process.poll() is None]
+            while len(self.idle) < self.size:
+                try:
+                    self.idle.append(self._spawn_worker())
+                except Exception as e:
+                    logger.error(f"Spawn app worker error, {e}")
+                    break
+
+    def find(self, app_id):
+        with self.lock:
+            for worker in self.assigned.values():
+                if worker.app_id == str(app_id) and worker.process.poll() is None:
+                    return worker
+        return None
+
+    def take(self, app_id):
+        # only a worker done warming up, a cold one is no faster than starting the app
+        with self.lock:
+            self.idle = [worker for worker in self.idle if worker.process.poll() is None]
+            worker = next((worker for worker in self.idle if worker.is_ready()), None)
+            if worker is not None:
+                self.idle.remove(worker)
+                worker.assign(app_id)
+                self.assigned[worker.url] = worker
+
+        # refill in background, keep the handoff fast
+        threading.Thread(target=self.fill, daemon=True).start()
+        return worker
+
+    def release(self, url):
+        with self.lock:
+            worker = self.assigned.pop(url, None)
+        if worker is None:
+            return False
+        worker.kill()
+        return True
+
+    def shutdown(self):
+        with self.lock:
+            workers = self.idle + list(self.assigned.values())
+            self.idle = []
+            self.assigned = {}
+        for worker in workers:
+            worker.kill()
+
+
+# address -> pool, the pools created so far
+app_worker_pools = {}
+
+
+@st.cache_resource
+def get_app_worker_pool(address):
+    pool_size = int(os.getenv('COMFYFLOW_APP_POOL_SIZE', '2'))
+    logger.info(f"get_app_worker_pool, address: {address}, size: {pool_size}")
+    pool = AppWorkerPool(address, pool_size)
+    app_worker_pools[address] = pool
+    # the workers warm up in the background, the page loading meanwhile is not held up
+    threading.Thread(target=pool.fill, daemon=True).start()
+    return pool
+
+
+def start_app_worker_pool():
+    """
+    create the pool on the first page load of the server, so its workers are warm by the
+    time the first app is started; apps are served on the server's own address
+    """
+    from streamlit import config
+    address = config.get_option('server.address') or "localhost"
+    return get_app_worker_pool(address)
+
+
 def start_app(app_name, app_id, url):
     # url, parse server and port
     address = url.split("//")[1].split(":")[0]
@@ -87,24 +246,39 @@ def start_app(app_name, app_id, url):
     command = f"streamlit run comfyflow_app.py --server.port {port} --server.address {address} -- --app {app_id}"
     if is_process_running(app_name, ["run", "comfyflow_app.py", str(port), address]):
         logger.info(f"App {app_name} is already running, url: {url}")
-        return AppStatus.RUNNING.value
-    else:
-        logger.info(f"start comfyflow app {app_name}")
-        app_path = make_app_home(app_name)
-        if app_path is None:
-            logger.error(f"App {app_name} dir generated failed, path: {app_path}")
-            return "failed"
-        app_thread = CommandThread(app_path, command)
-        add_script_run_ctx(app_thread)
-        app_thread.start()
-        logger.info(f"App {app_name} started, url: {url}")
-        return AppStatus.STARTED.value
+        return AppStatus.RUNNING.value, url
+
+    pool = get_app_worker_pool(address)
+    worker = pool.find(app_id)
+    if worker is not None:
+        logger.info(f"App {app_name} is already running, url: {worker.url}")
+        return AppStatus.RUNNING.value, worker.url
+
+    worker = pool.take(app_id)
+    if worker is not None:
+        logger.info(f"App {app_name} started on prewarmed worker, url: {worker.url}")
+        return AppStatus.STARTED.value, worker.url
+
+    logger.info(f"start comfyflow app {app_name}")
+    app_path = make_app_home(app_name)
+    if app_path is None:
+        logger.error(f"App {app_name} dir generated failed, path: {app_path}")
+        return "failed", url
+    app_thread = CommandThread(app_path, command)
+    add_script_run_ctx(app_thread)
+    app_thread.start()
+    logger.info(f"App {app_name} started, url: {url}")
+    return AppStatus.STARTED.value, url
     
 def stop_app(app_name, url):
     # url, parse server and port
     address = url.split("//")[1].split(":")[0]
     port = url.split("//")[1].split(":")[1]
-    if is_process_running(app_name, ["run", "comfyflow_app.py", str(port), address]):
+    pool = app_worker_pools.get(address)
+    if pool is not None and pool.release(url):
+        logger.info(f"stop comfyflow app {app_name} on worker {url}")
+        return AppStatus.STOPPING.value
+    elif is_process_running(app_name, ["run", "comfyflow_app.py", str(port), address]):
         logger.info(f"stop comfyflow app {app_name}")
         kill_all_process(app_name, ["run", "comfyflow_app.py", str(port), address])
         remove_app_home(app_name)
@@ -112,4 +286,3 @@ def stop_app(app_name, url):
     else:
         logger.info(f"App {app_name} is not running, url: {url}")
         return AppStatus.STOPPED.value
-
@@ -0,0 +1,30 @@
+"""
+Prewarmed comfyflow app worker.
+
+Launched by the app worker pool in manager/app_manager.py, it imports the heavy
+app dependencies up front and then serves comfyflow_app.py with streamlit, so
+that an app assigned to this worker later starts without a cold boot.
+"""
+import sys
+
+# preload app dependencies, the streamlit script runner reuses them from sys.modules.
+# the app modules import PIL, websocket and the page helpers at first use, so those are
+# imported here explicitly
+import modules.comfyflow  # noqa: F401
+import modules.comfyclient  # noqa: F401
+import modules.scheduler  # noqa: F401
+import modules.gallery  # noqa: F401
+import modules.job_model  # noqa: F401
+import modules.workspace_model  # noqa: F401
+import websocket  # noqa: F401
+import streamlit_extras.badges  # noqa: F401
+import streamlit_extras.row  # noqa: F401
+from PIL import Image
+from streamlit.web import cli as stcli
+
+# register the image plugins up front, PIL loads them on the first open otherwise
+Image.init()
+
+if __name__ == '__main__':
+    sys.argv = ["streamlit", "run", "comfyflow_app.py"] + sys.argv[1:]
+    sys.exit(stcli.main())
@@ -1,9 +1,10 @@
+import os
 import streamlit as st
 import argparse
 from loguru import logger
 from streamlit_extras.badges import badge
 
-from modules import get_workspace_model, get_comfy_client
+from modules import get_workspace_model, get_comfy_client, track_session
 
 def page_header():    
     st.set_page_config(page_title="ComfyFlowApp: Load a comfyui workflow as webapp in seconds.", 
@@ -48,16 +49,24 @@ def page_header():
         badge(type="github", name="xingren23/ComfyFlowApp", url="https://github.com/xingren23/ComfyFlowApp")
         badge(type="twitter", name="xingren23", url="https://twitter.com/xingren23")
 
+WORKER_APP_FILE = ".worker_app"
+
 parser = argparse.ArgumentParser(description='Comfyflow manager')
 parser.add_argument('--app', type=str, default='', help='comfyflow app id')
 args = parser.parse_args()
 
 page_header()
+# the metrics server starts with the first run of the app process
+track_session()
 
 with st.container():
     apps = get_workspace_model().get_all_apps()
     app_id_map = { str(app.id): app for app in apps} 
     app_id = args.app
+    if app_id == '' and os.path.exists(WORKER_APP_FILE):
+        # prewarmed pool worker, the app id is assigned at start time
+        with open(WORKER_APP_FILE) as f:
+            app_id = f.read().strip()
     logger.info(f"load app app_id {app_id}")
 
     if app_id not in app_id_map:
@@ -1,8 +1,12 @@
 import os
+import time
 from loguru import logger
 import streamlit as st
 from enum import Enum
 
+# seconds a disconnected session stays tracked for the active sessions gauge
+SESSION_FORGET_AFTER = 600
+
 # enum app status
 class AppStatus(Enum):
     CREATED = "Created"
@@ -32,14 +36,126 @@ def get_myapp_model():
     myapp_model = MyAppModel()
     return myapp_model 
 
+def get_comfyui_server_addrs():
+    # COMFYUI_SERVER_ADDR may list several comfyui backends, separated by comma
+    server_addr = os.getenv('COMFYUI_SERVER_ADDR') or ''
+    return [addr.strip() for addr in server_addr.split(',') if addr.strip()]
+
+@st.cache_resource
+def get_job_model():
+    logger.debug("get_job_model")
+    from modules.job_model import JobModel
+    retention_days = float(os.getenv('COMFYFLOW_JOB_RETENTION_DAYS', '7'))
+    job_model = JobModel(retention_days)
+    return job_model
+
+@st.cache_resource
+def get_result_gallery():
+    logger.debug("get_result_gallery")
+    from modules.gallery import ResultGallery
+    gallery_dir = os.getenv('COMFYFLOW_GALLERY_DIR', '.gallery')
+    max_bytes = int(os.getenv('COMFYFLOW_GALLERY_MAX_MB', '1024')) * 1024 * 1024
+    result_gallery = ResultGallery(gallery_dir, max_bytes)
+    return result_gallery
+
+@st.cache_resource
+def get_artifact_collector():
+    logger.debug("get_artifact_collector")
+    from modules.artifacts import ArtifactCollector
+    # comfyui input and output folders, in the order of COMFYUI_SERVER_ADDR, only for backends on this host
+    input_dirs = [path.strip() for path in os.getenv('COMFYUI_INPUT_DIR', '').split(',')]
+    output_dirs = [path.strip() for path in os.getenv('COMFYUI_OUTPUT_DIR', '').split(',')]
+    ttl = float(os.getenv('COMFYFLOW_ARTIFACT_TTL_HOURS', '24')) * 3600
+    artifact_collector = ArtifactCollector(len(get_comfyui_server_addrs()), input_dirs, output_dirs, ttl)
+    return artifact_collector
+
 @st.cache_resource
 def get_comfy_client():
     logger.debug("get_comfy_client")
     from modules.comfyclient import ComfyClient
-    server_addr = os.getenv('COMFYUI_SERVER_ADDR')
+    server_addr = next(iter(get_comfyui_server_addrs()), None)
     comfy_client = ComfyClient(server_addr=server_addr)
     return comfy_client
 
+@st.cache_resource
+def get_comfy_clients():
+    logger.debug("get_comfy_clients")
+    from modules.comfyclient import ComfyClient
+    comfy_clients = [get_comfy_client()]
+    for server_addr in get_comfyui_server_addrs()[1:]:
+        comfy_clients.append(ComfyClient(server_addr=server_addr))
+    return comfy_clients
+
+@st.cache_resource
+def get_job_scheduler():
+    logger.debug("get_job_scheduler")
+    from modules.scheduler import JobScheduler
+    max_inflight = int(os.getenv('COMFYFLOW_BACKEND_INFLIGHT', '2'))
+    user_quota = int(os.getenv('COMFYFLOW_USER_QUOTA', '64'))
+    model_window = int(os.getenv('COMFYFLOW_MODEL_WINDOW', '8'))
+    job_scheduler = JobScheduler(get_comfy_clients(), max_inflight=max_inflight, user_quota=user_quota, model_window=model_window, job_model=get_job_model(), gallery=get_result_gallery(), artifacts=get_artifact_collector())
+    from modules import metrics
+    metrics.BACKEND_JOBS.set_function(job_scheduler.backend_jobs)
+    return job_scheduler
+
+@st.cache_resource
+def get_model_warmer():
+    # optional, None unless COMFYFLOW_WARMUP is set
+    logger.debug("get_model_warmer")
+    if os.getenv('COMFYFLOW_WARMUP', '0') != '1':
+        return None
+    from modules.warmup import ModelWarmer
+    interval = int(os.getenv('COMFYFLOW_WARMUP_INTERVAL', '600'))
+    model_warmer = ModelWarmer(get_job_scheduler(), interval=interval)
+    return model_warmer
+
+@st.cache_resource
+def get_metrics_server():
+    # optional, None unless COMFYFLOW_METRICS_PORT is set
+    logger.debug("get_metrics_server")
+    port = int(os.getenv('COMFYFLOW_METRICS_PORT', '0'))
+    if port <= 0:
+        return None
+    from modules import metrics
+    sessions = get_tracked_sessions()
+    metrics.ACTIVE_SESSIONS.set_function(lambda: {(): count_active_sessions(sessions)})
+    metrics_server = metrics.start_metrics_server(os.getenv('COMFYFLOW_METRICS_ADDR', '127.0.0.1'), port)
+    return metrics_server
+
+@st.cache_resource
+def get_tracked_sessions():
+    # session_id -> time it was first seen disconnected, None while connected
+    return {}
+
+def track_session():
+    """
+    called on every script run of the pages and apps: the metrics server starts with the
+    first run of the process, and the session is counted for the active sessions gauge
+    """
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        get_tracked_sessions()[ctx.session_id] = None
+    get_metrics_server()
+
+def count_active_sessions(sessions):
+    from streamlit.runtime import Runtime
+    if not Runtime.exists():
+        return 0
+    runtime = Runtime.instance()
+    now = time.time()
+    active = 0
+    for session_id, inactive_since in list(sessions.items()):
+        if runtime.is_active_session(session_id):
+            sessions[session_id] = None
+            active += 1
+        elif inactive_since is None:
+            sessions[session_id] = now
+        elif now - inactive_since > SESSION_FORGET_AFTER:
+            # longer than streamlit keeps a disconnected session, a reconnect runs the script again
+            sessions.pop(session_id, None)
+    return active
+
 def check_comfyui_alive():
     try:
         get_comfy_client().queue_remaining()
@@ -55,6 +171,13 @@ def get_comfyui_object_info():
     comfy_object_info = comfy_client.get_node_class()
     return comfy_object_info
 
+@st.cache_data(ttl=60)
+def get_backend_object_info(server_addr):
+    # backends may have different nodes and models installed
+    logger.debug(f"get_backend_object_info, {server_addr}")
+    comfy_client = next(client for client in get_comfy_clients() if client.server_addr == server_addr)
+    return comfy_client.get_node_class()
+
 
 def get_comfyflow_token():
     import extra_streamlit_components as stx
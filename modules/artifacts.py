@@ -0,0 +1,152 @@
+"""
+Garbage collection of the files ComfyFlowApp leaves on comfyui backends.
+
+Uploads are stored under content-hash names, so identical inputs share one file and
+a user file name never overwrites another user's input. Each backend keeps a refcount
+per upload, held by the dispatched jobs that read it; an upload unreferenced for ttl
+seconds is deleted. Output files of finished jobs are deleted ttl seconds after the
+job finished, by then they are kept in the result gallery.
+
+The main server and every app process share the comfyui folders but keep their own
+bookkeeping, so a process deletes only the uploads it sent itself, and only once the
+file has not been used for ttl seconds by any process: each use touches the file.
+Output names are unique per prompt, a process only tracks the outputs of its own jobs.
+
+ComfyUI has no api to delete files, so files are only deleted on backends whose input
+and output folders are configured, i.e. comfyui runs on the same host. History entries
+are deleted through the api right after the outputs are collected.
+"""
+
+import os
+import time
+import hashlib
+import threading
+from loguru import logger
+
+# hex digits of the sha256 in upload names
+UPLOAD_HASH_LENGTH = 32
+
+
+def upload_name(filename, data):
+    # content-hash name keeping the extension, comfyui picks loaders by it
+    ext = os.path.splitext(filename)[1].lower()
+    return f"{hashlib.sha256(data).hexdigest()[:UPLOAD_HASH_LENGTH]}{ext}"
+
+
+def folder_path(root, subfolder, filename):
+    # a path inside root, None for names escaping it
+    if root is None:
+        return None
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, subfolder or '', filename))
+    return path if path.startswith(root + os.sep) else None
+
+
+class ArtifactCollector:
+    def __init__(self, backends, input_dirs=None, output_dirs=None, ttl=24 * 3600) -> None:
+        # folders per backend, None where comfyui runs on another host
+        self.input_dirs = ([path or None for path in input_dirs or []] + [None] * backends)[:backends]
+        self.output_dirs = ([path or None for path in output_dirs or []] + [None] * backends)[:backends]
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # per backend, (subfolder, name) -> [refcount, last released at, known to be on the backend]
+        self.uploads = [{} for _ in range(backends)]
+        # per backend, (subfolder, name) of the uploads this process sent and has not deleted,
+        # only where the input folder is known
+        self.created = [set() for _ in range(backends)]
+        # per backend, [(expire at, subfolder, filename)] in expiry order
+        self.outputs = [[] for _ in range(backends)]
+        logger.info(f"Artifact collector, input dirs {input_dirs}, output dirs {output_dirs}, ttl {ttl}s")
+
+    def is_uploaded(self, backend, subfolder, name):
+        with self.lock:
+            upload = self.uploads[backend].get((subfolder, name))
+            if upload is None or not upload[2]:
+                return False
+        # another process may have deleted it
+        path = folder_path(self.input_dirs[backend], subfolder, name)
+        return path is None or os.path.isfile(path)
+
+    def acquire(self, backend, subfolder, name, created=False):
+        # created, the upload was just sent by this process
+        path = folder_path(self.input_dirs[backend], subfolder, name)
+        with self.lock:
+            upload = self.uploads[backend].setdefault((subfolder, name), [0, time.time(), True])
+            upload[0] += 1
+            upload[2] = True
+            if created and path is not None:
+                self.created[backend].add((subfolder, name))
+        if path is not None:
+            try:
+                # the other processes keep the file while it is in use
+                os.utime(path)
+            except OSError:
+                pass
+
+    def release(self, backend, subfolder, name):
+        with self.lock:
+            upload = self.uploads[backend].get((subfolder, name))
+            if upload is not None:
+                upload[0] = max(upload[0] - 1, 0)
+                upload[1] = time.time()
+
+    def reset(self, backend):
+        # the backend restarted or its input folder was wiped, uploads must be sent again,
+        # the refcounts and the files to delete are kept
+        with self.lock:
+            for upload in self.uploads[backend].values():
+                upload[2] = False
+
+    def track_outputs(self, backend, outputs):
+        # output files of a finished prompt, temp previews are cleared by comfyui itself
+        expire_at = time.time() + self.ttl
+        files = [(expire_at, item.get('subfolder', ''), item['filename'])
+                 for node_output in outputs.values() for items in node_output.values() if isinstance(items, list)
+                 for item in items if isinstance(item, dict) and item.get('type') == 'output' and 'filename' in item]
+        if self.output_dirs[backend] is None or len(files) == 0:
+            return
+        with self.lock:
+            self.outputs[backend].extend(files)
+
+    def collect(self):
+        now = time.time()
+        deleted = 0
+        for backend in range(len(self.uploads)):
+            with self.lock:
+                # the bookkeeping always expires
+                for key in [key for key, (refs, released_at, _) in self.uploads[backend].items()
+                            if refs == 0 and now - released_at > self.ttl]:
+                    self.uploads[backend].pop(key)
+                # uploads this process sent and no longer references, kept while another process uses them
+                expired_uploads = [key for key in self.created[backend] if key not in self.uploads[backend]]
+                expired_outputs = []
+                while len(self.outputs[backend]) > 0 and self.outputs[backend][0][0] <= now:
+                    expired_outputs.append(self.outputs[backend].pop(0)[1:])
+            for subfolder, filename in expired_uploads:
+                path = folder_path(self.input_dirs[backend], subfolder, filename)
+                try:
+                    if now - os.path.getmtime(path) <= self.ttl:
+                        continue
+                except OSError:
+                    pass
+                if self._remove(path):
+                    deleted += 1
+                with self.lock:
+                    self.created[backend].discard((subfolder, filename))
+            for subfolder, filename in expired_outputs:
+                path = folder_path(self.output_dirs[backend], subfolder, filename)
+                if path is not None and self._remove(path):
+                    deleted += 1
+        if deleted > 0:
+            logger.info(f"Collected {deleted} comfyui artifacts")
+        return deleted
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to delete artifact {path}, {e}")
+        return False
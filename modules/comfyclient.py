@@ -1,24 +1,62 @@
 import json
+import time
 import uuid
+import random
 import requests
-import websocket
-from PIL import Image
 import io
 import threading
 from loguru import logger
 import urllib.parse as urlparse
+from modules import metrics
+from modules.recorder import open_recorder
+
+
+# prompts whose events arrived before they were subscribed, kept until subscribe
+MAX_EARLY_PROMPTS = 64
+# websocket reconnect backoff in seconds, doubled after each failed attempt
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+# /queue and /history polling interval in seconds while the websocket is down,
+# backed off while no subscribed prompt changes
+POLL_MIN_INTERVAL = 0.5
+POLL_MAX_INTERVAL = 5
+WEBSOCKET_TIMEOUT = 10
+# seconds without a websocket message before the prompts are polled and the connection
+# pinged, a connection that stays silent for another timeout after the ping is half-open
+WEBSOCKET_IDLE_TIMEOUT = 30
+# prompts queued by an earlier process send their events to its client id, nobody gets
+# them, so they are polled every interval whatever the websocket traffic
+REATTACHED_POLL_INTERVAL = 2
 
 
 class ComfyClient:
     def __init__(self, server_addr) -> None:
         self.client_id = str(uuid.uuid4())
         self.server_addr = server_addr
+        self.lock = threading.Lock()
+        # prompt_id -> event queues, all prompts share one websocket listener
+        self.subscribers = {}
+        self.early_events = {}
+        self.running_prompt_id = None
+        # subscribed prompts whose websocket events go to another client id, see subscribe
+        self.polled_prompts = set()
+        self.ws_thread = None
+        # websocket reconnects so far, comfyui drops the connection when it restarts
+        self.reconnects = 0
+        # records websocket messages and http responses for replay, see modules/recorder.py
+        self.recorder = open_recorder(server_addr, self.client_id)
         logger.info(f"Comfy client id: {self.client_id}")
 
+    def _request(self, method, url, request=None, **kwargs):
+        resp = requests.request(method, url, **kwargs)
+        if self.recorder is not None:
+            self.recorder.record_response(method, url, resp, request=request if request is not None else kwargs.get('json'))
+        return resp
+
     def get_node_class(self):
         object_info_url = f"{self.server_addr}/object_info"
         logger.info(f"Got object info from {object_info_url}")
-        resp = requests.get(object_info_url)
+        resp = self._request("GET", object_info_url)
         if resp.status_code != 200:
             raise Exception(f"Failed to get object info from {object_info_url}")
         return resp.json()
@@ -32,7 +70,7 @@ class ComfyClient:
         """
         url = f"{self.server_addr}/prompt"
         logger.info(f"Got remaining from {url}")
-        resp = requests.get(url)
+        resp = self._request("GET", url)
         if resp.status_code != 200:
             raise Exception(f"Failed to get queue from {url}")
         return resp.json()['exec_info']['queue_remaining']
@@ -41,15 +79,15 @@ class ComfyClient:
         p = {"prompt": prompt, "client_id": self.client_id}
         data = json.dumps(p).encode('utf-8')
         logger.info(f"Sending prompt to server, {self.client_id}")
-        resp = requests.post(f"{self.server_addr}/prompt", data=data)
+        resp = self._request("POST", f"{self.server_addr}/prompt", request=p, data=data)
         if resp.status_code != 200:
-            raise Exception(f"Failed to send prompt to server, {resp.status_code}")
+            raise Exception(f"Failed to send prompt to server, {resp.status_code}, {resp.text}")
         return resp.json()
 
     def get_image(self, filename, subfolder, folder_type):
         url = f"{self.server_addr}/view?filename={filename}&subfolder={subfolder}&type={folder_type}"
         logger.info(f"Getting image from server, {url}")
-        resp = requests.get(url)
+        resp = self._request("GET", url)
         if resp.status_code != 200:
             raise Exception(f"Failed to get image from server, {resp.status_code}")
         return resp.content
@@ -62,110 +100,340 @@ class ComfyClient:
     def upload_image(self, imagefile, subfolder, type, overwrite):
         data = {"subfolder": subfolder, "type": type, "overwrite": overwrite}
         logger.info(f"Uploading image to server, {data}")
-        resp = requests.post(f"{self.server_addr}/upload/image", data=data, files=imagefile)
+        resp = self._request("POST", f"{self.server_addr}/upload/image", request=data, data=data, files=imagefile)
         if resp.status_code != 200:
             raise Exception(f"Failed to upload image to server, {resp.status_code}")
         return resp.json()
 
+    def get_queue(self):
+        """
+        return: {"queue_running": [[number, prompt_id, prompt, extra_data, outputs]], "queue_pending": [...]}
+        """
+        resp = self._request("GET", f"{self.server_addr}/queue")
+        if resp.status_code != 200:
+            raise Exception(f"Failed to get queue from server, {resp.status_code}")
+        return resp.json()
+
+    def delete_queued(self, prompt_ids):
+        # remove pending prompts from the comfyui queue, running prompts are not affected
+        logger.info(f"Deleting prompts from queue, {prompt_ids}")
+        resp = self._request("POST", f"{self.server_addr}/queue", json={"delete": prompt_ids})
+        if resp.status_code != 200:
+            raise Exception(f"Failed to delete prompts from queue, {resp.status_code}")
+
+    def interrupt(self):
+        # interrupt the running prompt, whoever queued it
+        logger.info(f"Interrupting running prompt, {self.server_addr}")
+        resp = self._request("POST", f"{self.server_addr}/interrupt")
+        if resp.status_code != 200:
+            raise Exception(f"Failed to interrupt prompt, {resp.status_code}")
+
+    def cancel_prompt(self, prompt_id):
+        """
+        delete the prompt from the queue, interrupt it only if it is the running one
+        """
+        self.delete_queued([prompt_id])
+        running_ids = [item[1] for item in self.get_queue()['queue_running']]
+        if prompt_id in running_ids:
+            self.interrupt()
+        self.unsubscribe(prompt_id)
+
+    def delete_history(self, prompt_ids):
+        logger.info(f"Deleting history from server, {prompt_ids}")
+        resp = self._request("POST", f"{self.server_addr}/history", json={"delete": prompt_ids})
+        if resp.status_code != 200:
+            raise Exception(f"Failed to delete history from server, {resp.status_code}")
+
     def get_history(self, prompt_id):
         logger.info(f"Getting history from server, {prompt_id}")
-        resp = requests.get(f"{self.server_addr}/history/{prompt_id}")
+        resp = self._request("GET", f"{self.server_addr}/history/{prompt_id}")
         if resp.status_code != 200:
             raise Exception(f"Failed to get history from server, {resp.status_code}")
         return resp.json()
     
     
     def gen_images(self, prompt, queue):
+        """
+        queue a prompt and subscribe the queue to its events, events of all prompts
+        share one websocket connection of this client
+        """
         logger.info(f"Generating images from comfyui, {prompt}")
-        thread = threading.Thread(target=self._websocket_loop, args=(prompt, queue))
-        thread.start()
+        self._ensure_event_loop()
 
         # queue prompt 
         prompt_id = self.queue_prompt(prompt)['prompt_id']  
         logger.info(f"Send prompt to comfyui, {prompt_id}")
+        self.subscribe(prompt_id, queue)
         
         return prompt_id
 
-    def _websocket_loop(self, prompt, queue):
+    def subscribe(self, prompt_id, queue, poll=False):
+        """
+        dispatch the events of a prompt to queue, poll for a prompt queued with another
+        client id, e.g. by the process before a restart, its end is then polled from /history
+        """
+        with self.lock:
+            # events that arrived before the prompt id was known
+            early_events = self.early_events.pop(prompt_id, [])
+            finished = any(event['type'] == 'executing' and event['data'] is None for event in early_events)
+            if not finished:
+                self.subscribers.setdefault(prompt_id, []).append(queue)
+                if poll:
+                    self.polled_prompts.add(prompt_id)
+        for event in early_events:
+            queue.put(event)
+
+    def unsubscribe(self, prompt_id, queue=None):
+        with self.lock:
+            queues = self.subscribers.get(prompt_id, [])
+            if queue in queues:
+                queues.remove(queue)
+            if queue is None or len(queues) == 0:
+                self.subscribers.pop(prompt_id, None)
+                self.polled_prompts.discard(prompt_id)
+
+    def _ensure_event_loop(self):
+        with self.lock:
+            if self.ws_thread is not None and self.ws_thread.is_alive():
+                return
+            # connect before queueing prompts, so no event is missed, without a websocket
+            # the event loop polls /queue and /history instead
+            ws = self._connect()
+            self.ws_thread = threading.Thread(target=self._event_loop, args=(ws,), daemon=True)
+            self.ws_thread.start()
+
+    def _connect(self):
+        import websocket
+
         urlresult = urlparse.urlparse(self.server_addr)
-        if urlresult.scheme == "http":
-            wc_connect = "ws://{}/ws?clientId={}".format(urlresult.netloc, self.client_id)
-        elif urlresult.scheme == "https":
-            wc_connect = "wss://{}/ws?clientId={}".format(urlresult.netloc, self.client_id)
+        scheme = "wss" if urlresult.scheme == "https" else "ws"
+        # the same client id routes the events of prompts queued before a reconnect to the new connection
+        wc_connect = f"{scheme}://{urlresult.netloc}/ws?clientId={self.client_id}"
         logger.info(f"Websocket connect url, {wc_connect}")
-        ws = websocket.WebSocket()
-        ws.connect(wc_connect)
-
-        def dispatch_event(queue, event):            
-            if queue is not None:
-                event_type = event['type']
-                if event_type == 'b_preview':
-                    logger.debug(f"Dispatch event, {event_type}")
+        try:
+            ws = websocket.WebSocket()
+            ws.connect(wc_connect, timeout=WEBSOCKET_TIMEOUT)
+            # a long render sends no message, see _websocket_loop for the idle timeout
+            ws.settimeout(REATTACHED_POLL_INTERVAL)
+            return ws
+        except Exception as e:
+            logger.warning(f"Failed to connect websocket {wc_connect}, {e}")
+            return None
+
+    def _event_loop(self, ws):
+        reconnect_delay = RECONNECT_MIN_DELAY
+        reconnect_at = time.monotonic() + reconnect_delay
+        poll_interval = POLL_MIN_INTERVAL
+        while True:
+            if ws is not None:
+                reconnect_delay = RECONNECT_MIN_DELAY
+                try:
+                    # catch up on prompts that finished while disconnected
+                    self._poll_prompts()
+                except Exception as e:
+                    logger.error(f"Error while polling prompts, {self.server_addr}, {e}")
+                self._websocket_loop(ws)
+                ws = None
+                reconnect_at = time.monotonic()
+
+            if time.monotonic() >= reconnect_at:
+                ws = self._connect()
+                if ws is not None:
+                    self.reconnects += 1
+                    metrics.WEBSOCKET_RECONNECTS.inc(backend=self.server_addr)
+                    continue
+                reconnect_at = time.monotonic() + reconnect_delay * random.uniform(0.8, 1.2)
+                reconnect_delay = min(reconnect_delay * 2, RECONNECT_MAX_DELAY)
+
+            try:
+                changed = self._poll_prompts()
+            except Exception as e:
+                logger.error(f"Error while polling prompts, {self.server_addr}, {e}")
+                changed = False
+            poll_interval = POLL_MIN_INTERVAL if changed else min(poll_interval * 2, POLL_MAX_INTERVAL)
+            time.sleep(min(poll_interval, max(reconnect_at - time.monotonic(), 0)))
+
+    def _poll_prompts(self, prompt_ids=None):
+        """
+        dispatch the end of subscribed prompts, or of the given ones, from /queue and
+        /history, used while the websocket is down. return whether any prompt started or finished
+        """
+        with self.lock:
+            prompt_ids = [prompt_id for prompt_id in (prompt_ids or self.subscribers) if prompt_id in self.subscribers]
+        if len(prompt_ids) == 0:
+            return False
+
+        queue = self.get_queue()
+        running_ids = [item[1] for item in queue['queue_running']]
+        queued_ids = set(running_ids) | set(item[1] for item in queue['queue_pending'])
+        changed = False
+        running_prompt_id = running_ids[0] if len(running_ids) > 0 else None
+        if running_prompt_id in prompt_ids and running_prompt_id != self.running_prompt_id:
+            self._dispatch_event({"type": "execution_start", "data": {"prompt_id": running_prompt_id}, "prompt_id": running_prompt_id}, running_prompt_id)
+            changed = True
+        self.running_prompt_id = running_prompt_id
+
+        for prompt_id in prompt_ids:
+            if prompt_id in queued_ids:
+                continue
+            history = self.get_history(prompt_id).get(prompt_id)
+            if history is None:
+                # neither queued nor in history, the server restarted or the history was cleared
+                error = {"prompt_id": prompt_id, "exception_message": "prompt lost by comfyui server"}
+            else:
+                status = history.get('status', {})
+                errors = [data for message_type, data in status.get('messages', []) if message_type == 'execution_error']
+                error = errors[0] if status.get('status_str') == 'error' and len(errors) > 0 else None
+            logger.info(f"Polled finished prompt, {prompt_id}, error {error is not None}")
+            if error is not None:
+                self._dispatch_event({"type": "execution_error", "data": error, "prompt_id": prompt_id}, prompt_id)
+            self._dispatch_event({"type": "executing", "data": None, "prompt_id": prompt_id}, prompt_id)
+            self.unsubscribe(prompt_id)
+            changed = True
+        return changed
+
+    def _dispatch_event(self, event, prompt_id=None):
+        event_type = event['type']
+        if event_type == 'b_preview':
+            logger.debug(f"Dispatch event, {event_type}, {prompt_id}")
+        else:
+            logger.debug(f"Dispatch event, {event}")
+
+        with self.lock:
+            if prompt_id is None:
+                # status is broadcast to all subscribers
+                queues = [queue for queues in self.subscribers.values() for queue in queues]
+            elif prompt_id in self.subscribers:
+                queues = list(self.subscribers[prompt_id])
+            else:
+                queues = []
+                if len(self.early_events) > MAX_EARLY_PROMPTS:
+                    self.early_events.pop(next(iter(self.early_events)))
+                self.early_events.setdefault(prompt_id, []).append(event)
+        for queue in queues:
+            queue.put(event)
+
+    def _handle_message(self, out):
+        if self.recorder is not None:
+            self.recorder.record_message(out)
+        if isinstance(out, str):
+            msg = json.loads(out)
+            msg_type = msg['type']
+            data = msg.get('data', {})
+            logger.debug(f"Got message from websocket server, {msg_type}, {msg}")
+            # older comfyui doesn't send prompt_id with progress, it belongs to the running prompt
+            prompt_id = data.get('prompt_id', self.running_prompt_id) if isinstance(data, dict) else self.running_prompt_id
+            if msg_type == "status":
+                if "sid" in data:
+                    self.client_id = data["sid"]
+                status_data = data["status"]
+                # Dispatch status event with status_data
+                self._dispatch_event({"type": "status", "data": status_data})
+            elif msg_type == "progress":
+                # Dispatch progress event with msg["data"]
+                self._dispatch_event({"type": "progress", "data": data, "prompt_id": prompt_id}, prompt_id)
+            elif msg_type == "executing":
+                # Dispatch executing event with msg["data"]["node"]
+                self._dispatch_event({"type": "executing", "data": data["node"], "prompt_id": prompt_id}, prompt_id)
+                if data["node"] is None:
+                    logger.info(f"workflow finished, {prompt_id}")
+                    self.running_prompt_id = None
+                    self.unsubscribe(prompt_id)
                 else:
-                    logger.debug(f"Dispatch event, {event}")
-                queue.put(event)
+                    self.running_prompt_id = prompt_id
+            elif msg_type == "executed":
+                # Dispatch executed event with msg["data"]
+                self._dispatch_event({"type": "executed", "data": data, "prompt_id": prompt_id}, prompt_id)
+            elif msg_type == "execution_start":
+                # Dispatch execution_start event with msg["data"]
+                self.running_prompt_id = prompt_id
+                self._dispatch_event({"type": "execution_start", "data": data, "prompt_id": prompt_id}, prompt_id)
+            elif msg_type == "execution_error":
+                # Dispatch execution_error event with msg["data"]
+                self._dispatch_event({"type": "execution_error", "data": data, "prompt_id": prompt_id}, prompt_id)
+            elif msg_type == "execution_cached":
+                # Dispatch execution_cached event with msg["data"]
+                self._dispatch_event({"type": "execution_cached", "data": data, "prompt_id": prompt_id}, prompt_id)
             else:
-                logger.info("queue is none")
+                logger.warning(f"Unknown message type {msg_type}")
+            
+        elif isinstance(out, bytes):
+            from PIL import Image
 
+            view = memoryview(out)
+            event_type = int.from_bytes(view[:4], 'big')
+            buffer = view[4:]
+            if event_type == 1:
+                view2 = memoryview(buffer)
+                image_type = int.from_bytes(view2[:4], 'big')
+                image_mime = ""
+                if image_type == 1:
+                    image_mime = "image/jpeg"
+                elif image_type == 2:
+                    image_mime = "image/png"
+                
+                image_blob = buffer[4:]
+                logger.debug(f"Got binary websocket message of type {event_type}, {image_mime}, {len(image_blob)}")
+                # Dispatch b_preview event with image_blob, previews belong to the running prompt
+                prompt_id = self.running_prompt_id
+                if prompt_id is not None:
+                    image = Image.open(io.BytesIO(image_blob))
+                    self._dispatch_event({"type": "b_preview", "data": image, "prompt_id": prompt_id}, prompt_id)
+            else:
+                logger.warning(f"Unknown binary websocket message of type {event_type}")      
+
+    def _websocket_loop(self, ws):
+        # return when the connection drops or stops answering pings, the event loop reconnects
+        import websocket
+
+        message_at = time.monotonic()
+        polled_at = time.monotonic()
+        pinged_at = None
         while True:
-            out = ws.recv()
+            if len(self.polled_prompts) > 0 and time.monotonic() - polled_at >= REATTACHED_POLL_INTERVAL:
+                polled_at = time.monotonic()
+                try:
+                    self._poll_prompts(list(self.polled_prompts))
+                except Exception as e:
+                    logger.error(f"Error while polling prompts, {self.server_addr}, {e}")
             try:
-                if isinstance(out, str):
-                    msg = json.loads(out)
-                    msg_type = msg['type']
-                    logger.debug(f"Got message from websocket server, {msg_type}, {msg}")
-                    if msg_type == "status":
-                        if "sid" in msg.get("data"):
-                            self.client_id = msg["data"]["sid"]
-                            # Set window.name to self.client_id
-                        status_data = msg["data"]["status"]
-                        # Dispatch status event with status_data
-                        dispatch_event(queue, {"type": "status", "data": status_data})
-                    elif msg_type == "progress":
-                        # Dispatch progress event with msg["data"]
-                        dispatch_event(queue, {"type": "progress", "data": msg["data"]})
-                    elif msg_type == "executing":
-                        # Dispatch executing event with msg["data"]["node"]
-                        dispatch_event(queue, {"type": "executing", "data": msg["data"]["node"]})
-                        if msg["data"]["node"] is None:
-                            logger.info("workflow finished, exiting websocket loop")
-                            break
-                    elif msg_type == "executed":
-                        # Dispatch executed event with msg["data"]
-                        dispatch_event(queue, {"type": "executed", "data": msg["data"]})
-                    elif msg_type == "execution_start":
-                        # Dispatch execution_start event with msg["data"]
-                        dispatch_event(queue, {"type": "execution_start", "data": msg["data"]})
-                    elif msg_type == "execution_error":
-                        # Dispatch execution_error event with msg["data"]
-                        dispatch_event(queue, {"type": "execution_error", "data": msg["data"]})
-                    elif msg_type == "execution_cached":
-                        # Dispatch execution_cached event with msg["data"]
-                        dispatch_event(queue, {"type": "execution_cached", "data": msg["data"]})
-                    else:
-                        logger.warning(f"Unknown message type {msg_type}")
-                    
-                elif isinstance(out, bytes):
-                    view = memoryview(out)
-                    event_type = int.from_bytes(view[:4], 'big')
-                    buffer = view[4:]
-                    if event_type == 1:
-                        view2 = memoryview(buffer)
-                        image_type = int.from_bytes(view2[:4], 'big')
-                        image_mime = ""
-                        if image_type == 1:
-                            image_mime = "image/jpeg"
-                        elif image_type == 2:
-                            image_mime = "image/png"
-                        
-                        image_blob = buffer[4:]
-                        logger.debug(f"Got binary websocket message of type {event_type}, {image_mime}, {len(image_blob)}")
-                        # Dispatch b_preview event with image_blob
-                        image = Image.open(io.BytesIO(image_blob))
-                        dispatch_event(queue, {"type": "b_preview", "data": image})
-                    else:
-                        logger.warning(f"Unknown binary websocket message of type {event_type}")      
-
+                opcode, data = ws.recv_data(control_frame=True)
+            except websocket.WebSocketTimeoutException:
+                if pinged_at is not None:
+                    if time.monotonic() - pinged_at >= WEBSOCKET_IDLE_TIMEOUT:
+                        logger.error(f"Websocket half-open, no answer to ping, {self.server_addr}")
+                        ws.close()
+                        return
+                    continue
+                if time.monotonic() - message_at < WEBSOCKET_IDLE_TIMEOUT:
+                    continue
+                try:
+                    # prompts that finished while a proxy dropped the messages
+                    self._poll_prompts()
+                except Exception as e:
+                    logger.error(f"Error while polling prompts, {self.server_addr}, {e}")
+                try:
+                    ws.ping()
+                except Exception as e:
+                    logger.error(f"Websocket disconnected, {self.server_addr}, {e}")
+                    ws.close()
+                    return
+                pinged_at = time.monotonic()
+                continue
+            except Exception as e:
+                logger.error(f"Websocket disconnected, {self.server_addr}, {e}")
+                ws.close()
+                return
+            message_at = time.monotonic()
+            pinged_at = None
+            if opcode == websocket.ABNF.OPCODE_CLOSE:
+                logger.error(f"Websocket closed by server, {self.server_addr}")
+                ws.close()
+                return
+            if opcode not in (websocket.ABNF.OPCODE_TEXT, websocket.ABNF.OPCODE_BINARY):
+                continue
+            out = data.decode('utf-8') if opcode == websocket.ABNF.OPCODE_TEXT else data
+            try:
+                self._handle_message(out)
             except Exception as e:
                 logger.error(f"Error while processing websocket message, {e}")
-                raise e
@@ -7,13 +7,60 @@ from typing import Any
 import random
 import json
 import copy
-from PIL import Image
+import mimetypes
+import time
 from loguru import logger
 import queue
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import streamlit as st
-from streamlit_extras.row import row
-from modules.page import custom_text_area
+from modules.page import custom_text_area, row
+from modules.prompt_graph import get_required_nodes, draft_prompt, SEED_PARAMS
+from modules import get_job_scheduler, get_result_gallery, get_comfy_clients, get_backend_object_info, get_model_warmer
+from modules import metrics
+from modules.prompt_validator import validate_prompt
+from modules.profiler import summarize
+from modules import tracing
+from modules.scheduler import Job, JobPriority, JobStatus, QuotaExceededError
+
+# 并发获取输出图片的线程数
+OUTPUT_FETCH_WORKERS = 8
+# 一次批量生成的组合上限，以及画廊列数
+MAX_BATCH_VARIANTS = 64
+GALLERY_COLUMNS = 3
+# 历史结果显示数量
+GALLERY_HISTORY_SIZE = 12
+# 节点耗时统计的最近运行次数，以及显示的最慢节点数
+PROFILE_RUNS = 50
+PROFILE_NODES = 10
+# 提交前校验错误的显示条数
+MAX_VALIDATION_ERRORS = 10
+# 等待进度事件的超时秒数，超时后刷新队列显示，以便及时响应页面重新运行
+PROGRESS_POLL_TIMEOUT = 1
+
+
+def parse_sweep_numbers(text, is_int):
+    """
+    解析参数扫描的数值，支持 "5, 7.5, 10" 和 "20:40:5"（包含终点）
+    """
+    values = []
+    for item in (text or "").split(","):
+        item = item.strip()
+        if item == "":
+            continue
+        if ":" in item:
+            start, stop, step = [float(x) for x in item.split(":")]
+            if step <= 0:
+                raise ValueError(f"步长必须大于0, {item}")
+            count = int(round((stop - start) / step)) + 1
+            values.extend(start + step * i for i in range(count))
+        else:
+            values.append(float(item))
+    if is_int:
+        return [int(value) for value in values]
+    return [round(value, 6) for value in values]
+
 
 class Comfyflow:
     """
@@ -31,139 +78,439 @@ class Comfyflow:
         self.comfy_client = comfy_client
         self.api_json = json.loads(api_data)
         self.app_json = json.loads(app_data)
+        # 只提交对应用输出有贡献的节点，分析结果按应用缓存
+        self.prompt_nodes = get_required_nodes(api_data, tuple(self.app_json['outputs'].keys()))
+        # 会话中本应用最近一次生成的任务ID，任务由后台调度器执行，页面按ID订阅
+        self.jobs_key = f"{self.app_json['name']}_jobs"
+        # 草稿任务ID -> 对应的完整工作流，用于按选中的种子完整渲染
+        self.drafts_key = f"{self.app_json['name']}_drafts"
+        # 工作流中有可降低成本的节点时才提供草稿模式
+        pruned_prompt = {node_id: node for node_id, node in self.api_json.items() if node_id in self.prompt_nodes}
+        self.draft_available = draft_prompt(pruned_prompt, tuple(self.app_json['outputs'].keys())) != pruned_prompt
+        # 应用首次运行时预热模型，减少首个请求加载模型的等待
+        model_warmer = get_model_warmer()
+        if model_warmer is not None:
+            model_warmer.register(self.app_json['name'], self.api_json, tuple(self.app_json['outputs'].keys()))
 
-    def generate(self):
+    def get_input_values(self):
         """
-        生成并执行工作流
-        处理工作流配置，更新参数，并发送到ComfyUI服务器执行
-        """
-        # 复制原始工作流配置
-        prompt = copy.deepcopy(self.api_json)
-        if prompt is not None:
-            # 为未设置的seed和noise_seed生成随机值
-            for node_id in prompt:
-                node = prompt[node_id]
-                node_inputs = node['inputs']
-                for param_name in node_inputs:
-                    param_value = node_inputs[param_name]
-                    if isinstance(param_value, int):
-                        if (param_name == "seed" or param_name == "noise_seed"):
-                            random_value = random.randint(0, 0x7fffffffffffffff)
-                            prompt[node_id]['inputs'][param_name] = random_value
-                            logger.info(f"更新随机参数: {node_id} {param_name} {param_value} -> {random_value}")
-
-            # 根据应用配置更新工作流参数
-            for node_id in self.app_json['inputs']:
-                node = self.app_json['inputs'][node_id]
-                node_inputs = node['inputs']
-                for param_item in node_inputs:
-                    logger.info(f"更新参数 {param_item}, {node_inputs[param_item]}")
-                    param_type = node_inputs[param_item]['type']
-                    
-                    # 处理文本类型参数
-                    if param_type == "TEXT":
-                        param_name = node_inputs[param_item]['name']
-                        param_key = f"{node_id}_{param_name}"
-                        param_value = st.session_state[param_key]
-                        logger.info(f"更新文本参数: {param_key} {param_name} {param_value}")
-                        prompt[node_id]["inputs"][param_item] = param_value
+        读取界面上的应用输入参数
+        Returns:
+            {(node_id, param_item): value}，上传文件取文件名；缺少上传文件时返回 None
+        """
+        input_values = {}
+        for node_id in self.app_json['inputs']:
+            node_inputs = self.app_json['inputs'][node_id]['inputs']
+            for param_item in node_inputs:
+                param_type = node_inputs[param_item]['type']
+                param_name = node_inputs[param_item]['name']
+                param_key = f"{node_id}_{param_name}"
 
-                    # 处理数值类型参数
-                    elif param_type == "NUMBER":
-                        param_name = node_inputs[param_item]['name']
-                        param_key = f"{node_id}_{param_name}"
-                        param_value = st.session_state[param_key]
-                        logger.info(f"更新数值参数: {param_key} {param_name} {param_value}")                        
-                        prompt[node_id]["inputs"][param_item] = param_value
+                # 处理文本、数值、选择和复选框类型参数
+                if param_type in ("TEXT", "NUMBER", "SELECT", "CHECKBOX"):
+                    param_value = st.session_state[param_key]
+                    logger.info(f"读取参数: {param_key} {param_type} {param_value}")
+                    input_values[(node_id, param_item)] = param_value
 
-                    # 处理选择类型参数
-                    elif param_type == "SELECT":
-                        param_name = node_inputs[param_item]['name']
-                        param_key = f"{node_id}_{param_name}"
+                # 处理图片和视频上传参数
+                elif param_type in ('UPLOADIMAGE', 'UPLOADVIDEO'):
+                    if param_key in st.session_state:
                         param_value = st.session_state[param_key]
-                        logger.info(f"更新选择参数: {param_key} {param_name} {param_value}")
-                        prompt[node_id]["inputs"][param_item] = param_value
+                        logger.info(f"读取上传参数: {param_key} {param_type} {param_value}")
+                        if param_value is not None:
+                            input_values[(node_id, param_item)] = param_value.name
+                        elif param_type == 'UPLOADIMAGE':
+                            st.error(f"请为参数 {param_name} 选择输入图片")
+                            return None
+                        else:
+                            st.error(f"请为参数 {param_name} 选择输入视频")
+                            return None
+        return input_values
 
-                    # 处理复选框类型参数
-                    elif param_type == "CHECKBOX":
-                        param_name = node_inputs[param_item]['name']
-                        param_key = f"{node_id}_{param_name}"
-                        param_value = st.session_state[param_key]
-                        logger.info(f"更新复选框参数: {param_key} {param_name} {param_value}")
-                        prompt[node_id]["inputs"][param_item] = param_value
-
-                    # 处理图片上传参数
-                    elif param_type == 'UPLOADIMAGE':
-                        param_name = node_inputs[param_item]['name']
-                        param_key = f"{node_id}_{param_name}"
-                        if param_key in st.session_state:
-                            param_value = st.session_state[param_key]
-                            
-                            logger.info(f"更新上传图片参数: {param_key} {param_name} {param_value}")
-                            if param_value is not None:
-                                prompt[node_id]["inputs"][param_item] = param_value.name
-                            else:
-                                st.error(f"请为参数 {param_name} 选择输入图片")
-                                return
-
-                    # 处理视频上传参数
-                    elif param_type == 'UPLOADVIDEO':
-                        param_name = node_inputs[param_item]['name']
-                        param_key = f"{node_id}_{param_name}"
-                        if param_key in st.session_state:
-                            param_value = st.session_state[param_key]
-                            
-                            logger.info(f"更新上传视频参数: {param_key} {param_name} {param_value}")
-                            if param_value is not None:
-                                prompt[node_id]["inputs"][param_item] = param_value.name
-                            else:
-                                st.error(f"请为参数 {param_name} 选择输入视频")
-                                return
-                            
-            logger.info(f"发送工作流到服务器: {prompt}")
-            queue = st.session_state.get('progress_queue', None)
+    def get_uploads(self):
+        """
+        读取界面上的上传文件，任务分配到ComfyUI服务器时再上传
+        Returns:
+            [(文件名, 文件内容, 子目录)]
+        """
+        uploads = []
+        for node_id in self.app_json['inputs']:
+            node_inputs = self.app_json['inputs'][node_id]['inputs']
+            for param_item in node_inputs:
+                param_node = node_inputs[param_item]
+                if param_node['type'] in ('UPLOADIMAGE', 'UPLOADVIDEO'):
+                    uploaded_file = st.session_state.get(f"{node_id}_{param_node['name']}")
+                    if uploaded_file is not None:
+                        uploads.append((uploaded_file.name, uploaded_file.getvalue(), param_node.get('subfolder', '')))
+        return uploads
+
+    def get_session_id(self):
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        return ctx.session_id if ctx is not None else None
+
+    def get_session_user(self):
+        # 登录用户按用户名公平调度，未登录时每个会话单独计算
+        # 非登录模式下 Home.py 给所有会话设置默认用户名 local，同样按会话计算
+        username = st.session_state.get('username')
+        if username and username != 'local':
+            return username
+        return self.get_session_id() or 'local'
+
+    def cancel_jobs(self):
+        """
+        取消本会话上一次生成中未完成的任务，新的生成取代旧的生成
+        """
+        job_scheduler = get_job_scheduler()
+        for job_id in st.session_state.get(self.jobs_key, []):
+            job = job_scheduler.get_job(job_id)
+            if job is not None:
+                job_scheduler.cancel(job, "superseded")
+
+    def bind_prompt(self, input_values, seed_offset=0):
+        """
+        根据输入参数生成待提交的工作流
+        Args:
+            input_values: {(node_id, param_item): value}
+            seed_offset: 批量生成时应用输入中的随机种子偏移量
+        """
+        # 复制输出节点依赖的工作流配置，裁剪掉无关分支
+        prompt = {node_id: copy.deepcopy(node) for node_id, node in self.api_json.items() if node_id in self.prompt_nodes}
+
+        # 为未设置的seed和noise_seed生成随机值
+        for node_id in prompt:
+            node_inputs = prompt[node_id]['inputs']
+            for param_name in node_inputs:
+                param_value = node_inputs[param_name]
+                if isinstance(param_value, int) and param_name in SEED_PARAMS:
+                    random_value = random.randint(0, 0x7fffffffffffffff)
+                    node_inputs[param_name] = random_value
+                    logger.debug(f"更新随机参数: {node_id} {param_name} {param_value} -> {random_value}")
+
+        # 根据应用配置更新工作流参数
+        for (node_id, param_item), param_value in input_values.items():
+            if node_id not in prompt:
+                logger.warning(f"输入节点不影响输出，已裁剪: {node_id}")
+                continue
+            if param_item in SEED_PARAMS and seed_offset > 0:
+                param_value = (param_value + seed_offset) % 0x7fffffffffffffff
+            logger.debug(f"更新参数: {node_id} {param_item} {param_value}")
+            prompt[node_id]["inputs"][param_item] = param_value
+        return prompt
+
+    def validate_prompts(self, prompts, uploads):
+        """
+        提交前按ComfyUI节点信息校验绑定后的工作流，节点是否安装、选项是否可选、数值是否越界
+        每台ComfyUI服务器分别校验，任务只调度到校验通过的服务器
+        Returns:
+            (错误列表, 可用服务器序号)，有服务器校验通过时错误列表为空，全部通过时可用服务器为None，
+            节点信息获取失败的服务器不校验，由ComfyUI校验
+        """
+        upload_names = [name for name, _, _ in uploads] + [f"{subfolder}/{name}" for name, _, subfolder in uploads if subfolder]
+        clients = get_comfy_clients()
+        errors = []
+        allowed_backends = []
+        for backend, client in enumerate(clients):
             try:
-                prompt_id = self.comfy_client.gen_images(prompt, queue)
-                st.session_state['preview_prompt_id'] = prompt_id
-                logger.info(f"生成工作流ID: {prompt_id}")
+                object_info = get_backend_object_info(client.server_addr)
             except Exception as e:
-                st.session_state['preview_prompt_id'] = None
-                logger.warning(f"生成工作流异常: {e}")
+                logger.warning(f"获取节点信息失败，跳过提交前校验: {client.server_addr}, {e}")
+                allowed_backends.append(backend)
+                continue
+            backend_errors = []
+            for prompt in prompts:
+                for error in validate_prompt(prompt, object_info, upload_names):
+                    # 多台服务器时标明出错的服务器
+                    error = f"{client.server_addr} {error}" if len(clients) > 1 else error
+                    if error not in backend_errors:
+                        backend_errors.append(error)
+            if len(backend_errors) == 0:
+                allowed_backends.append(backend)
+            else:
+                logger.info(f"工作流在服务器上校验失败，不调度到该服务器: {client.server_addr}, {backend_errors}")
+                errors.extend(backend_errors)
+        if len(allowed_backends) == 0:
+            return errors, []
+        return [], None if len(allowed_backends) == len(clients) else allowed_backends
+
+    def show_validation_errors(self, errors):
+        # 校验失败时不提交，最多显示 MAX_VALIDATION_ERRORS 条错误
+        logger.warning(f"工作流校验失败: {errors}")
+        error_lines = "\n".join(f"- {error}" for error in errors[:MAX_VALIDATION_ERRORS])
+        more = f"\n\n另有 {len(errors) - MAX_VALIDATION_ERRORS} 个错误" if len(errors) > MAX_VALIDATION_ERRORS else ""
+        st.error(f"工作流参数校验失败，未提交：\n{error_lines}{more}")
 
-    def get_outputs(self):
+    def get_reuse_inputs(self, prompt):
+        """
+        从绑定后的工作流读取应用输入的实际取值，含批量生成偏移后的种子，用于历史结果复用参数
+        Returns:
+            {控件key: 取值}，上传文件不复用
+        """
+        reuse_inputs = {}
+        for node_id in self.app_json['inputs']:
+            node_inputs = self.app_json['inputs'][node_id]['inputs']
+            for param_item in node_inputs:
+                param_node = node_inputs[param_item]
+                if param_node['type'] in ("TEXT", "NUMBER", "SELECT", "CHECKBOX") and node_id in prompt:
+                    reuse_inputs[f"{node_id}_{param_node['name']}"] = prompt[node_id]['inputs'].get(param_item)
+        return reuse_inputs
+
+    def get_variants(self, input_values):
+        """
+        根据批量数量和参数扫描生成所有输入组合
+        Returns:
+            [(label, input_values, seed_offset)]
+        """
+        batch_count = int(st.session_state.get('batch_count', 1))
+        sweep_params = st.session_state.get('sweep_params', [])
+        sweep_inputs = self.get_sweep_inputs()
+
+        sweep_axes = []
+        for option in sweep_params:
+            node_id, param_item = option.split(":", 1)
+            param_node = sweep_inputs[option]
+            sweep_value = st.session_state.get(f"sweep_{option}")
+            if param_node['type'] == 'NUMBER':
+                values = parse_sweep_numbers(sweep_value, isinstance(param_node['default'], int))
+            else:
+                values = list(sweep_value or [])
+            if len(values) > 0:
+                sweep_axes.append([(node_id, param_item, param_node['name'], value) for value in values])
+
+        variants = []
+        for combo in itertools.product(*sweep_axes):
+            variant_values = dict(input_values)
+            for node_id, param_item, _, value in combo:
+                variant_values[(node_id, param_item)] = value
+            combo_label = ", ".join(f"{name}={value}" for _, _, name, value in combo)
+            for index in range(batch_count):
+                label = f"{combo_label} #{index + 1}" if combo_label else f"#{index + 1}"
+                variants.append((label, variant_values, index))
+        return variants
+
+    def get_sweep_inputs(self):
+        # 可扫描的参数：数值和选择类型
+        sweep_inputs = {}
+        for node_id in self.app_json['inputs']:
+            node_inputs = self.app_json['inputs'][node_id]['inputs']
+            for param_item in node_inputs:
+                if node_inputs[param_item]['type'] in ('NUMBER', 'SELECT'):
+                    sweep_inputs[f"{node_id}:{param_item}"] = node_inputs[param_item]
+        return sweep_inputs
+
+    def generate(self):
+        """
+        生成并执行工作流，每次点击生成一个追踪ID，贯穿提交、上传、执行和获取结果
+        """
+        trace_id = tracing.new_trace_id()
+        logger.info(f"开始生成: {self.app_json['name']}, trace {trace_id}")
+        with tracing.span("generate", trace_id, app=self.app_json['name']):
+            self.generate_jobs(trace_id)
+
+    def generate_jobs(self, trace_id):
+        """
+        一次绑定全部批量和扫描组合的参数，一起提交到任务调度器，由调度器按用户公平分配到ComfyUI服务器
+        """
+        self.cancel_jobs()
+        st.session_state[self.jobs_key] = []
+        st.session_state[self.drafts_key] = {}
+        input_values = self.get_input_values()
+        if input_values is None:
+            return
+
+        try:
+            variants = self.get_variants(input_values)
+        except ValueError as e:
+            st.error(f"参数扫描取值错误: {e}")
+            return
+        if len(variants) > MAX_BATCH_VARIANTS:
+            st.error(f"批量生成数量 {len(variants)} 超过上限 {MAX_BATCH_VARIANTS}")
+            return
+
+        # 单次生成为交互任务，优先于批量任务
+        priority = JobPriority.INTERACTIVE if len(variants) == 1 else JobPriority.BATCH
+        user = self.get_session_user()
+        session_id = self.get_session_id()
+        uploads = self.get_uploads()
+        prompts = [(label, self.bind_prompt(values, seed_offset)) for label, values, seed_offset in variants]
+        # 草稿模式提交降低步数和尺寸的工作流，保留完整工作流供完整渲染
+        is_draft = self.draft_available and st.session_state.get('draft_mode', False)
+        output_node_ids = tuple(self.app_json['outputs'].keys())
+        submit_prompts = [draft_prompt(prompt, output_node_ids) if is_draft else prompt for _, prompt in prompts]
+        with tracing.span("validate", trace_id, prompts=len(submit_prompts)):
+            errors, allowed_backends = self.validate_prompts(submit_prompts, uploads)
+        if len(errors) > 0:
+            self.show_validation_errors(errors)
+            return
+
+        jobs = []
+        drafts = {}
+        for (label, full_prompt), prompt in zip(prompts, submit_prompts):
+            logger.info(f"提交工作流任务: {label}, trace {trace_id}, {prompt}")
+            job = Job(user, prompt, priority=priority, uploads=uploads, label=f"草稿 {label}" if is_draft else label,
+                      session_id=session_id, app=self.app_json['name'], inputs=self.get_reuse_inputs(full_prompt), trace_id=trace_id,
+                      allowed_backends=allowed_backends)
+            jobs.append(job)
+            if is_draft:
+                drafts[job.job_id] = {'label': label, 'prompt': full_prompt}
+        if self.submit_jobs(jobs):
+            st.session_state[self.drafts_key] = drafts
+
+    def submit_jobs(self, jobs):
+        """
+        提交任务到调度器，记录为本会话当前的生成
+        """
+        try:
+            get_job_scheduler().submit(jobs)
+        except QuotaExceededError as e:
+            logger.warning(f"提交任务超过配额: {e}")
+            st.error("排队中的任务过多，请等待已提交的任务完成")
+            return False
+        st.session_state[self.jobs_key] = [job.job_id for job in jobs]
+        return True
+
+    def render_full(self, job_id):
+        """
+        以草稿的种子和参数完整渲染选中的草稿
+        """
+        draft = st.session_state.get(self.drafts_key, {}).get(job_id)
+        if draft is None:
+            return
+        trace_id = tracing.new_trace_id()
+        uploads = self.get_uploads()
+        # 草稿校验的是降低步数和尺寸后的工作流，完整工作流提交前同样校验，校验失败时保留草稿
+        with tracing.span("validate", trace_id, prompts=1):
+            errors, allowed_backends = self.validate_prompts([draft['prompt']], uploads)
+        if len(errors) > 0:
+            self.show_validation_errors(errors)
+            return
+        self.cancel_jobs()
+        st.session_state[self.jobs_key] = []
+        st.session_state[self.drafts_key] = {}
+        logger.info(f"完整渲染草稿: {job_id}, {draft['label']}, trace {trace_id}")
+        job = Job(self.get_session_user(), draft['prompt'], priority=JobPriority.INTERACTIVE, uploads=uploads,
+                  label=draft['label'], session_id=self.get_session_id(), app=self.app_json['name'],
+                  inputs=self.get_reuse_inputs(draft['prompt']), trace_id=trace_id, allowed_backends=allowed_backends)
+        self.submit_jobs([job])
+
+    def get_outputs(self, job, node_ids=None):
         """
         获取工作流输出结果
-        根据工作流ID获取输出结果
-        """
-        # 获取工作流ID
-        prompt_id = st.session_state['preview_prompt_id']
-        if prompt_id is None:
-            return None
-        history = self.comfy_client.get_history(prompt_id)[prompt_id]
-        for node_id in self.app_json['outputs']:
-            node_output = history['outputs'][node_id]
-            logger.info(f"获取输出结果: {node_id}, {node_output}")
-            if 'images' in node_output:
-                images_output = []
-                for image in node_output['images']:
-                    # image_url = self.comfy_client.get_image_url(image['filename'], image['subfolder'], image['type'])
-                    # images_output.append(image_url)
-                    image_data = self.comfy_client.get_image(image['filename'], image['subfolder'], image['type'])
-                    images_output.append(image_data)
-                    
-                logger.info(f"获取图片输出结果: {node_id}, {len(images_output)}")
-                return 'images', images_output
-            elif 'gifs' in node_output:
-                gifs_output = []
-                format = 'gifs'
-                for gif in node_output['gifs']:
-                    if gif['format'] == 'image/gif' or gif['format'] == 'image/webp':
-                        format = 'images'
-                    gif_url = self.comfy_client.get_image_url(gif['filename'], gif['subfolder'], gif['type'])
-                    gifs_output.append(gif_url)
-
-                logger.info(f"获取GIF输出结果: {node_id}, {len(gifs_output)}")
-                return format, gifs_output
+        调度器在任务完成时已从历史记录中取出全部输出节点，已保存到历史结果的图片直接从本地读取
+        Args:
+            job: 已完成的工作流任务
+            node_ids: 需要获取的输出节点，默认为全部输出节点
+        Returns:
+            生成器，每个节点结果就绪后立即返回 (node_id, type, outputs)
+        """
+        if node_ids is None:
+            node_ids = list(self.app_json['outputs'].keys())
+        gallery = get_result_gallery()
+        entry = gallery.get_entry(job.job_id)
+        metrics.cache_hit('gallery', entry is not None)
+        saved_outputs = []
+        node_outputs = {}
+        for node_id in node_ids:
+            if entry is not None and node_id in entry['images']:
+                saved_images = zip(gallery.preview_paths(entry, node_id), gallery.image_paths(entry, node_id), entry['images'][node_id])
+                saved_outputs.append((node_id, 'images', list(saved_images)))
+            elif node_id in job.outputs:
+                node_outputs[node_id] = job.outputs[node_id]
+            else:
+                logger.warning(f"输出节点无结果: {node_id}")
+        return itertools.chain(saved_outputs, self.fetch_outputs(node_outputs, job))
+
+    def fetch_outputs(self, node_outputs, job):
+        """
+        批量获取输出节点的结果，图片并发下载并生成预览，动图和视频返回地址
+        Args:
+            node_outputs: {node_id: ComfyUI 节点输出}
+            job: 输出所属的任务，从执行任务的ComfyUI服务器下载
+        Returns:
+            生成器，按完成顺序返回 (node_id, type, outputs)，图片为 [(预览, 原图, 文件名)]
+        """
+        client = job.client
+        with ThreadPoolExecutor(max_workers=OUTPUT_FETCH_WORKERS) as executor:
+            image_futures = {}
+            for node_id, node_output in node_outputs.items():
+                logger.info(f"获取输出结果: {node_id}, {node_output}")
+                if 'images' in node_output:
+                    image_futures[node_id] = [executor.submit(self.fetch_image, job, image) for image in node_output['images']]
+                elif 'gifs' in node_output:
+                    # VHS_VideoCombine, gif/webp 作为图片显示，视频通过地址播放
+                    gifs_output = []
+                    format = 'gifs'
+                    for gif in node_output['gifs']:
+                        if gif['format'] == 'image/gif' or gif['format'] == 'image/webp':
+                            format = 'images'
+                        gif_url = client.get_image_url(gif['filename'], gif['subfolder'], gif['type'])
+                        gifs_output.append(gif_url)
+                    if format == 'images':
+                        gifs_output = [(gif_url, None, None) for gif_url in gifs_output]
+
+                    logger.info(f"获取GIF输出结果: {node_id}, {len(gifs_output)}")
+                    yield node_id, format, gifs_output
+                else:
+                    logger.warning(f"不支持的输出结果: {node_id}, {list(node_output.keys())}")
+
+            future_nodes = {future: node_id for node_id, futures in image_futures.items() for future in futures}
+            remaining = {node_id: len(futures) for node_id, futures in image_futures.items()}
+            for node_id in [node_id for node_id, count in remaining.items() if count == 0]:
+                yield node_id, 'images', []
+            for future in as_completed(future_nodes):
+                node_id = future_nodes[future]
+                remaining[node_id] -= 1
+                if remaining[node_id] == 0:
+                    images_output = [future.result() for future in image_futures[node_id]]
+                    logger.info(f"获取图片输出结果: {node_id}, {len(images_output)}")
+                    yield node_id, 'images', images_output
+
+    def fetch_image(self, job, image):
+        """
+        下载输出图片并在服务端生成压缩预览，页面只传输预览，原图在下载时传输
+        同一任务的图片只下载一次，历史结果保存时复用
+        """
+        preview, original = job.fetch_image(image)
+        return preview, original, image['filename']
+
+    def render_output(self, placeholder, node_id, output_type, outputs):
+        """
+        在输出节点对应的位置显示结果
+        """
+        caption = self.app_json['outputs'].get(node_id, {}).get('name')
+        if output_type == 'images':
+            with placeholder.container():
+                st.image([preview for preview, _, _ in outputs], use_column_width=True, caption=caption)
+                for index, (_, original, filename) in enumerate(outputs):
+                    if original is None:
+                        continue
+                    if isinstance(original, str):
+                        with open(original, 'rb') as f:
+                            original = f.read()
+                    st.download_button(f"下载原图 {filename}", data=original, file_name=filename,
+                                       mime=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+                                       key=f"download_{node_id}_{index}_{filename}", use_container_width=True)
+        elif output_type == 'gifs':
+            iframes = [f'<iframe src="{output}" width="100%" height="360px"></iframe>' for output in outputs]
+            placeholder.markdown("".join(iframes), unsafe_allow_html=True)
+
+    def render_variant(self, placeholder, label, results):
+        """
+        在画廊中显示一个组合的全部输出
+        """
+        images = []
+        iframes = []
+        for node_id, output_type, outputs in results:
+            if output_type == 'images':
+                images.extend(preview for preview, _, _ in outputs)
+            elif output_type == 'gifs':
+                iframes.extend(f'<iframe src="{output}" width="100%" height="240px"></iframe>' for output in outputs)
+        with placeholder.container():
+            if len(images) > 0:
+                st.image(images, use_column_width=True, caption=[label] * len(images))
+            if len(iframes) > 0:
+                st.markdown("".join(iframes), unsafe_allow_html=True)
+                st.caption(label)
 
     def create_ui_input(self, node_id, node_inputs):
         """
@@ -225,35 +572,104 @@ class Comfyflow:
             elif param_type == 'UPLOADIMAGE':
                 param_name = param_node['name']
                 param_help = param_node['help']
-                param_subfolder = param_node.get('subfolder', '')
                 param_key = f"{node_id}_{param_name}"
                 uploaded_file = st.file_uploader(param_name, help=param_help, key=param_key, type=['png', 'jpg', 'jpeg'], accept_multiple_files=False)
                 if uploaded_file is not None:
-                    logger.info(f"上传图片: {uploaded_file}")
-                    # 上传到服务器
-                    upload_type = "input"
-                    imagefile = {'image': (uploaded_file.name, uploaded_file)}  # 替换为要上传的文件名和路径
-                    self.comfy_client.upload_image(imagefile, param_subfolder, upload_type, 'true')
-
+                    # 任务分配到服务器时再上传，见 get_uploads
                     # 显示图片预览
+                    from PIL import Image
                     image = Image.open(uploaded_file)
                     st.image(image, use_column_width=True, caption='输入图片')
             elif param_type == 'UPLOADVIDEO':
                 param_name = param_node['name']
                 param_help = param_node['help']
-                param_subfolder = param_node.get('subfolder', '')
                 param_key = f"{node_id}_{param_name}"
                 uploaded_file = st.file_uploader(param_name, help=param_help, key=param_key, type=['mp4', "h264"], accept_multiple_files=False)
                 if uploaded_file is not None:
-                    logger.info(f"上传视频: {uploaded_file}")
-                    # 上传到服务器
-                    upload_type = "input"
-                    imagefile = {'image': (uploaded_file.name, uploaded_file)}  # 替换为要上传的文件名和路径
-                    self.comfy_client.upload_image(imagefile, param_subfolder, upload_type, 'true')
-
+                    # 任务分配到服务器时再上传，见 get_uploads
                     # 显示视频预览
                     st.video(uploaded_file, format="video/mp4", start_time=0)
 
+    def create_ui_batch(self):
+        """
+        创建批量生成控件
+        每组参数生成多个随机种子，并可对数值和选择参数做组合扫描
+        """
+        st.number_input("每组参数生成数量", min_value=1, max_value=MAX_BATCH_VARIANTS, value=1, step=1, key='batch_count',
+                        help="每组参数使用不同的随机种子生成")
+        sweep_inputs = self.get_sweep_inputs()
+        sweep_params = st.multiselect("参数扫描", options=list(sweep_inputs.keys()), key='sweep_params',
+                                      format_func=lambda option: sweep_inputs[option]['name'],
+                                      help="对选中参数的多个取值做组合生成")
+        for option in sweep_params:
+            param_node = sweep_inputs[option]
+            if param_node['type'] == 'NUMBER':
+                st.text_input(f"{param_node['name']} 取值", key=f"sweep_{option}", placeholder="如 5, 7.5, 10 或 20:40:5")
+            else:
+                st.multiselect(f"{param_node['name']} 取值", options=param_node['options'], key=f"sweep_{option}")
+
+    def show_history(self, job_id):
+        # 在输出区域重新显示历史结果，无需重新生成；未完成的生成在后台继续，结果进入历史
+        st.session_state[self.jobs_key] = [job_id]
+
+    def reuse_inputs(self, inputs):
+        for param_key, param_value in inputs.items():
+            if param_value is not None:
+                st.session_state[param_key] = param_value
+        logger.info(f"复用历史参数: {inputs}")
+
+    def create_ui_gallery(self):
+        """
+        创建历史结果控件
+        显示本应用最近的生成结果缩略图，可重新查看结果或复用当时的输入参数
+        """
+        gallery = get_result_gallery()
+        entries = gallery.list_entries(self.app_json['name'], limit=GALLERY_HISTORY_SIZE)
+        if len(entries) == 0:
+            st.caption("暂无历史结果")
+            return
+        history_cols = st.columns(GALLERY_COLUMNS)
+        for index, entry in enumerate(entries):
+            with history_cols[index % GALLERY_COLUMNS]:
+                created_at = time.strftime('%m-%d %H:%M', time.localtime(entry['created_at']))
+                seeds = ", ".join(str(seed) for seed in entry['seeds'].values())
+                st.image(gallery.thumbnail_paths(entry)[:1], use_column_width=True, caption=f"{created_at} {entry['label'] or ''}")
+                if seeds:
+                    st.caption(f"seed: {seeds}")
+                st.button("查看", key=f"history_show_{entry['job_id']}", use_container_width=True,
+                          on_click=self.show_history, args=(entry['job_id'],))
+                st.button("复用参数", key=f"history_reuse_{entry['job_id']}", use_container_width=True,
+                          on_click=self.reuse_inputs, args=(entry['inputs'],))
+
+    def create_ui_profile(self):
+        """
+        创建节点耗时报告
+        统计本应用最近运行中各节点的平均耗时、耗时占比和缓存命中率，最慢的节点在前
+        """
+        job_model = get_job_scheduler().job_model
+        if job_model is None:
+            st.caption("未启用任务记录")
+            return
+        try:
+            rows = job_model.get_node_timings(self.app_json['name'], PROFILE_RUNS)
+        except Exception as e:
+            logger.warning(f"读取节点耗时失败: {e}")
+            rows = []
+        if len(rows) == 0:
+            st.caption("暂无节点耗时数据，生成后显示")
+            return
+        report = summarize(rows)
+        runs = sum(row.runs for row in rows)
+        cached_runs = sum(row.cached_runs for row in rows)
+        st.caption(f"最近 {PROFILE_RUNS} 次运行，节点缓存命中率 {cached_runs / runs:.0%}")
+        st.dataframe([{
+            "节点": item['node'],
+            "平均耗时(秒)": item['avg_seconds'],
+            "最长耗时(秒)": item['max_seconds'],
+            "耗时占比": f"{item['time_share']:.0%}",
+            "缓存命中率": f"{item['cache_hit_rate']:.0%}",
+        } for item in report[:PROFILE_NODES]], use_container_width=True, hide_index=True)
+
     def create_ui(self, show_header=True):      
         logger.info("创建UI")  
 
@@ -277,62 +693,150 @@ class Comfyflow:
                     node_inputs = node['inputs']
                     self.create_ui_input(node_id, node_inputs)
 
+                with st.expander("批量生成"):
+                    self.create_ui_batch()
+
+                if self.draft_available:
+                    st.checkbox("草稿模式", key='draft_mode', help="减少采样步数、缩小尺寸并跳过放大节点，快速预览构图，满意后按相同种子完整渲染")
+
                 gen_button = st.button(label='生成', use_container_width=True, on_click=self.generate)
 
+                with st.expander("历史结果"):
+                    self.create_ui_gallery()
+
+                with st.expander("节点耗时"):
+                    self.create_ui_profile()
+
 
         with output_col:
             # st.subheader('输出')
             with st.container():
-                node_size = len(self.api_json)
-                executed_nodes = []
+                node_size = len(self.prompt_nodes)
+                # 本地调度器排队的任务与ComfyUI队列一起显示
+                job_scheduler = get_job_scheduler()
                 queue_remaining = self.comfy_client.queue_remaining()
-                output_queue_remaining = st.text(f"队列: {queue_remaining}")
+                output_queue_remaining = st.text(f"队列: {queue_remaining + job_scheduler.pending_count()}")
                 progress_placeholder = st.empty()
                 img_placeholder = st.empty()
-                if gen_button:
-                    if st.session_state['preview_prompt_id'] is None:
-                        st.warning("生成失败，请检查ComfyFlowApp和ComfyUI控制台日志。")
-                        st.stop()
-
-                    # 更新进度
-                    output_progress = progress_placeholder.progress(value=0.0, text="生成图片")
-                    while True:
-                        try:
-                            progress_queue = st.session_state.get('progress_queue')
-                            event = progress_queue.get()
-                            logger.debug(f"事件: {event}")
-
-                            event_type = event['type']
-                            if event_type == 'status':
-                                remaining = event['data']['exec_info']['queue_remaining']
-                                output_queue_remaining.text(f"队列: {remaining}")
-                            elif event_type == 'execution_cached':
-                                executed_nodes.extend(event['data']['nodes'])
-                                output_progress.progress(len(executed_nodes)/node_size, text="生成图片...")
-                            elif event_type == 'executing':
-                                node = event['data']
-                                if node is None:
-                                    type, outputs = self.get_outputs()
-                                    if type == 'images' and outputs is not None:
-                                        img_placeholder.image(outputs, use_column_width=True)
-                                    elif type == 'gifs' and outputs is not None:
-                                        for output in outputs:
-                                            img_placeholder.markdown(f'<iframe src="{output}" width="100%" height="360px"></iframe>', unsafe_allow_html=True)
-
-                                    output_progress.progress(1.0, text="生成完成")
-                                    logger.info("生成完成")
-                                    st.session_state[f'{app_name}_previewed'] = True
-                                    break
-                                else:
-                                    executed_nodes.append(node)
-                                    output_progress.progress(len(executed_nodes)/node_size, text="生成图片...")
-                            elif event_type == 'b_preview':
-                                preview_image = event['data']
-                                img_placeholder.image(preview_image, use_column_width=True, caption="预览")
-                        except Exception as e:
-                            logger.warning(f"获取进度异常: {e}")
-                            # st.warning(f"获取进度异常 {e}")
+                # 每个输出节点一个显示位置，第一个输出复用预览位置
+                output_placeholders = {}
+                for node_id in self.app_json['outputs']:
+                    output_placeholders[node_id] = img_placeholder if len(output_placeholders) == 0 else st.empty()
+                first_output_node = next(iter(output_placeholders), None)
+                rendered_nodes = set()
+                job_ids = st.session_state.get(self.jobs_key, [])
+                if gen_button and len(job_ids) == 0:
+                    st.warning("生成失败，请检查ComfyFlowApp和ComfyUI控制台日志。")
+                    st.stop()
+                preview_jobs = [job for job in map(job_scheduler.get_job, job_ids) if job is not None]
+                if len(preview_jobs) > 0:
+                    # 批量结果以画廊显示，每个组合一个位置
+                    jobs = {job.job_id: job for job in preview_jobs}
+                    is_batch = len(preview_jobs) > 1
+                    variant_placeholders = {}
+                    if is_batch:
+                        gallery_cols = st.columns(GALLERY_COLUMNS)
+                        for index, job in enumerate(preview_jobs):
+                            variant_placeholders[job.job_id] = gallery_cols[index % GALLERY_COLUMNS].empty()
+
+                    def show_result(job):
+                        result_placeholder = variant_placeholders[job.job_id] if is_batch else img_placeholder
+                        if job.status == JobStatus.CANCELLED:
+                            result_placeholder.warning(f"已取消 {job.label}")
+                        elif job.error:
+                            result_placeholder.error(f"生成失败 {job.label}: {job.error}")
+                        elif is_batch:
+                            self.render_variant(result_placeholder, job.label, self.get_outputs(job))
+                        else:
+                            # 批量获取尚未显示的输出节点，如命中缓存的节点
+                            pending_nodes = [node_id for node_id in output_placeholders if node_id not in rendered_nodes]
+                            for node_id, type, outputs in self.get_outputs(job, pending_nodes):
+                                self.render_output(output_placeholders[node_id], node_id, type, outputs)
+                                rendered_nodes.add(node_id)
+
+                    # 订阅未完成的任务，页面重新运行后从任务当前状态继续显示
+                    progress_queue = st.session_state.get('progress_queue')
+                    executed_nodes = {}
+                    finished_jobs = set()
+                    for job in preview_jobs:
+                        executed_nodes[job.job_id] = set(job.executed)
+                        if not job_scheduler.subscribe(job, progress_queue):
+                            finished_jobs.add(job.job_id)
+                            show_result(job)
+
+                    def update_progress():
+                        executed_size = sum(min(len(nodes), node_size) for nodes in executed_nodes.values())
+                        output_progress.progress(executed_size / (node_size * len(jobs)),
+                                                 text=f"生成图片... {len(finished_jobs)}/{len(jobs)}")
+
+                    output_progress = progress_placeholder.progress(value=0.0, text="排队中")
+                    update_progress()
+                    try:
+                        while len(finished_jobs) < len(jobs):
+                            try:
+                                try:
+                                    event = progress_queue.get(timeout=PROGRESS_POLL_TIMEOUT)
+                                except queue.Empty:
+                                    # 输出到页面时检查是否需要重新运行，避免一直阻塞在已被取代的生成上
+                                    output_queue_remaining.text(f"队列: {queue_remaining + job_scheduler.pending_count()}")
+                                    continue
+                                logger.debug(f"事件: {event}")
+
+                                event_type = event['type']
+                                job_id = event.get('job_id')
+                                if job_id not in jobs or job_id in finished_jobs:
+                                    # 之前生成遗留的事件
+                                    continue
+                                job = jobs[job_id]
+
+                                if event_type == 'status':
+                                    queue_remaining = event['data']['exec_info']['queue_remaining']
+                                    output_queue_remaining.text(f"队列: {queue_remaining + job_scheduler.pending_count()}")
+                                elif event_type == 'execution_cached':
+                                    executed_nodes[job_id].update(event['data']['nodes'])
+                                    update_progress()
+                                elif event_type == 'executed':
+                                    # 输出节点执行完成后立即显示，无需等待整个工作流
+                                    node = event['data']['node']
+                                    if not is_batch and node in output_placeholders and node not in rendered_nodes:
+                                        for node_id, type, outputs in self.fetch_outputs({node: event['data']['output']}, job):
+                                            self.render_output(output_placeholders[node_id], node_id, type, outputs)
+                                            rendered_nodes.add(node_id)
+                                elif event_type == 'executing':
+                                    node = event['data']
+                                    if node is not None:
+                                        executed_nodes[job_id].add(node)
+                                        update_progress()
+                                elif event_type in ('job_finished', 'job_cancelled'):
+                                    # 调度器已取回输出或任务被取消
+                                    finished_jobs.add(job_id)
+                                    executed_nodes[job_id] = set(self.prompt_nodes)
+                                    show_result(job)
+                                    update_progress()
+                                elif event_type == 'b_preview':
+                                    preview_image = event['data']
+                                    if is_batch:
+                                        variant_placeholders[job_id].image(preview_image, use_column_width=True, caption=f"预览 {job.label}")
+                                    elif first_output_node not in rendered_nodes:
+                                        # 预览与第一个输出共用位置，输出显示后不再覆盖
+                                        img_placeholder.image(preview_image, use_column_width=True, caption="预览")
+                            except Exception as e:
+                                logger.warning(f"获取进度异常: {e}")
+                                # st.warning(f"获取进度异常 {e}")
+                    finally:
+                        for job in preview_jobs:
+                            job_scheduler.unsubscribe(job, progress_queue)
+
+                    output_progress.progress(1.0, text="生成完成")
+                    logger.info("生成完成")
+                    drafts = st.session_state.get(self.drafts_key, {})
+                    for job in preview_jobs:
+                        if job.job_id in drafts and job.status == JobStatus.FINISHED:
+                            st.button(f"完整渲染 {drafts[job.job_id]['label']}", key=f"full_render_{job.job_id}", use_container_width=True,
+                                      on_click=self.render_full, args=(job.job_id,))
+                    st.session_state[f'{app_name}_previewed'] = True
                 else:
+                    from PIL import Image
                     output_image = Image.open('./public/images/output-none.png')
                     logger.info("默认输出")
-                    img_placeholder.image(output_image, use_column_width=True, caption='无输出图片，请生成')
\ No newline at end of file
+                    img_placeholder.image(output_image, use_column_width=True, caption='无输出图片，请生成')
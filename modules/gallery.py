@@ -0,0 +1,229 @@
+"""
+Per-app result gallery kept on local disk.
+
+Each finished job is one entry directory <root>/<app hash>/<job_id>/ holding the output
+images, their display previews and thumbnails, and meta.json with the label, the input values to reuse and
+the seeds of the bound prompt. Followers of a deduplicated job keep only meta.json and
+read the files of their leader's entry. Entries are evicted least recently viewed first,
+together with the entries sharing their files, once the gallery grows beyond max_bytes.
+"""
+
+import io
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from loguru import logger
+from modules.prompt_graph import prompt_seeds
+from modules.image_preview import preview_ext
+
+META_FILE = 'meta.json'
+THUMBNAIL_SIZE = (256, 256)
+# seconds between writes of an entry's accessed_at to its meta.json
+ACCESS_WRITE_INTERVAL = 60
+
+
+def app_dir_name(app):
+    return hashlib.sha1(app.encode('utf-8')).hexdigest()[:16]
+
+
+class ResultGallery:
+    def __init__(self, root, max_bytes) -> None:
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # job_id -> entry meta, with 'path' and 'size' of the entry directory and 'files_path'
+        # of the directory holding its images, the leader's entry directory for followers
+        self.entries = {}
+        self._load()
+        logger.info(f"Result gallery {self.root}, entries {len(self.entries)}, size {self.total_bytes()}, max {max_bytes}")
+
+    def _load(self):
+        if not os.path.isdir(self.root):
+            return
+        for app_dir in os.scandir(self.root):
+            if not app_dir.is_dir():
+                continue
+            for entry_dir in os.scandir(app_dir.path):
+                meta_path = os.path.join(entry_dir.path, META_FILE)
+                try:
+                    with open(meta_path, encoding='utf-8') as f:
+                        meta = json.load(f)
+                except (OSError, ValueError):
+                    # an entry interrupted while saving
+                    logger.warning(f"Remove broken gallery entry {entry_dir.path}")
+                    shutil.rmtree(entry_dir.path, ignore_errors=True)
+                    continue
+                meta['path'] = entry_dir.path
+                meta['files_path'] = os.path.join(app_dir.path, meta.get('files', meta['job_id']))
+                meta['size'] = sum(f.stat().st_size for f in os.scandir(entry_dir.path) if f.is_file() and f.name != META_FILE)
+                meta['written_accessed_at'] = meta['accessed_at']
+                self.entries[meta['job_id']] = meta
+        for entry in list(self.entries.values()):
+            if not os.path.isfile(os.path.join(entry['files_path'], META_FILE)):
+                # a follower whose leader entry was broken
+                logger.warning(f"Remove gallery entry without files {entry['path']}")
+                shutil.rmtree(entry['path'], ignore_errors=True)
+                self.entries.pop(entry['job_id'])
+
+    def total_bytes(self):
+        with self.lock:
+            return sum(entry['size'] for entry in self.entries.values())
+
+    def save(self, jobs):
+        """
+        save an entry for a finished job with the images and previews fetched through the job,
+        its followers' entries refer to its files, jobs without an app are not kept
+        """
+        jobs = [job for job in jobs if job.app is not None]
+        if len(jobs) == 0:
+            return
+        files = {}
+        previews = {}
+        for node_id, node_output in jobs[0].outputs.items():
+            for index, image in enumerate(node_output.get('images', [])):
+                # the images and previews the page already fetched, downloaded here otherwise
+                preview, data = jobs[0].fetch_image(image)
+                ext = os.path.splitext(image['filename'])[1] or '.png'
+                name = f"{node_id}_{index}{ext}"
+                files.setdefault(node_id, []).append((name, data))
+                previews.setdefault(node_id, []).append(self._preview(name, data, preview))
+        if len(files) == 0:
+            return
+
+        thumbnails = {}
+        for node_id, node_files in files.items():
+            thumbnails[node_id] = [(f"thumb_{name.rsplit('.', 1)[0]}.webp", self._thumbnail(data)) for name, data in node_files]
+        self._write_entry(jobs[0], files, previews, thumbnails)
+        for job in jobs[1:]:
+            self._write_entry(job, files, previews, thumbnails, leader=jobs[0])
+        self._evict()
+
+    def _preview(self, name, data, preview):
+        if preview is data:
+            # animations and small images are shown as they are, the entry keeps one file
+            return name, data
+        return f"preview_{name.rsplit('.', 1)[0]}{preview_ext()}", preview
+
+    def _thumbnail(self, data):
+        from PIL import Image
+
+        image = Image.open(io.BytesIO(data))
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        image.thumbnail(THUMBNAIL_SIZE)
+        buffer = io.BytesIO()
+        image.save(buffer, format='WEBP', quality=80)
+        return buffer.getvalue()
+
+    def _write_entry(self, job, files, previews, thumbnails, leader=None):
+        # the files are written only for the leader, None for a job run by itself
+        path = os.path.join(self.root, app_dir_name(job.app), job.job_id)
+        files_path = os.path.join(self.root, app_dir_name(job.app), leader.job_id) if leader is not None else path
+        os.makedirs(path, exist_ok=True)
+        size = 0
+        images = {}
+        preview_names = {}
+        thumbs = []
+        for node_id, node_files in files.items():
+            images[node_id] = []
+            preview_names[node_id] = []
+            for (name, data), (preview_name, preview_data), (thumb_name, thumb_data) in zip(node_files, previews[node_id], thumbnails[node_id]):
+                entry_files = [(name, data), (thumb_name, thumb_data)]
+                if preview_name != name:
+                    entry_files.append((preview_name, preview_data))
+                for file_name, file_data in entry_files if leader is None else []:
+                    with open(os.path.join(path, file_name), 'wb') as f:
+                        f.write(file_data)
+                    size += len(file_data)
+                images[node_id].append(name)
+                preview_names[node_id].append(preview_name)
+                thumbs.append(thumb_name)
+
+        now = time.time()
+        meta = {
+            'job_id': job.job_id,
+            'app': job.app,
+            'label': job.label,
+            'inputs': job.inputs or {},
+            'seeds': prompt_seeds(job.prompt),
+            'images': images,
+            'previews': preview_names,
+            'thumbnails': thumbs,
+            'created_at': now,
+            'accessed_at': now,
+        }
+        if leader is not None:
+            meta['files'] = leader.job_id
+        # meta is written last, a directory without it is a broken entry
+        self._write_meta(path, meta)
+        meta['path'] = path
+        meta['files_path'] = files_path
+        meta['size'] = size
+        meta['written_accessed_at'] = now
+        with self.lock:
+            self.entries[job.job_id] = meta
+        logger.info(f"Save gallery entry {job.app}, {job.job_id}, {size} bytes")
+
+    def _write_meta(self, path, meta):
+        # replaced in one step, a meta.json cut short would make the entry broken
+        meta = {key: value for key, value in meta.items() if key not in ('path', 'files_path', 'size', 'written_accessed_at')}
+        meta_path = os.path.join(path, META_FILE)
+        with open(f"{meta_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(f"{meta_path}.tmp", meta_path)
+
+    def _evict(self):
+        with self.lock:
+            # entries sharing files are evicted together, when none of them was viewed recently
+            groups = {}
+            for entry in self.entries.values():
+                groups.setdefault(entry['files_path'], []).append(entry)
+            total = sum(entry['size'] for entry in self.entries.values())
+            evicted = []
+            for group in sorted(groups.values(), key=lambda group: max(entry['accessed_at'] for entry in group)):
+                if total <= self.max_bytes:
+                    break
+                for entry in group:
+                    total -= entry['size']
+                    evicted.append(self.entries.pop(entry['job_id']))
+        for entry in evicted:
+            logger.info(f"Evict gallery entry {entry['app']}, {entry['job_id']}")
+            shutil.rmtree(entry['path'], ignore_errors=True)
+
+    def get_entry(self, job_id):
+        with self.lock:
+            entry = self.entries.get(job_id)
+            if entry is None:
+                return None
+            entry['accessed_at'] = time.time()
+            # the eviction order survives restarts, written at most once per interval
+            write = entry['accessed_at'] - entry['written_accessed_at'] > ACCESS_WRITE_INTERVAL
+            if write:
+                entry['written_accessed_at'] = entry['accessed_at']
+        if write:
+            try:
+                self._write_meta(entry['path'], entry)
+            except OSError as e:
+                logger.warning(f"Failed to update gallery entry {entry['job_id']}, {e}")
+        return entry
+
+    def list_entries(self, app, limit=None):
+        # most recent first
+        with self.lock:
+            entries = [entry for entry in self.entries.values() if entry['app'] == app]
+        entries.sort(key=lambda entry: entry['created_at'], reverse=True)
+        return entries[:limit] if limit else entries
+
+    def image_paths(self, entry, node_id):
+        return [os.path.join(entry['files_path'], name) for name in entry['images'].get(node_id, [])]
+
+    def preview_paths(self, entry, node_id):
+        # entries saved before previews were kept show the originals
+        names = entry.get('previews', entry['images']).get(node_id, [])
+        return [os.path.join(entry['files_path'], name) for name in names]
+
+    def thumbnail_paths(self, entry):
+        return [os.path.join(entry['files_path'], name) for name in entry['thumbnails']]
@@ -0,0 +1,45 @@
+"""
+Display previews of output images.
+
+Pages show a size-capped WebP (or progressive JPEG) encoded on the server, the lossless
+original is only sent when the user downloads it.
+"""
+
+import io
+import os
+from loguru import logger
+
+PREVIEW_MAX_SIZE = int(os.getenv('COMFYFLOW_PREVIEW_MAX_SIZE', '1024'))
+PREVIEW_FORMAT = os.getenv('COMFYFLOW_PREVIEW_FORMAT', 'webp').lower()
+PREVIEW_QUALITY = 85
+
+
+def preview_ext():
+    return '.jpg' if PREVIEW_FORMAT == 'jpeg' else '.webp'
+
+
+def encode_preview(data):
+    """
+    return the preview bytes of an encoded image, the original if it is already smaller or
+    animated, a re-encoded animation would keep only its first frame
+    """
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    if getattr(image, 'is_animated', False):
+        return data
+    image.thumbnail((PREVIEW_MAX_SIZE, PREVIEW_MAX_SIZE))
+    buffer = io.BytesIO()
+    if PREVIEW_FORMAT == 'jpeg':
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.save(buffer, format='JPEG', quality=PREVIEW_QUALITY, progressive=True, optimize=True)
+    else:
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        image.save(buffer, format='WEBP', quality=PREVIEW_QUALITY, method=4)
+    preview = buffer.getvalue()
+    if len(preview) >= len(data):
+        return data
+    logger.debug(f"Encode preview {image.size}, {len(data)} -> {len(preview)} bytes")
+    return preview
@@ -0,0 +1,131 @@
+import json
+from loguru import logger
+import streamlit as st
+from sqlalchemy import text
+
+"""
+comfyflow_jobs table
+    id TEXT
+    app TEXT
+    username TEXT
+    label TEXT
+    status TEXT
+    server_addr TEXT
+    prompt_id TEXT
+    prompt TEXT
+    outputs TEXT
+    error TEXT
+    created_at TEXT
+    started_at TEXT
+    finished_at TEXT
+
+comfyflow_node_timings table, one row per node of a finished job
+    job_id TEXT
+    app TEXT
+    node_id TEXT
+    class_type TEXT
+    duration REAL
+    cached INTEGER
+    created_at TEXT
+"""
+
+UNFINISHED_STATUS = ('Pending', 'Running')
+
+
+class JobModel:
+    def __init__(self, retention_days=7) -> None:
+        self.db_conn = st.connection('comfyflow_db', type='sql')
+        self.job_table_name = 'comfyflow_jobs'
+        self.timing_table_name = 'comfyflow_node_timings'
+        # finished jobs and node timings older than this are deleted, 0 keeps them forever
+        self.retention_days = retention_days
+        self._init_table()
+        self.prune()
+        logger.info(f"db_conn: {self.db_conn}, job_table_name: {self.job_table_name}, retention days: {retention_days}")
+
+    @property
+    def session(self):
+        return self.db_conn.session
+
+    def _init_table(self):
+        # Create a table if it doesn't exist.
+        with self.session as s:
+            sql = text(f'CREATE TABLE IF NOT EXISTS {self.job_table_name} (id TEXT PRIMARY KEY, app TEXT, username TEXT, label TEXT, status TEXT, server_addr TEXT, prompt_id TEXT, prompt TEXT, outputs TEXT, error TEXT, created_at TEXT, started_at TEXT, finished_at TEXT);')
+            s.execute(sql)
+
+            # create index on app and status
+            sql = text(f'CREATE INDEX IF NOT EXISTS {self.job_table_name}_app_index ON {self.job_table_name} (app);')
+            s.execute(sql)
+            sql = text(f'CREATE INDEX IF NOT EXISTS {self.job_table_name}_status_index ON {self.job_table_name} (status);')
+            s.execute(sql)
+
+            sql = text(f'CREATE TABLE IF NOT EXISTS {self.timing_table_name} (job_id TEXT, app TEXT, node_id TEXT, class_type TEXT, duration REAL, cached INTEGER, created_at TEXT);')
+            s.execute(sql)
+            sql = text(f'CREATE INDEX IF NOT EXISTS {self.timing_table_name}_app_index ON {self.timing_table_name} (app, created_at);')
+            s.execute(sql)
+            s.commit()
+            logger.info(f"init job table {self.job_table_name} and index")
+
+    def create_jobs(self, jobs):
+        with self.session as s:
+            logger.info(f"insert jobs: {[job.job_id for job in jobs]}")
+            sql = text(f'INSERT INTO {self.job_table_name} (id, app, username, label, status, prompt, created_at) VALUES (:id, :app, :username, :label, :status, :prompt, datetime("now"));')
+            s.execute(sql, [dict(id=job.job_id, app=job.app, username=job.user, label=job.label, status=job.status.value, prompt=json.dumps(job.prompt)) for job in jobs])
+            s.commit()
+
+    def update_job_started(self, job):
+        with self.session as s:
+            logger.debug(f"update job started: {job.job_id} {job.prompt_id}")
+            sql = text(f'UPDATE {self.job_table_name} SET status=:status, server_addr=:server_addr, prompt_id=:prompt_id, started_at=datetime("now") WHERE id=:id;')
+            s.execute(sql, dict(id=job.job_id, status=job.status.value, server_addr=job.client.server_addr, prompt_id=job.prompt_id))
+            s.commit()
+
+    def update_jobs_finished(self, jobs):
+        with self.session as s:
+            logger.debug(f"update jobs finished: {[(job.job_id, job.status.value) for job in jobs]}")
+            sql = text(f'UPDATE {self.job_table_name} SET status=:status, server_addr=:server_addr, prompt_id=:prompt_id, outputs=:outputs, error=:error, finished_at=datetime("now") WHERE id=:id;')
+            s.execute(sql, [dict(id=job.job_id, status=job.status.value, server_addr=job.client.server_addr if job.client else None,
+                                 prompt_id=job.prompt_id, outputs=json.dumps(job.outputs), error=job.error) for job in jobs])
+            s.commit()
+
+    def get_job(self, job_id):
+        with self.session as s:
+            sql = text(f'SELECT * FROM {self.job_table_name} WHERE id=:id;')
+            return s.execute(sql, {'id': job_id}).fetchone()
+
+    def get_unfinished_jobs(self):
+        with self.session as s:
+            sql = text(f'SELECT * FROM {self.job_table_name} WHERE status IN (:pending, :running) order by created_at;')
+            jobs = s.execute(sql, dict(pending=UNFINISHED_STATUS[0], running=UNFINISHED_STATUS[1])).fetchall()
+            logger.info(f"get unfinished jobs from db, {len(jobs)}")
+            return jobs
+
+    def create_node_timings(self, job):
+        with self.session as s:
+            logger.debug(f"insert node timings: {job.job_id}, {len(job.timer.records)}")
+            sql = text(f'INSERT INTO {self.timing_table_name} (job_id, app, node_id, class_type, duration, cached, created_at) VALUES (:job_id, :app, :node_id, :class_type, :duration, :cached, datetime("now"));')
+            s.execute(sql, [dict(job_id=job.job_id, app=job.app, node_id=node_id, class_type=class_type, duration=duration, cached=int(cached))
+                            for node_id, class_type, duration, cached in job.timer.records])
+            s.commit()
+
+    def get_node_timings(self, app, runs):
+        # per node totals over the last runs of an app
+        with self.session as s:
+            sql = text(f'SELECT node_id, class_type, count(*) AS runs, sum(cached) AS cached_runs, sum(duration) AS total_duration, max(duration) AS max_duration '
+                       f'FROM {self.timing_table_name} WHERE app=:app AND job_id IN '
+                       f'(SELECT job_id FROM {self.timing_table_name} WHERE app=:app GROUP BY job_id ORDER BY max(created_at) DESC LIMIT :runs) '
+                       f'GROUP BY node_id, class_type;')
+            return s.execute(sql, dict(app=app, runs=runs)).fetchall()
+
+    def prune(self):
+        # unfinished jobs are kept whatever their age, they are reattached on restart
+        if self.retention_days <= 0:
+            return
+        with self.session as s:
+            before = f'-{self.retention_days} days'
+            sql = text(f'DELETE FROM {self.job_table_name} WHERE status NOT IN (:pending, :running) AND created_at < datetime("now", :before);')
+            jobs = s.execute(sql, dict(pending=UNFINISHED_STATUS[0], running=UNFINISHED_STATUS[1], before=before)).rowcount
+            sql = text(f'DELETE FROM {self.timing_table_name} WHERE created_at < datetime("now", :before);')
+            timings = s.execute(sql, dict(before=before)).rowcount
+            s.commit()
+            logger.info(f"prune jobs older than {self.retention_days} days, {jobs} jobs, {timings} node timings")
@@ -0,0 +1,184 @@
+"""
+Prometheus metrics of the generation flow.
+
+Metrics are module globals updated by the client, scheduler and app code, and served
+in the prometheus text format by a stdlib http server on a local port. Every app runs
+in its own streamlit process, so a process whose port is taken tries the next ones.
+
+Gauges are read at scrape time from callbacks, e.g. jobs per backend from the scheduler.
+"""
+
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loguru import logger
+
+# latency buckets in seconds, from a cached prompt to a long video render
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+# ports tried after the configured one, for the app processes
+METRICS_PORT_RANGE = 16
+
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name, help, labels=()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def label_values(self, labels):
+        # None, e.g. the app of a warm-up job, is an empty label
+        return tuple('' if labels.get(name) is None else str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        # [(suffix, label names, label values, value)]
+        return []
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.metric_type}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(names, values)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def __init__(self, name, help, labels=()) -> None:
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [('_total', self.labels, key, value) for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def __init__(self, name, help, labels=()) -> None:
+        super().__init__(name, help, labels)
+        self.callbacks = []
+
+    def set_function(self, callback):
+        # callback returns {label values tuple: value}, read at scrape time
+        self.callbacks.append(callback)
+
+    def samples(self):
+        samples = []
+        for callback in self.callbacks:
+            try:
+                samples.extend(('', self.labels, tuple(str(value) for value in key), value) for key, value in callback().items())
+            except Exception as e:
+                logger.warning(f"Failed to read gauge {self.name}, {e}")
+        return samples
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+        # label values -> [bucket counts, sum, count]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append(('_bucket', self.labels + ('le',), key + (format_value(bound),), bucket_count))
+                samples.append(('_sum', self.labels, key, total))
+                samples.append(('_count', self.labels, key, count))
+        return samples
+
+
+REGISTRY = []
+
+QUEUE_WAIT = Histogram('comfyflow_queue_wait_seconds', 'Time a job waited in the local queue before dispatch', ('app',))
+EXECUTION = Histogram('comfyflow_execution_seconds', 'Time from dispatch until comfyui finished the prompt', ('app',))
+OUTPUT_FETCH = Histogram('comfyflow_output_fetch_seconds', 'Time to fetch the history and outputs of a finished prompt', ('app',))
+END_TO_END = Histogram('comfyflow_end_to_end_seconds', 'Time from submission until the outputs were collected', ('app', 'status'))
+CACHE_REQUESTS = Counter('comfyflow_cache_requests', 'Cache lookups by cache and result, hit or miss', ('cache', 'result'))
+WEBSOCKET_RECONNECTS = Counter('comfyflow_websocket_reconnects', 'Websocket connections reopened after a drop', ('backend',))
+UPLOAD_BYTES = Counter('comfyflow_upload_bytes', 'Bytes of input files uploaded to comfyui', ('backend',))
+ACTIVE_SESSIONS = Gauge('comfyflow_active_sessions', 'Browser sessions connected to this process')
+BACKEND_JOBS = Gauge('comfyflow_backend_jobs', 'Jobs per backend and state', ('backend', 'state'))
+
+
+def cache_hit(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would flood the log
+        pass
+
+
+def start_metrics_server(address, port):
+    for candidate in range(port, port + METRICS_PORT_RANGE):
+        try:
+            server = ThreadingHTTPServer((address, candidate), MetricsHandler)
+        except OSError:
+            continue
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"Metrics server on http://{address}:{candidate}/metrics")
+        return server
+    logger.warning(f"No free port for the metrics server in {port}-{port + METRICS_PORT_RANGE - 1}")
+    return None
@@ -1,85 +1,46 @@
 from loguru import logger
-from PIL import Image, ImageOps
 from io import BytesIO
 import json
 import streamlit as st
 import modules.page as page
-from streamlit_extras.row import row
 from modules import get_comfyui_object_info, get_workspace_model, check_comfyui_alive
+from modules.workflow_meta import read_workflow_meta
+from modules.prompt_index import get_prompt_index, param_key
+from modules.prompt_graph import get_required_nodes
 
-NODE_SEP = '||'
 FAQ_URL = "https://github.com/xingren23/ComfyFlowApp/wiki/FAQ"
-SUPPORTED_COMFYUI_CLASSTYPE_OUTPUT = ['PreviewImage', 'SaveImage', 'SaveAnimatedWEBP', 'SaveAnimatedPNG', 'VHS_VideoCombine']
 
 def format_input_node_info(param):
-    # format {id}.{class_type}.{alias}.{param_name}
+    # format {id}:{class_type}:{param_name}:{param_value}
     params_inputs = st.session_state.get('create_prompt_inputs', {})
-    params_value = params_inputs[param]
-    logger.debug(f"format_input_node_info, {param} {params_value}")
-    node_id, class_type, param_name, param_value = params_value.split(NODE_SEP)
-    return f"{node_id}:{class_type}:{param_name}:{param_value}"
+    return params_inputs[param].label
 
 def format_output_node_info(param):
-    # format {id}.{class_type}
+    # format {id}:{class_type}:{input_values}
     params_outputs = st.session_state.get('create_prompt_outputs', {})
-    params_value = params_outputs[param]
-    logger.debug(f"format_output_node_info, {param} {params_value}")
-    node_id, class_type, input_values = params_value.split(NODE_SEP)
-    return f"{node_id}:{class_type}:{input_values}"
+    return params_outputs[param].label
+
+def is_json_upload(upload):
+    return upload is not None and upload.name.lower().endswith('.json')
 
 def process_workflow_meta(image_upload):
-    # parse meta data from image, save image to local
+    # parse meta data from image metadata chunks or json, pixels are never decoded
     try:
         logger.info(f"process_workflow_meta, {image_upload}")
-        img = Image.open(image_upload)
-        tran_img = ImageOps.exif_transpose(img)
-        logger.debug(f"process_workflow_meta, {tran_img.info.get('workflow')} {tran_img.info.get('prompt')}")
-        return tran_img.info
+        metas = read_workflow_meta(image_upload)
+        logger.debug(f"process_workflow_meta, {metas.get('workflow')} {metas.get('prompt')}")
+        return metas
     except Exception as e:
         logger.error(f"process_workflow_meta error, {e}")
         return None
 
 
 def parse_prompt(prompt_info, object_info_meta):
-    # parse prompt to inputs and outputs
+    # parse prompt to inputs and outputs, indexed by "{node_id}||{param}" and "{node_id}||{class_type}"
+    # every output node of comfyui could be an app output, the output kind is detected at runtime
     try:
-        prompt = json.loads(prompt_info)
-        params_inputs = {}
-        params_outputs = {}
-        for node_id in prompt:
-            node = prompt[node_id]
-            class_type = prompt[node_id]['class_type']
-            node_inputs = []
-            for param in node['inputs']:
-                param_value = node['inputs'][param]
-                option_key = f"{node_id}{NODE_SEP}{param}"
-                option_value = f"{node_id}{NODE_SEP}{class_type}{NODE_SEP}{param}{NODE_SEP}{param_value}"
-                logger.debug(f"parse_prompt, {option_key} {option_value}")
-                # check param_value is []
-                if isinstance(param_value, list):
-                    logger.debug(f"ignore {option_key}, param_value is list, {param_value}")
-                    continue
-                if param == "choose file to upload":
-                    logger.debug(f"ignore {option_key}, param for 'choose file to upload'")
-                    continue
-                                
-                params_inputs.update({option_key: option_value})
-                node_inputs.append(param_value)
-
-            is_output = object_info_meta[class_type]['output_node']
-            if is_output:
-                # TODO: support multi output
-                if class_type in SUPPORTED_COMFYUI_CLASSTYPE_OUTPUT:
-                    option_key = f"{node_id}{NODE_SEP}{class_type}"
-                    if len(node_inputs) == 0:
-                        option_value = f"{node_id}{NODE_SEP}{class_type}{NODE_SEP}None"
-                    else:
-                        option_value = f"{node_id}{NODE_SEP}{class_type}{NODE_SEP}{node_inputs}"
-                    params_outputs.update({option_key: option_value})
-                else:
-                    logger.warning(f"Only support SaveImage as output node, {class_type}")
-
-        return (params_inputs, params_outputs)
+        prompt_index = get_prompt_index(prompt_info, object_info_meta)
+        return (prompt_index.inputs, prompt_index.outputs)
     except Exception as e:
         st.error(f"parse_prompt error, {e} refer to {FAQ_URL}")
         return (None, None)
@@ -90,24 +51,26 @@ def process_image_change():
     upload_image = st.session_state['create_upload_image']
     if upload_image:
         metas = process_workflow_meta(upload_image)
-        if metas and 'prompt' in metas.keys() and 'workflow' in metas.keys():
+        if metas and 'prompt' in metas.keys():
             st.session_state['create_prompt'] = metas.get('prompt')
             st.session_state['create_workflow'] = metas.get('workflow')
             inputs, outputs = parse_prompt(metas.get('prompt'), comfyui_object_info)
             if inputs:
-                logger.info(f"create_prompt_inputs, {inputs}")
+                logger.info(f"create_prompt_inputs, {len(inputs)}")
                 st.success(f"parse inputs from workflow image, input nodes {len(inputs)}")
                 st.session_state['create_prompt_inputs'] = inputs
             else:
                 st.error(f"parse workflow from image error, inputs is None, refer to {FAQ_URL}")
 
             if outputs:
-                logger.info(f"create_prompt_outputs, {outputs}")
+                logger.info(f"create_prompt_outputs, {len(outputs)}")
                 st.success(f"parse outputs from workflow image, output nodes {len(outputs)}")
                 st.session_state['create_prompt_outputs'] = outputs
             else:
                 st.error(f"parse workflow from image error, outputs is None, refer to {FAQ_URL}")
             
+        elif metas and 'workflow' in metas.keys():
+            st.error(f"the file only contains the ui workflow, please upload an image or api format json (Save (API Format)), refer to {FAQ_URL}")
         else:
             st.error(f"the image don't contain workflow info, refer to {FAQ_URL}")
     else:
@@ -122,14 +85,14 @@ def process_image_edit(api_prompt):
         st.session_state['create_prompt'] =api_prompt
         inputs, outputs = parse_prompt(api_prompt, comfyui_object_info)
         if inputs:
-            logger.info(f"create_prompt_inputs, {inputs}")
+            logger.info(f"create_prompt_inputs, {len(inputs)}")
             st.success(f"parse inputs from workflow image, input nodes {len(inputs)}")
             st.session_state['create_prompt_inputs'] = inputs
         else:
             st.error(f"parse workflow from image error, inputs is None, refer to {FAQ_URL}")
 
         if outputs:
-            logger.info(f"create_prompt_outputs, {outputs}")
+            logger.info(f"create_prompt_outputs, {len(outputs)}")
             st.success(f"parse outputs from workflow image, output nodes {len(outputs)}")
             st.session_state['create_prompt_outputs'] = outputs
         else:
@@ -140,21 +103,16 @@ def process_image_edit(api_prompt):
 
 def get_node_input_config(input_param, app_input_name, app_input_description):
     params_inputs = st.session_state.get('create_prompt_inputs', {})
-    option_params_value = params_inputs[input_param]
-    logger.debug(f"get_node_input_config, {input_param} {option_params_value}")
-    node_id, class_type, param, param_value = option_params_value.split(NODE_SEP)
-    comfyui_object_info = st.session_state.get('comfyui_object_info')
-    class_meta = comfyui_object_info[class_type]
-    class_input = class_meta['input']['required']
-    if 'optional' in class_meta['input'].keys():
-        class_input.update(class_meta['input']['optional'])
-
-    logger.debug(f"{node_id} {class_type} {param} {param_value}, class input {class_input}")
+    prompt_param = params_inputs[input_param]
+    node_id, class_type, param, param_value, spec = prompt_param
+    logger.debug(f"get_node_input_config, {node_id} {class_type} {param}, spec {spec}")
+    if spec is None:
+        raise ValueError(f"input {param} of node {node_id}:{class_type} not found in comfyui object info")
 
     input_config = {}
-    if isinstance(class_input[param][0], str):
+    if isinstance(spec[0], str):
 
-        if class_input[param][0] == 'STRING':
+        if spec[0] == 'STRING':
             input_config = {
                 "type": "TEXT",
                 "name": app_input_name,
@@ -162,8 +120,8 @@ def get_node_input_config(input_param, app_input_name, app_input_description):
                 "default": str(param_value),
                 "max": 500,
             }
-        elif class_input[param][0] == 'INT':
-            defaults = class_input[param][1]
+        elif spec[0] == 'INT':
+            defaults = spec[1]
             input_config = {
                 "type": "NUMBER",
                 "name": app_input_name,
@@ -173,8 +131,8 @@ def get_node_input_config(input_param, app_input_name, app_input_description):
                 "max": min(defaults.get('max', 100), 4503599627370496),
                 "step": defaults.get('step', 1),
             }
-        elif class_input[param][0] == 'FLOAT':
-            defaults = class_input[param][1]
+        elif spec[0] == 'FLOAT':
+            defaults = spec[1]
             input_config = {
                 "type": "NUMBER",
                 "name": app_input_name,
@@ -184,15 +142,15 @@ def get_node_input_config(input_param, app_input_name, app_input_description):
                 "max": min(defaults.get('max', 100), 4503599627370496),
                 "step": defaults.get('step', 1),
             }
-        elif class_input[param][0] == 'BOOLEAN':
-            defaults = class_input[param][1]
+        elif spec[0] == 'BOOLEAN':
+            defaults = spec[1]
             input_config = {
                 "type": "CHECKBOX",
                 "name": app_input_name,
                 "help": app_input_description,
                 "default": param_value,
             }
-    elif isinstance(class_input[param][0], list):
+    elif isinstance(spec[0], list):
         if class_type == 'LoadImage' and param == 'image':
             input_config = {
                 "type": "UPLOADIMAGE",
@@ -210,18 +168,19 @@ def get_node_input_config(input_param, app_input_name, app_input_description):
                 "type": "SELECT",
                 "name": app_input_name,
                 "help": app_input_description,
-                "options": class_input[param][0],
+                "options": spec[0],
             }
     return node_id, param, input_config
 
 
-def get_node_output_config(output_param):
+def get_node_output_config(output_param, app_output_name, app_output_description):
     params_outputs = st.session_state.get('create_prompt_outputs', {})
-    output_param_value = params_outputs[output_param]
-    node_id, class_type, param = output_param_value.split(NODE_SEP)
+    node_id = params_outputs[output_param].node_id
     output_param_inputs = {
         "outputs": {
-        }
+        },
+        "name": app_output_name,
+        "help": app_output_description,
     }
     return node_id, output_param_inputs
 
@@ -232,6 +191,8 @@ def gen_app_config():
     input_param1_name = st.session_state['input_param1_name']
     input_param1_desc = st.session_state['input_param1_desc']
     output_param1 = st.session_state['output_param1']
+    output_param1_name = st.session_state['output_param1_name']
+    output_param1_desc = st.session_state['output_param1_desc']
     app_name = st.session_state['create_app_name']
     app_description = st.session_state['create_app_description']
     logger.info(f"gen_app_config, {prompt} {input_param1} {output_param1} {app_name} {app_description}")
@@ -273,8 +234,20 @@ def gen_app_config():
             app_config['inputs'][node_id]['inputs'][param] = input_param3_inputs
 
         # parse output_param1
-        node_id, output_param1_inputs = get_node_output_config(output_param1)
+        node_id, output_param1_inputs = get_node_output_config(
+            output_param1, output_param1_name, output_param1_desc)
         app_config['outputs'][node_id] = output_param1_inputs
+
+        # parse output_param2 and output_param3, all outputs are fetched in one run
+        for index in [2, 3]:
+            output_param = st.session_state.get(f'output_param{index}')
+            if output_param:
+                node_id, output_param_inputs = get_node_output_config(
+                    output_param, st.session_state[f'output_param{index}_name'], st.session_state[f'output_param{index}_desc'])
+                app_config['outputs'][node_id] = output_param_inputs
+
+        # analyse nodes feeding the outputs once at creation, cached for app runs
+        get_required_nodes(prompt, tuple(app_config['outputs'].keys()))
         return app_config
 
 
@@ -285,8 +258,14 @@ def submit_app():
         if get_workspace_model().get_app(app_config['name']):
             st.session_state['create_submit_info'] = "exist"
         else:
-            # resize image
-            img = Image.open(st.session_state['create_upload_image'])
+            # resize image, json uploads use the default app icon
+            from PIL import Image
+            upload_image = st.session_state['create_upload_image']
+            if is_json_upload(upload_image):
+                img = Image.open("./public/images/app-150.png")
+            else:
+                img = Image.open(upload_image)
+                img.draft('RGB', (64, 64))
             img = img.resize((64,64))
             img_bytesio = BytesIO()
             img.save(img_bytesio, format="PNG")
@@ -335,7 +314,7 @@ def on_edit_workspace():
 
 def edit_app_ui(app):
     with page.stylable_button_container():
-        header_row = row([0.85, 0.15], vertical_align="top")
+        header_row = page.row([0.85, 0.15], vertical_align="top")
         header_row.title("🌱 Edit app")
         header_row.button("Back Workspace", help="Back to your workspace", key="edit_back_workspace", on_click=on_edit_workspace)
         
@@ -397,7 +376,7 @@ def edit_app_ui(app):
                     param_help = node_inputs[param]['help']
 
                     param = {
-                        'index': f"{node_id}{NODE_SEP}{param}",
+                        'index': param_key(node_id, param),
                         'name': param_name,
                         'help': param_help,
                     }
@@ -429,28 +408,25 @@ def edit_app_ui(app):
             params_outputs = st.session_state.get('create_prompt_outputs', {})
             params_outputs_options = list(params_outputs.keys())
 
+            api_conf = json.loads(app.api_conf)
             output_params = []
             for node_id in app_conf['outputs']:
-                node_inputs = app_conf['outputs'][node_id]['outputs']
-                for param in node_inputs:
-                    param_name = node_inputs[param]['name']
-                    param_help = node_inputs[param]['help']
-
-                    param = {
-                        'index': f"{node_id}{NODE_SEP}{param}",
-                        'name': param_name,
-                        'help': param_help,
-                    }
-                    input_params.append(param)
-
-            if len(output_params) > 0:
-                output_param_1 = output_params[0]
-                add_output_config_param(params_outputs_options, 1, output_param_1)
-            else:
-                add_output_config_param(params_outputs_options, 1, None)
+                node_output = app_conf['outputs'][node_id]
+                param = {
+                    'index': param_key(node_id, api_conf[node_id]['class_type']),
+                    'name': node_output.get('name'),
+                    'help': node_output.get('help'),
+                }
+                output_params.append(param)
+
+            for index in [1, 2, 3]:
+                if len(output_params) >= index:
+                    add_output_config_param(params_outputs_options, index, output_params[index - 1])
+                else:
+                    add_output_config_param(params_outputs_options, index, None)
 
     with st.container():
-        operation_row = row([0.15, 0.7, 0.15])
+        operation_row = page.row([0.15, 0.7, 0.15])
         submit_button = operation_row.button("Save", key='edit_submit_app', type="primary",
                                             use_container_width=True, 
                                             help="Save app params",on_click=save_app, args=(app,))     
@@ -479,7 +455,7 @@ def add_input_config_param(params_inputs_options, index, input_param):
     else:
         option_index = params_inputs_options.index(input_param['index'])
 
-    param_input_row = row([0.4, 0.2, 0.4], vertical_align="bottom")
+    param_input_row = page.row([0.4, 0.2, 0.4], vertical_align="bottom")
     param_input_row.selectbox("Select input of workflow *", options=params_inputs_options, key=f"input_param{index}", 
                             index=option_index,format_func=format_input_node_info, help="Select a param from workflow")
     param_input_row.text_input("App Input Name *", placeholder="Param Name", key=f"input_param{index}_name", 
@@ -497,7 +473,7 @@ def add_output_config_param(params_outputs_options, index, output_param):
     else:
         option_index = params_outputs_options.index(output_param['index'])
     
-    param_output_row = row([0.4, 0.2, 0.4], vertical_align="bottom")
+    param_output_row = page.row([0.4, 0.2, 0.4], vertical_align="bottom")
     param_output_row.selectbox("Select output of workflow *", options=params_outputs_options,
                             key=f"output_param{index}", index=option_index, format_func=format_output_node_info, help="Select a param from workflow")
     param_output_row.text_input("Apn Output Name *", placeholder="Param Name", key=f"output_param{index}_name", 
@@ -508,7 +484,7 @@ def add_output_config_param(params_outputs_options, index, output_param):
 def new_app_ui():
     logger.info("Loading create page")
     with page.stylable_button_container():
-        header_row = row([0.85, 0.15], vertical_align="top")
+        header_row = page.row([0.85, 0.15], vertical_align="top")
         header_row.title("🌱 Create app from comfyui workflow")
         header_row.button("Back Workspace", help="Back to your workspace", key="create_back_workspace", on_click=on_new_workspace)
 
@@ -528,9 +504,9 @@ def new_app_ui():
     with st.expander("### :one: Upload image of comfyui workflow", expanded=True):
         image_col1, image_col2 = st.columns([0.5, 0.5])
         with image_col1:
-            st.file_uploader("Upload image from comfyui outputs *", type=["png", "jpg", "jpeg", "webp"], 
+            st.file_uploader("Upload image from comfyui outputs *", type=["png", "jpg", "jpeg", "webp", "json"], 
                                             key="create_upload_image", 
-                                            help="upload image from comfyui output folder", accept_multiple_files=False)
+                                            help="upload image from comfyui output folder, or workflow json of api format", accept_multiple_files=False)
             process_image_change()  
 
         with image_col2:
@@ -541,7 +517,10 @@ def new_app_ui():
                 logger.debug(f"input_params: {input_params}, output_params: {output_params}")
                 _, image_col, _ = st.columns([0.2, 0.6, 0.2])
                 with image_col:
-                    st.image(image_upload, use_column_width=True, caption='ComfyUI Image with workflow info')
+                    if is_json_upload(image_upload):
+                        st.image("./public/images/app-150.png", use_column_width=True, caption='ComfyUI workflow json')
+                    else:
+                        st.image(image_upload, use_column_width=True, caption='ComfyUI Image with workflow info')
                 
                 
     with st.expander("### :two: Config params of app", expanded=True):
@@ -569,10 +548,12 @@ def new_app_ui():
             params_outputs_options = list(params_outputs.keys())
 
             add_output_config_param(params_outputs_options, 1, None)
+            add_output_config_param(params_outputs_options, 2, None)
+            add_output_config_param(params_outputs_options, 3, None)
             
     
     with st.container():
-        operation_row = row([0.15, 0.7, 0.15])
+        operation_row = page.row([0.15, 0.7, 0.15])
         submit_button = operation_row.button("Submit", key='create_submit_app', type="primary",
                                             use_container_width=True, 
                                             help="Submit app params",on_click=submit_app)     
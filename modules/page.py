@@ -6,10 +6,6 @@
 from loguru import logger
 import os
 import streamlit as st
-import streamlit_extras.app_logo as app_logo
-from streamlit_extras.badges import badge
-from htbuilder import a, img
-from streamlit_extras.stylable_container import stylable_container
 from streamlit.source_util import (
     get_pages,
     _on_pages_changed,
@@ -83,7 +79,18 @@ def page_init(layout="wide"):
     # 根据环境变量中的模式更新页面
     change_mode_pages(os.environ.get('MODE'))
 
-    # 添加应用logo
+    # 进程首次运行页面时启动指标服务，并记录当前会话
+    from modules import track_session
+    track_session()
+
+    # 服务启动后首次加载页面时创建应用进程池，启动应用前进程已完成预热
+    from manager.app_manager import start_app_worker_pool
+    start_app_worker_pool()
+
+    # 添加应用logo，streamlit_extras 和 htbuilder 在首次使用时导入
+    import streamlit_extras.app_logo as app_logo
+    from streamlit_extras.badges import badge
+    from htbuilder import a, img
     app_logo.add_logo("public/images/logo.png", height=70)
 
     # 调整页面上边距
@@ -140,6 +147,7 @@ def stylable_button_container():
     Returns:
         stylable_container: 返回一个带有预定义样式的容器
     """
+    from streamlit_extras.stylable_container import stylable_container
     return stylable_container(
         key="app_button",
         css_styles=""" 
@@ -161,6 +169,7 @@ def exchange_button_container():
     Returns:
         stylable_container: 返回一个带有预定义样式的容器
     """
+    from streamlit_extras.stylable_container import stylable_container
     return stylable_container(
         key="exchange_button",
         css_styles=""" 
@@ -191,4 +200,13 @@ def custom_text_area():
             </style>
         """
     # 将自定义CSS样式添加到Streamlit中
-    st.markdown(custom_css, unsafe_allow_html=True)
\ No newline at end of file
+    st.markdown(custom_css, unsafe_allow_html=True)
+
+def row(spec, gap="small", vertical_align="top"):
+    """
+    创建一行多列布局，参数同 streamlit_extras.row.row
+    streamlit_extras.row 会连带导入 grid 和 stylable_container，导入耗时较长，
+    因此在首次使用时才导入，避免拖慢页面脚本的冷启动
+    """
+    from streamlit_extras.row import row as extras_row
+    return extras_row(spec, gap=gap, vertical_align=vertical_align)
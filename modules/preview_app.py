@@ -2,9 +2,7 @@ from loguru import logger
 from modules.comfyflow import Comfyflow
 import streamlit as st
 import modules.page as page
-from streamlit_extras.row import row
-from modules import get_comfy_client, get_workspace_model, check_comfyui_alive
-from modules.workspace_model import AppStatus
+from modules import get_comfy_client, get_workspace_model, check_comfyui_alive, AppStatus
 
 def on_preview_workspace():
     st.session_state.pop('preview_app', None)
@@ -12,7 +10,7 @@ def on_preview_workspace():
 
 def preview_app_ui(app):
     with page.stylable_button_container():
-        header_row = row([0.85, 0.15], vertical_align="top")
+        header_row = page.row([0.85, 0.15], vertical_align="top")
         header_row.title("💡Preview app")
         header_row.button("Back Workspace", help="Back to your workspace", key='preview_back_workspace', on_click=on_preview_workspace)
 
@@ -54,7 +52,7 @@ def enter_app_ui(app):
         logger.info(f"enter app {name}, status: {status}")
 
         with page.stylable_button_container():
-            header_row = row([0.85, 0.15], vertical_align="top")
+            header_row = page.row([0.85, 0.15], vertical_align="top")
             header_row.title(f"{name}")
             header_row.button("My Apps", help="Back to your apps", key='enter_back_apps', on_click=on_back_apps)
 
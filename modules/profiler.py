@@ -0,0 +1,57 @@
+"""
+Per-node execution timing from the comfyui websocket events.
+
+ComfyUI announces each node it starts with an executing event and the end of the prompt
+with executing None, so a node runs from its executing event to the next one. Nodes
+reported by execution_cached take no time. Times are measured when the events arrive
+here, the first node of a run includes the model loading it triggers.
+"""
+
+import time
+
+
+class NodeTimer:
+    def __init__(self, prompt) -> None:
+        self.prompt = prompt
+        # [(node_id, class_type, duration seconds, cached)] in execution order
+        self.records = []
+        self.node_id = None
+        self.node_started_at = None
+
+    def put(self, event):
+        now = time.time()
+        event_type = event['type']
+        if event_type == 'execution_cached':
+            for node_id in event['data']['nodes']:
+                self.records.append((node_id, self.class_type(node_id), 0.0, True))
+        elif event_type == 'executing':
+            if self.node_id is not None:
+                self.records.append((self.node_id, self.class_type(self.node_id), now - self.node_started_at, False))
+            self.node_id = event['data']
+            self.node_started_at = now
+        elif event_type == 'execution_error':
+            self.node_id = None
+
+    def class_type(self, node_id):
+        return self.prompt.get(node_id, {}).get('class_type', '')
+
+
+def summarize(rows):
+    """
+    slowest nodes first from node timing rows with node_id, class_type, runs, cached_runs,
+    total_duration and max_duration, with each node's share of the executed time
+    """
+    total = sum(row.total_duration for row in rows) or 1
+    report = []
+    for row in rows:
+        executed_runs = row.runs - row.cached_runs
+        report.append({
+            'node': f"{row.node_id}:{row.class_type}",
+            'avg_seconds': round(row.total_duration / executed_runs, 3) if executed_runs > 0 else 0.0,
+            'max_seconds': round(row.max_duration, 3),
+            'time_share': round(row.total_duration / total, 3),
+            'runs': row.runs,
+            'cache_hit_rate': round(row.cached_runs / row.runs, 3) if row.runs > 0 else 0.0,
+        })
+    report.sort(key=lambda item: item['time_share'], reverse=True)
+    return report
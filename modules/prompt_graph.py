@@ -0,0 +1,169 @@
+"""
+Graph analysis of comfyui api prompts.
+
+A node input that links to another node is a list [node_id, output_index]; nodes are
+walked backwards from the app outputs so branches that don't feed them are dropped.
+"""
+
+import json
+from loguru import logger
+import streamlit as st
+
+# loader inputs naming a model, e.g. CheckpointLoaderSimple.ckpt_name, LoraLoader.lora_name
+MODEL_INPUT_NAMES = ('ckpt_name', 'lora_name', 'unet_name', 'vae_name', 'clip_name', 'control_net_name', 'model_name')
+MODEL_FILE_EXTENSIONS = ('.safetensors', '.ckpt', '.pt', '.pth', '.bin', '.gguf', '.sft')
+SEED_PARAMS = ("seed", "noise_seed")
+
+
+def is_link(value):
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int)
+
+
+def upstream_nodes(prompt, output_node_ids):
+    # all nodes the outputs depend on, outputs included
+    required = set()
+    stack = [node_id for node_id in output_node_ids if node_id in prompt]
+    while stack:
+        node_id = stack.pop()
+        if node_id in required:
+            continue
+        required.add(node_id)
+        for value in prompt[node_id]['inputs'].values():
+            if is_link(value) and value[0] in prompt and value[0] not in required:
+                stack.append(value[0])
+    return required
+
+
+def prune_prompt(prompt, node_ids):
+    return {node_id: node for node_id, node in prompt.items() if node_id in node_ids}
+
+
+def prompt_models(prompt):
+    # model files a bound prompt loads, checkpoints, loras, vaes, controlnets...
+    models = set()
+    for node in prompt.values():
+        for name, value in node['inputs'].items():
+            if not isinstance(value, str):
+                continue
+            if name in MODEL_INPUT_NAMES or value.lower().endswith(MODEL_FILE_EXTENSIONS):
+                models.add(value)
+    return frozenset(models)
+
+
+def prompt_seeds(prompt):
+    # seeds of a bound prompt, "node_id:param" -> value
+    seeds = {}
+    for node_id, node in prompt.items():
+        for param, value in node['inputs'].items():
+            if param in SEED_PARAMS and isinstance(value, int):
+                seeds[f"{node_id}:{param}"] = value
+    return seeds
+
+
+@st.cache_resource(max_entries=64)
+def get_required_nodes(api_data, output_node_ids):
+    """
+    api_data is the api prompt json text and output_node_ids a tuple of the app outputs,
+    the analysis runs once per app and is shared by all sessions
+    """
+    prompt = json.loads(api_data)
+    if not output_node_ids or not all(node_id in prompt for node_id in output_node_ids):
+        logger.warning(f"app outputs {output_node_ids} not found in prompt, keep all nodes")
+        return frozenset(prompt.keys())
+
+    required = upstream_nodes(prompt, output_node_ids)
+    dropped = sorted(set(prompt.keys()) - required)
+    if dropped:
+        dropped_info = [f"{node_id}:{prompt[node_id]['class_type']}" for node_id in dropped]
+        logger.info(f"prune nodes not feeding outputs {output_node_ids}, {dropped_info}")
+    return frozenset(required)
+
+
+# draft mode, per node class: inputs whose step counts are cut, inputs whose latent
+# size is cut, and the input an upscale node is bypassed to
+DRAFT_STEPS_RATIO = 0.4
+DRAFT_MIN_STEPS = 4
+DRAFT_SIZE_RATIO = 0.5
+DRAFT_MIN_SIZE = 256
+# model warm-up runs the smallest variant that still loads every model, upscales with a
+# model are kept for their upscale model loader, on the smallest latent they are cheap
+WARMUP_MIN_SIZE = 64
+WARMUP_KEEP_CLASSES = ('ImageUpscaleWithModel',)
+DRAFT_RULES = {
+    'KSampler': {'steps': ('steps',)},
+    'KSamplerAdvanced': {'steps': ('steps', 'start_at_step', 'end_at_step')},
+    'BasicScheduler': {'steps': ('steps',)},
+    'KarrasScheduler': {'steps': ('steps',)},
+    'ExponentialScheduler': {'steps': ('steps',)},
+    'SDTurboScheduler': {'steps': ('steps',)},
+    'AlignYourStepsScheduler': {'steps': ('steps',)},
+    'EmptyLatentImage': {'size': ('width', 'height')},
+    'EmptySD3LatentImage': {'size': ('width', 'height')},
+    'LatentUpscale': {'bypass': 'samples'},
+    'LatentUpscaleBy': {'bypass': 'samples'},
+    'ImageScale': {'bypass': 'image'},
+    'ImageScaleBy': {'bypass': 'image'},
+    'ImageUpscaleWithModel': {'bypass': 'image'},
+}
+
+
+def draft_steps(value, steps, steps_ratio=DRAFT_STEPS_RATIO, min_steps=DRAFT_MIN_STEPS):
+    # KSamplerAdvanced end_at_step defaults to 10000, i.e. until the last step
+    draft = min(steps, max(min_steps, round(steps * steps_ratio)))
+    return min(draft, round(value * draft / steps)) if steps > 0 else value
+
+
+def draft_size(value, size_ratio=DRAFT_SIZE_RATIO, min_size=DRAFT_MIN_SIZE):
+    # multiples of 16 suit both sd and sd3 latents, small sizes are kept
+    return min(value, max(min_size, int(value * size_ratio) // 16 * 16))
+
+
+def draft_prompt(prompt, output_node_ids, steps_ratio=DRAFT_STEPS_RATIO, min_steps=DRAFT_MIN_STEPS,
+                 size_ratio=DRAFT_SIZE_RATIO, min_size=DRAFT_MIN_SIZE, keep_classes=()):
+    """
+    derive a fast low-cost variant of a bound prompt: fewer sampler steps, smaller empty
+    latents and upscale nodes bypassed, except those of keep_classes, nodes only the
+    upscales used are dropped.
+    the noise depends on the latent size, the draft previews the composition roughly
+    """
+    draft = json.loads(json.dumps(prompt))
+    bypassed = {}
+    for node_id, node in draft.items():
+        rule = DRAFT_RULES.get(node['class_type'], {})
+        inputs = node['inputs']
+        step_names = [name for name in rule.get('steps', ()) if isinstance(inputs.get(name), int)]
+        if 'steps' in step_names:
+            steps = inputs['steps']
+            for name in step_names:
+                inputs[name] = draft_steps(inputs[name], steps, steps_ratio, min_steps)
+        for name in rule.get('size', ()):
+            if isinstance(inputs.get(name), int):
+                inputs[name] = draft_size(inputs[name], size_ratio, min_size)
+        if 'bypass' in rule and node['class_type'] not in keep_classes and is_link(inputs.get(rule['bypass'])):
+            bypassed[node_id] = inputs[rule['bypass']]
+
+    def resolve(link):
+        # follow chains of bypassed upscales
+        while link[0] in bypassed:
+            link = bypassed[link[0]]
+        return link
+
+    for node in draft.values():
+        for name, value in node['inputs'].items():
+            if is_link(value) and value[0] in bypassed:
+                node['inputs'][name] = list(resolve(value))
+    return prune_prompt(draft, upstream_nodes(draft, output_node_ids))
+
+
+def warmup_prompt(prompt, output_node_ids):
+    """
+    the cheapest variant of an app prompt that loads its models: one sampler step on the
+    smallest latent, images are previewed into the comfyui temp folder instead of saved
+    """
+    warmup = draft_prompt(prompt, output_node_ids, steps_ratio=0, min_steps=1, size_ratio=0, min_size=WARMUP_MIN_SIZE,
+                          keep_classes=WARMUP_KEEP_CLASSES)
+    for node in warmup.values():
+        if node['class_type'] == 'SaveImage':
+            node['class_type'] = 'PreviewImage'
+            node['inputs'] = {'images': node['inputs']['images']}
+    return warmup
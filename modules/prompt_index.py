@@ -0,0 +1,116 @@
+"""
+Parameter index of a comfyui api prompt.
+
+Candidate inputs and outputs of a workflow are parsed once per prompt and kept as
+typed records, widgets reference them by key instead of re-parsing strings.
+"""
+
+import json
+from typing import Any, NamedTuple, Optional
+from loguru import logger
+import streamlit as st
+
+NODE_SEP = '||'
+LABEL_VALUE_MAX = 40
+
+
+class PromptParam(NamedTuple):
+    node_id: str
+    class_type: str
+    param: str
+    value: Any
+    # object_info input spec, e.g. ["INT", {"default": 20, "min": 1}], None if the node class is unknown
+    spec: Optional[list]
+
+    @property
+    def key(self):
+        return param_key(self.node_id, self.param)
+
+    @property
+    def label(self):
+        value = str(self.value)
+        if len(value) > LABEL_VALUE_MAX:
+            value = value[:LABEL_VALUE_MAX] + "..."
+        return f"{self.node_id}:{self.class_type}:{self.param}:{value}"
+
+
+class PromptOutput(NamedTuple):
+    node_id: str
+    class_type: str
+    values: list
+
+    @property
+    def key(self):
+        return param_key(self.node_id, self.class_type)
+
+    @property
+    def label(self):
+        values = str(self.values) if self.values else "None"
+        if len(values) > LABEL_VALUE_MAX:
+            values = values[:LABEL_VALUE_MAX] + "..."
+        return f"{self.node_id}:{self.class_type}:{values}"
+
+
+class PromptIndex(NamedTuple):
+    inputs: dict
+    outputs: dict
+
+
+def param_key(node_id, name):
+    return f"{node_id}{NODE_SEP}{name}"
+
+
+def class_input_spec(object_info, class_type):
+    # merge required and optional inputs, without touching the cached object_info
+    if class_type not in object_info:
+        return None
+    class_input = object_info[class_type]['input']
+    spec = dict(class_input.get('required', {}))
+    spec.update(class_input.get('optional', {}))
+    return spec
+
+
+def build_prompt_index(prompt, object_info):
+    inputs = {}
+    outputs = {}
+    for node_id, node in prompt.items():
+        class_type = node['class_type']
+        class_spec = class_input_spec(object_info, class_type)
+        if class_spec is None:
+            logger.warning(f"node class {class_type} not found in object info, node {node_id}")
+
+        node_values = []
+        for param, value in node['inputs'].items():
+            # links to other nodes, [node_id, output_index]
+            if isinstance(value, list):
+                continue
+            if param == "choose file to upload":
+                continue
+            spec = class_spec.get(param) if class_spec else None
+            prompt_param = PromptParam(node_id, class_type, param, value, spec)
+            inputs[prompt_param.key] = prompt_param
+            node_values.append(value)
+
+        if class_spec is not None and object_info[class_type].get('output_node', False):
+            prompt_output = PromptOutput(node_id, class_type, node_values)
+            outputs[prompt_output.key] = prompt_output
+    return PromptIndex(inputs, outputs)
+
+
+def get_prompt_index(prompt_info, object_info):
+    """
+    prompt_info is the api prompt json text, the index is cached per prompt and the
+    object_info of its node classes, so it is rebuilt only when the prompt changes or
+    comfyui gets new nodes or models for it; records are immutable and shared by all sessions
+    """
+    class_types = sorted({node['class_type'] for node in json.loads(prompt_info).values()})
+    class_info = json.dumps({class_type: object_info[class_type] for class_type in class_types if class_type in object_info},
+                            sort_keys=True)
+    return cached_prompt_index(prompt_info, class_info)
+
+
+@st.cache_resource(max_entries=32)
+def cached_prompt_index(prompt_info, class_info):
+    prompt_index = build_prompt_index(json.loads(prompt_info), json.loads(class_info))
+    logger.info(f"build prompt index, inputs {len(prompt_index.inputs)}, outputs {len(prompt_index.outputs)}")
+    return prompt_index
@@ -0,0 +1,63 @@
+"""
+Local validation of bound api prompts against comfyui object_info.
+
+object_info maps a node class to its inputs, {"input": {"required": {name: [type, options]}}},
+where type is "INT", "FLOAT", "STRING"... or the list of allowed values of a select,
+and options hold min and max of numbers. Only what a prompt gets wrong without comfyui
+knowing more is checked, linked inputs are left to the server.
+"""
+
+from modules.prompt_graph import is_link
+
+
+def validate_node_input(node_id, class_type, name, value, spec, upload_names):
+    input_type = spec[0] if isinstance(spec, (list, tuple)) and len(spec) > 0 else None
+    options = spec[1] if isinstance(spec, (list, tuple)) and len(spec) > 1 and isinstance(spec[1], dict) else {}
+    where = f"{node_id}:{class_type}.{name}"
+
+    if isinstance(input_type, list):
+        # select, uploaded images are not in the list until they are uploaded
+        if value not in input_type and value not in upload_names:
+            return f"{where} value {value!r} is not one of the {len(input_type)} allowed values"
+    elif input_type in ('INT', 'FLOAT'):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return f"{where} value {value!r} is not a number"
+        if input_type == 'INT' and not isinstance(value, int):
+            return f"{where} value {value!r} is not an integer"
+        if 'min' in options and value < options['min']:
+            return f"{where} value {value} is less than min {options['min']}"
+        if 'max' in options and value > options['max']:
+            return f"{where} value {value} is greater than max {options['max']}"
+    return None
+
+
+def validate_prompt(prompt, object_info, upload_names=()):
+    """
+    return the errors of a bound prompt, empty if comfyui is expected to accept it
+    """
+    errors = []
+    upload_names = set(upload_names)
+    for node_id, node in prompt.items():
+        class_type = node.get('class_type')
+        node_info = object_info.get(class_type)
+        if node_info is None:
+            errors.append(f"{node_id}:{class_type} node class is not installed on comfyui")
+            continue
+
+        input_info = node_info.get('input', {})
+        required = input_info.get('required', {})
+        specs = {**input_info.get('optional', {}), **required}
+        for name in required:
+            if name not in node['inputs']:
+                errors.append(f"{node_id}:{class_type}.{name} required input is missing")
+        for name, value in node['inputs'].items():
+            if is_link(value):
+                if value[0] not in prompt:
+                    errors.append(f"{node_id}:{class_type}.{name} links to missing node {value[0]}")
+                continue
+            if name not in specs:
+                continue
+            error = validate_node_input(node_id, class_type, name, value, specs[name], upload_names)
+            if error is not None:
+                errors.append(error)
+    return errors
@@ -5,8 +5,7 @@ import base64
 import requests
 import streamlit as st
 import modules.page as page
-from modules.workspace_model import AppStatus
-from streamlit_extras.row import row
+from modules import AppStatus
 
 MODEL_SEP = '##'
 comfyui_supported_pt_extensions = set(['.ckpt', '.pt', '.bin', '.pth', '.safetensors'])
@@ -86,7 +85,7 @@ def publish_app_ui(app, cookies):
     logger.info("Loading publish page")
 
     with page.stylable_button_container():
-        header_row = row([0.85, 0.15], vertical_align="top")
+        header_row = page.row([0.85, 0.15], vertical_align="top")
         header_row.title("✈️ Publish app")
         header_row.button("Back Workspace", help="Back to your workspace", key='publish_back_workspace', on_click=on_publish_workspace)
 
@@ -148,7 +147,7 @@ def publish_app_ui(app, cookies):
                         missing_models.append({class_type: value})
 
         with st.container():
-            operation_row = row([3, 6, 1])
+            operation_row = page.row([3, 6, 1])
 
             missing_button = operation_row.button("Request missing nodes and models", key='missing_button', 
                       help="Request missing comfyui custom nodes and models", disabled=len(missing_nodes) == 0 and len(missing_models) == 0)
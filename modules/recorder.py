@@ -0,0 +1,137 @@
+"""
+Recording of the comfyui traffic of a client, for replaying real runs in benchmarks.
+
+With COMFYFLOW_RECORD_DIR set, every ComfyClient writes the websocket messages it
+receives and the http responses it gets to comfyui-<pid>-<client>.jsonl in that folder,
+one json object per line with t, the seconds since the recording started:
+
+    {"t": 0.0, "kind": "start", "server_addr": ..., "client_id": ...}
+    {"t": 1.25, "kind": "ws", "text": "<json message>"}
+    {"t": 1.31, "kind": "ws_binary", "data": "<base64>"}
+    {"t": 2.4, "kind": "http", "method": "GET", "path": "/history/...", "status": 200,
+     "elapsed": 0.01, "request": {...}, "json": {...}}
+
+Binary http responses, the output images from /view, are kept as base64 in "data", so
+recordings of long runs are large. benchmark/replay.py and the fake comfyui server play
+them back, see load_recording.
+"""
+
+import os
+import json
+import time
+import base64
+import threading
+import urllib.parse as urlparse
+from loguru import logger
+
+RECORD_DIR = os.getenv('COMFYFLOW_RECORD_DIR', '')
+
+
+class Recorder:
+    def __init__(self, path, server_addr, client_id) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.file = open(path, 'a', encoding='utf-8')
+        self.write({"kind": "start", "server_addr": server_addr, "client_id": client_id, "time": time.time()})
+        logger.info(f"Recording comfyui traffic to {path}")
+
+    def write(self, item):
+        item = dict(item, t=round(time.monotonic() - self.started_at, 6))
+        line = json.dumps(item, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def record_message(self, out):
+        if isinstance(out, bytes):
+            self.write({"kind": "ws_binary", "data": base64.b64encode(out).decode('ascii')})
+        else:
+            self.write({"kind": "ws", "text": out})
+
+    def record_response(self, method, url, resp, request=None):
+        url = urlparse.urlparse(url)
+        item = {"kind": "http", "method": method, "path": url.path + (f"?{url.query}" if url.query else ''),
+                "status": resp.status_code, "elapsed": resp.elapsed.total_seconds()}
+        if request is not None:
+            item["request"] = request
+        if resp.headers.get('Content-Type', '').startswith('application/json'):
+            item["json"] = resp.json()
+        elif len(resp.content) > 0:
+            item["data"] = base64.b64encode(resp.content).decode('ascii')
+        self.write(item)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def open_recorder(server_addr, client_id):
+    # a recorder when COMFYFLOW_RECORD_DIR is set, None otherwise
+    if not RECORD_DIR:
+        return None
+    os.makedirs(RECORD_DIR, exist_ok=True)
+    return Recorder(os.path.join(RECORD_DIR, f"comfyui-{os.getpid()}-{client_id[:8]}.jsonl"), server_addr, client_id)
+
+
+class RecordedPrompt:
+    def __init__(self, prompt_id) -> None:
+        self.prompt_id = prompt_id
+        self.prompt = None
+        self.started_at = None
+        # [(seconds since the prompt's first message, raw websocket message)]
+        self.messages = []
+        self.history = None
+
+
+def load_recording(path):
+    """
+    read a recording, return (items, prompts, images): the recorded items in order, with
+    binary payloads decoded, the recorded prompts by id in the order they were queued, with
+    their websocket messages and history, and the fetched images by filename
+    """
+    items = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                if 'data' in item:
+                    item['data'] = base64.b64decode(item['data'])
+                items.append(item)
+
+    prompts = {}
+    images = {}
+    running_prompt_id = None
+    for item in items:
+        if item['kind'] == 'http':
+            path = urlparse.urlparse(item['path'])
+            if item['method'] == 'POST' and path.path == '/prompt' and 'prompt_id' in item.get('json', {}):
+                prompt = prompts.setdefault(item['json']['prompt_id'], RecordedPrompt(item['json']['prompt_id']))
+                prompt.prompt = item.get('request', {}).get('prompt')
+            elif item['method'] == 'GET' and path.path.startswith('/history/') and item.get('json'):
+                for prompt_id, history in item['json'].items():
+                    prompts.setdefault(prompt_id, RecordedPrompt(prompt_id)).history = history
+            elif item['method'] == 'GET' and path.path == '/view' and 'data' in item:
+                images[urlparse.parse_qs(path.query).get('filename', [''])[0]] = item['data']
+            continue
+        if item['kind'] not in ('ws', 'ws_binary'):
+            continue
+
+        # the owner of a message, as ComfyClient._handle_message finds it
+        prompt_id = running_prompt_id
+        if item['kind'] == 'ws':
+            message = json.loads(item['text'])
+            data = message.get('data')
+            if message['type'] == 'status':
+                continue
+            if isinstance(data, dict) and data.get('prompt_id'):
+                prompt_id = data['prompt_id']
+            if message['type'] in ('execution_start', 'executing'):
+                running_prompt_id = prompt_id if not (message['type'] == 'executing' and data.get('node') is None) else None
+        if prompt_id is None:
+            continue
+        prompt = prompts.setdefault(prompt_id, RecordedPrompt(prompt_id))
+        if prompt.started_at is None:
+            prompt.started_at = item['t']
+        prompt.messages.append((item['t'] - prompt.started_at, item.get('text', item.get('data'))))
+    return items, {prompt_id: prompt for prompt_id, prompt in prompts.items() if len(prompt.messages) > 0}, images
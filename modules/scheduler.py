@@ -0,0 +1,762 @@
+"""
+Fair-share job scheduler in front of the comfyui queues.
+
+ComfyUI runs a single fifo queue per server, so prompts are held here and released
+to a backend only while it has fewer than max_inflight prompts. Pending jobs are
+picked by priority class first and round-robin over users inside a class, each user
+may hold at most user_quota pending and running jobs.
+
+Loading a checkpoint takes seconds, so among the first model_window jobs of the fair
+order a job whose models are already loaded on a free backend goes first; a job passed
+over model_window times is dispatched next regardless of its models.
+
+Jobs are cancelled when their generation is superseded or their browser session has
+been gone for SESSION_GRACE seconds; a dispatched prompt is deleted from the comfyui
+queue, or interrupted if it is the one running.
+
+A job may be pinned to one backend, model warm-ups are, and then waits for it, or be
+limited to the backends its prompt validated on.
+
+Identical jobs, by the hash of the canonical bound prompt and uploaded files, run once:
+a later job follows the pending or running leader and gets its events and outputs.
+
+Uploads are stored on the backend under content-hash names and referenced by the jobs
+reading them, see artifacts.ArtifactCollector; comfyui history entries are deleted
+once the outputs are collected.
+
+The scheduler owns a job from submission to output collection, independent of the
+streamlit script run: pages subscribe to a job by id, and job state is saved in the
+jobs table so running prompts are reattached through /history after a restart.
+"""
+
+import time
+import uuid
+import json
+import hashlib
+import threading
+from enum import Enum, IntEnum
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from loguru import logger
+from modules.prompt_graph import prompt_models
+from modules.profiler import NodeTimer
+from modules import tracing
+from modules.artifacts import ArtifactCollector, upload_name
+from modules import metrics
+from modules.image_preview import encode_preview
+
+# seconds between checks for jobs of closed sessions, and how long a session may be disconnected
+SESSION_CHECK_INTERVAL = 5
+SESSION_GRACE = 30
+# finished jobs kept in memory for pages to look up, older ones are read from the jobs table
+MAX_RECENT_JOBS = 256
+# threads fetching the history of finished prompts
+COLLECT_WORKERS = 4
+# seconds between deletions of expired uploads and outputs on the backends
+ARTIFACT_GC_INTERVAL = 60
+# seconds between deletions of old rows from the jobs and node timings tables
+JOB_PRUNE_INTERVAL = 3600
+
+
+class JobPriority(IntEnum):
+    # lower value is dispatched first
+    INTERACTIVE = 0
+    BATCH = 1
+    BACKGROUND = 2
+
+
+class JobStatus(Enum):
+    PENDING = "Pending"
+    RUNNING = "Running"
+    FINISHED = "Finished"
+    FAILED = "Failed"
+    CANCELLED = "Cancelled"
+
+
+class QuotaExceededError(Exception):
+    pass
+
+
+def is_active_session(session_id):
+    # a session is active while its browser tab is connected
+    from streamlit.runtime import Runtime
+    if not Runtime.exists():
+        return True
+    return Runtime.instance().is_active_session(session_id)
+
+
+def prompt_key(prompt, uploads):
+    # canonical json of the bound prompt, uploads are referenced by name so their content counts too
+    digest = hashlib.sha256(json.dumps(prompt, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    for filename, data, subfolder in sorted(uploads, key=lambda upload: (upload[2], upload[0])):
+        digest.update(f"{subfolder}/{filename}".encode('utf-8'))
+        digest.update(hashlib.sha256(data).digest())
+    return digest.hexdigest()
+
+
+class Job:
+    def __init__(self, user, prompt, priority=JobPriority.INTERACTIVE, uploads=None, label=None, session_id=None, app=None, inputs=None, pinned_backend=None, trace_id=None, allowed_backends=None):
+        self.job_id = str(uuid.uuid4())
+        # the generation the job belongs to, for correlating logs and trace spans
+        self.trace_id = trace_id or tracing.new_trace_id()
+        self.user = user
+        self.app = app
+        # streamlit session that waits for the job, None for jobs nobody watches
+        self.session_id = session_id
+        self.prompt = prompt
+        # event queues of the pages watching the job, events are forwarded with the job id
+        self.subscribers = []
+        self.priority = priority
+        # [(filename, data, subfolder)], uploaded to the backend the job is dispatched to
+        self.uploads = uploads or []
+        # [(subfolder, name)] of the uploads on the backend while the job holds them
+        self.upload_refs = []
+        self.label = label
+        # widget values of the app inputs, to reuse from the result gallery
+        self.inputs = inputs
+        self.models = prompt_models(prompt)
+        # a job pinned to a backend, e.g. a model warm-up, runs there and only follows jobs pinned the same
+        self.pinned_backend = pinned_backend
+        self.key = prompt_key(prompt, self.uploads) if pinned_backend is None else f"{prompt_key(prompt, self.uploads)}@{pinned_backend}"
+        # backends the job may run on, None for any
+        if pinned_backend is not None:
+            self.backends = frozenset([pinned_backend])
+        else:
+            self.backends = frozenset(allowed_backends) if allowed_backends is not None else None
+        # single flight, a follower shares the prompt of its leader
+        self.leader = None
+        self.followers = []
+        # times a later job was dispatched first because its models were loaded
+        self.skipped = 0
+        self.status = JobStatus.PENDING
+        self.error = None
+        self.backend = None
+        self.client = None
+        self.prompt_id = None
+        # nodes executed or cached so far, and the history outputs once finished {node_id: output}
+        self.executed = set()
+        self.outputs = {}
+        # (filename, subfolder, type) -> future of (preview, original), output images downloaded
+        # once for the page and the gallery, dropped once the gallery has saved them
+        self.images = {}
+        self.images_lock = threading.Lock()
+        # per node durations of the run, saved for the app's profile
+        self.timer = NodeTimer(prompt)
+        self.released = False
+        self.scheduler = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.prompt_done_at = None
+        self.finished_at = None
+
+    def fetch_image(self, image):
+        """
+        download an output image and encode its preview, once per job, followers share the
+        downloads of their leader; returns (preview, original)
+        """
+        owner = self.leader or self
+        key = (image['filename'], image['subfolder'], image['type'])
+        with owner.images_lock:
+            future = owner.images.get(key)
+            fetch = future is None
+            if fetch:
+                future = owner.images[key] = Future()
+        if not fetch:
+            return future.result()
+        try:
+            with tracing.span("download_image", self.trace_id, track=self.job_id, filename=image['filename']):
+                original = self.client.get_image(image['filename'], image['subfolder'], image['type'])
+        except Exception as e:
+            # a later call downloads again
+            with owner.images_lock:
+                owner.images.pop(key, None)
+            future.set_exception(e)
+            raise
+        try:
+            with tracing.span("encode_preview", self.trace_id, track=self.job_id, filename=image['filename']):
+                preview = encode_preview(original)
+        except Exception as e:
+            logger.warning(f"Failed to encode preview of {image['filename']}, {e}")
+            preview = original
+        future.set_result((preview, original))
+        return preview, original
+
+    def runs_on(self, backend):
+        return self.backends is None or backend in self.backends
+
+    @property
+    def done(self):
+        return self.status in (JobStatus.FINISHED, JobStatus.FAILED, JobStatus.CANCELLED)
+
+    def put(self, event):
+        # the job is the subscriber of its comfyui prompt
+        if self.status == JobStatus.CANCELLED:
+            return
+        if self.prompt_id is None and event.get('prompt_id') is not None:
+            # events replayed on subscribe may come before gen_images returns
+            self.prompt_id = event['prompt_id']
+        event_type = event['type']
+        self.timer.put(event)
+        if event_type not in ('b_preview', 'progress', 'status'):
+            tracing.instant(f"ws {event_type}", self.trace_id, track=self.job_id, node=event['data'] if event_type == 'executing' else None)
+        if event_type == 'execution_error':
+            self.error = event['data'].get('exception_message', 'execution error')
+        elif event_type == 'execution_cached':
+            self.executed.update(event['data']['nodes'])
+            metrics.CACHE_REQUESTS.inc(len(event['data']['nodes']), cache='node', result='hit')
+        elif event_type == 'executing' and event['data'] is not None:
+            self.executed.add(event['data'])
+            metrics.cache_hit('node', False)
+        self.scheduler.publish(self, event)
+        if event_type == 'executing' and event['data'] is None:
+            self.scheduler.finish(self)
+
+    @classmethod
+    def from_row(cls, row, client):
+        # a job restored from the jobs table
+        job = cls(row.username, json.loads(row.prompt or '{}'), label=row.label, app=row.app)
+        job.job_id = row.id
+        job.status = JobStatus(row.status)
+        job.client = client
+        job.prompt_id = row.prompt_id
+        job.outputs = json.loads(row.outputs or '{}')
+        job.error = row.error
+        return job
+
+
+class JobScheduler:
+    def __init__(self, clients, max_inflight=2, user_quota=64, model_window=8, job_model=None, gallery=None, artifacts=None) -> None:
+        self.clients = clients
+        self.job_model = job_model
+        self.gallery = gallery
+        self.artifacts = artifacts if artifacts is not None else ArtifactCollector(len(clients))
+        self.artifacts_collected_at = time.time()
+        # websocket reconnects of each backend's client seen so far
+        self.backend_reconnects = [client.reconnects for client in clients]
+        # the job model prunes once on creation
+        self.jobs_pruned_at = time.time()
+        self.max_inflight = max_inflight
+        self.user_quota = user_quota
+        self.model_window = max(model_window, 1)
+        self.cond = threading.Condition()
+        # priority -> user -> pending jobs, a user moves to the end after each pick
+        self.pending = {priority: OrderedDict() for priority in JobPriority}
+        self.inflight = [set() for _ in clients]
+        # models of the job last dispatched to each backend, likely still in vram
+        self.backend_models = [frozenset() for _ in clients]
+        self.user_jobs = {}
+        # prompt key -> leader job, pending or running
+        self.flights = {}
+        # job_id -> job, unfinished jobs and the most recent finished ones
+        self.jobs = OrderedDict()
+        self.collector = ThreadPoolExecutor(max_workers=COLLECT_WORKERS)
+        # session_id -> first time seen disconnected
+        self.inactive_sessions = {}
+        self.session_checked_at = time.time()
+        # read before any job of this process is saved
+        unfinished_jobs = job_model.get_unfinished_jobs() if job_model is not None else []
+        self.thread = threading.Thread(target=self._dispatch_loop, args=(unfinished_jobs,), daemon=True)
+        self.thread.start()
+        logger.info(f"Job scheduler, backends {[client.server_addr for client in clients]}, max inflight {max_inflight}, user quota {user_quota}")
+
+    def submit(self, jobs):
+        """
+        admit all jobs or none, raise QuotaExceededError if the user would exceed the quota
+        """
+        if len(jobs) == 0:
+            return jobs
+        user = jobs[0].user
+        with self.cond:
+            # identical jobs of the same batch follow the first of them, only leaders count
+            new_keys = {job.key for job in jobs if job.key not in self.flights}
+            count = self.user_jobs.get(user, 0)
+            if count + len(new_keys) > self.user_quota:
+                raise QuotaExceededError(f"user {user} has {count} jobs, quota {self.user_quota}")
+            leaders = 0
+            for job in jobs:
+                job.scheduler = self
+                self.jobs[job.job_id] = job
+                metrics.cache_hit('single_flight', job.key in self.flights)
+                if job.key in self.flights:
+                    self._follow(self.flights[job.key], job)
+                else:
+                    self.flights[job.key] = job
+                    self.pending[job.priority].setdefault(job.user, deque()).append(job)
+                    leaders += 1
+            if leaders > 0:
+                self.user_jobs[user] = count + leaders
+            self.cond.notify()
+        self._save('create_jobs', jobs)
+        logger.info(f"Submit jobs, user {user}, count {len(jobs)}, deduplicated {len(jobs) - leaders}, priority {jobs[0].priority.name}, trace {jobs[0].trace_id}")
+        return jobs
+
+    def get_job(self, job_id):
+        with self.cond:
+            job = self.jobs.get(job_id)
+        if job is not None or self.job_model is None:
+            return job
+        row = self.job_model.get_job(job_id)
+        if row is None:
+            return None
+        return Job.from_row(row, self.get_client(row.server_addr))
+
+    def recent_jobs(self):
+        with self.cond:
+            return list(self.jobs.values())
+
+    def get_client(self, server_addr):
+        for client in self.clients:
+            if client.server_addr == server_addr:
+                return client
+        return None
+
+    def subscribe(self, job, queue):
+        """
+        forward the events of an unfinished job to queue, return False if the job is done
+        """
+        with self.cond:
+            if job.done:
+                return False
+            job.subscribers.append(queue)
+            return True
+
+    def unsubscribe(self, job, queue):
+        with self.cond:
+            if queue in job.subscribers:
+                job.subscribers.remove(queue)
+
+    def publish(self, job, event):
+        with self.cond:
+            targets = [(job.job_id, queue) for queue in job.subscribers]
+            for follower in job.followers:
+                follower.client = job.client
+                follower.prompt_id = job.prompt_id
+                follower.error = job.error
+                follower.executed = job.executed
+                targets.extend((follower.job_id, queue) for queue in follower.subscribers)
+        for job_id, queue in targets:
+            queue.put(dict(event, job_id=job_id))
+
+    def _follow(self, leader, job):
+        job.leader = leader
+        job.status = leader.status
+        job.client = leader.client
+        job.prompt_id = leader.prompt_id
+        leader.followers.append(job)
+        if leader.status == JobStatus.PENDING and job.priority < leader.priority:
+            # an interactive follower lifts a pending batch leader into its class
+            users = self.pending[leader.priority]
+            users[leader.user].remove(leader)
+            if len(users[leader.user]) == 0:
+                users.pop(leader.user)
+            leader.priority = job.priority
+            self.pending[leader.priority].setdefault(leader.user, deque()).append(leader)
+        logger.info(f"Job {job.job_id} follows {leader.job_id}, prompt {leader.prompt_id}")
+
+    def pending_count(self):
+        with self.cond:
+            return self._pending_count()
+
+    def backend_jobs(self):
+        # metrics gauge, running jobs per backend and the local queue
+        with self.cond:
+            jobs = {(client.server_addr, 'running'): len(self.inflight[backend]) for backend, client in enumerate(self.clients)}
+            jobs[('local', 'pending')] = self._pending_count()
+            return jobs
+
+    def inflight_count(self):
+        with self.cond:
+            return sum(len(jobs) for jobs in self.inflight)
+
+    def is_backend_idle(self, backend):
+        with self.cond:
+            return len(self.inflight[backend]) == 0 and self._pending_count() == 0
+
+    def backend_has_models(self, backend, models):
+        with self.cond:
+            return models <= self.backend_models[backend]
+
+    def _check_restarts(self):
+        # comfyui drops the websocket when it restarts, a reconnected backend is taken as restarted
+        for backend, client in enumerate(self.clients):
+            if client.reconnects != self.backend_reconnects[backend]:
+                self.backend_reconnects[backend] = client.reconnects
+                logger.info(f"Backend {client.server_addr} reconnected, reset its models and uploads")
+                self.reset_backend(backend)
+
+    def reset_backend(self, backend):
+        # the backend restarted, no model is loaded and files uploaded before are gone
+        with self.cond:
+            self.backend_models[backend] = frozenset()
+        self.artifacts.reset(backend)
+
+    def finish(self, job):
+        # the prompt is done, free its backend slot and collect the outputs in the background
+        with self.cond:
+            if job.done or job.released:
+                return
+            self._release(job)
+        job.prompt_done_at = time.time()
+        if job.started_at is not None:
+            metrics.EXECUTION.observe(job.prompt_done_at - job.started_at, app=job.app)
+            tracing.record("execution", job.trace_id, job.started_at, job.prompt_done_at, track=job.job_id, prompt_id=job.prompt_id)
+        logger.info(f"Job prompt done, {job.job_id}, prompt {job.prompt_id}")
+        self.collector.submit(self._collect, job)
+
+    def _collect(self, job):
+        try:
+            if job.error is None and job.prompt_id is not None:
+                with tracing.span("get_history", job.trace_id, track=job.job_id):
+                    history = job.client.get_history(job.prompt_id).get(job.prompt_id, {})
+                job.outputs = history.get('outputs', {})
+        except Exception as e:
+            logger.error(f"Failed to collect outputs of job {job.job_id}, {e}")
+            job.error = f"failed to collect outputs, {e}"
+        if job.prompt_id is not None and job.backend is not None:
+            self.artifacts.track_outputs(job.backend, job.outputs)
+            try:
+                # outputs are kept in the jobs table, the history only slows down /history
+                job.client.delete_history([job.prompt_id])
+            except Exception as e:
+                logger.warning(f"Failed to delete history of job {job.job_id}, {e}")
+        metrics.OUTPUT_FETCH.observe(time.time() - job.prompt_done_at, app=job.app)
+        with self.cond:
+            if job.status == JobStatus.CANCELLED:
+                return
+            self._set_status(job, JobStatus.FAILED if job.error else JobStatus.FINISHED)
+            for follower in job.followers:
+                follower.outputs = job.outputs
+                follower.error = job.error
+        for done_job in [job] + job.followers:
+            metrics.END_TO_END.observe(done_job.finished_at - done_job.created_at, app=done_job.app, status=done_job.status.value)
+            tracing.record("job", done_job.trace_id, done_job.created_at, done_job.finished_at, track=done_job.job_id,
+                           job_id=done_job.job_id, app=done_job.app, label=done_job.label, status=done_job.status.value, leader=job.job_id)
+        self._save('update_jobs_finished', [job] + job.followers)
+        if job.app is not None and job.error is None and len(job.timer.records) > 0:
+            self._save('create_node_timings', job)
+        logger.info(f"Job finished, {job.job_id}, {job.status.name}, prompt {job.prompt_id}, outputs {list(job.outputs.keys())}")
+        self.publish(job, {"type": "job_finished", "data": job.status.value, "prompt_id": job.prompt_id})
+        # saved after the result is published, the page fetches outputs missing from the gallery itself
+        if self.gallery is not None and job.error is None:
+            try:
+                with tracing.span("gallery_save", job.trace_id, track=job.job_id):
+                    self.gallery.save([job] + job.followers)
+            except Exception as e:
+                logger.error(f"Failed to save job {job.job_id} to gallery, {e}")
+        with job.images_lock:
+            # later views read the gallery entry, or download again
+            job.images = {}
+
+    def cancel(self, job, reason="cancelled"):
+        """
+        drop a pending job, or delete a dispatched prompt from the comfyui queue and interrupt it
+        if it is running; the session queue gets a job_cancelled event.
+        the prompt of a job with followers keeps running for them, a leader left without
+        anyone waiting is cancelled with its last follower
+        """
+        with self.cond:
+            if job.status not in (JobStatus.PENDING, JobStatus.RUNNING):
+                return False
+            leader = job.leader
+            orphaned = len(job.followers) > 0 and job.session_id is not None
+            subscribers = list(job.subscribers)
+            if leader is not None:
+                leader.followers.remove(job)
+                job.status = JobStatus.CANCELLED
+                job.finished_at = time.time()
+                job.subscribers = []
+                orphaned = False
+            elif orphaned:
+                job.session_id = None
+                job.subscribers = []
+        if leader is not None or orphaned:
+            logger.info(f"Cancel job {job.job_id}, {reason}, shared prompt {job.prompt_id} continues")
+            if leader is not None:
+                self._save('update_jobs_finished', [job])
+            for queue in subscribers:
+                queue.put({"type": "job_cancelled", "data": reason, "prompt_id": job.prompt_id, "job_id": job.job_id})
+            if leader is not None and len(leader.followers) == 0 and leader.session_id is None:
+                self.cancel(leader, "no one waiting")
+            return True
+
+        with self.cond:
+            if job.status == JobStatus.PENDING:
+                users = self.pending[job.priority]
+                users[job.user].remove(job)
+                if len(users[job.user]) == 0:
+                    users.pop(job.user)
+            elif job.status != JobStatus.RUNNING:
+                return False
+            dispatched = job.prompt_id is not None and not job.released
+            self._release(job)
+            self._set_status(job, JobStatus.CANCELLED)
+            targets = [(cancelled.job_id, queue) for cancelled in [job] + job.followers for queue in cancelled.subscribers]
+        logger.info(f"Cancel job {job.job_id}, {reason}, prompt {job.prompt_id}")
+
+        # a job still being dispatched is cancelled by _start once the prompt id is known
+        if dispatched:
+            self._cancel_prompt(job)
+        self._save('update_jobs_finished', [job] + job.followers)
+        for job_id, queue in targets:
+            queue.put({"type": "job_cancelled", "data": reason, "prompt_id": job.prompt_id, "job_id": job_id})
+        return True
+
+    def _set_status(self, job, status):
+        # terminal status of a job and its followers, finished jobs age out of memory
+        for done_job in [job] + job.followers:
+            done_job.status = status
+            done_job.finished_at = time.time()
+            if done_job.job_id in self.jobs:
+                self.jobs.move_to_end(done_job.job_id)
+        done_jobs = [job_id for job_id, done_job in self.jobs.items() if done_job.done]
+        for job_id in done_jobs[:max(len(done_jobs) - MAX_RECENT_JOBS, 0)]:
+            self.jobs.pop(job_id)
+
+    def _release(self, job):
+        # free the backend slot, quota and flight of a job once
+        if job.released:
+            return
+        job.released = True
+        if self.flights.get(job.key) is job:
+            self.flights.pop(job.key)
+        if job.backend is not None:
+            self.inflight[job.backend].discard(job)
+            for subfolder, name in job.upload_refs:
+                self.artifacts.release(job.backend, subfolder, name)
+            job.upload_refs = []
+        count = self.user_jobs.get(job.user, 1) - 1
+        if count > 0:
+            self.user_jobs[job.user] = count
+        else:
+            self.user_jobs.pop(job.user, None)
+        self.cond.notify()
+
+    def _cancel_prompt(self, job):
+        try:
+            job.client.cancel_prompt(job.prompt_id)
+        except Exception as e:
+            logger.warning(f"Failed to cancel prompt {job.prompt_id} on {job.client.server_addr}, {e}")
+
+    def _cancel_abandoned(self):
+        now = time.time()
+        if now - self.session_checked_at < SESSION_CHECK_INTERVAL:
+            return
+        self.session_checked_at = now
+        with self.cond:
+            jobs = [job for users in self.pending.values() for user_jobs in users.values() for job in user_jobs]
+            jobs.extend(job for backend_jobs in self.inflight for job in backend_jobs)
+            jobs.extend(follower for job in list(jobs) for follower in job.followers)
+        session_ids = set(job.session_id for job in jobs if job.session_id is not None)
+
+        closed_sessions = set()
+        for session_id in session_ids:
+            if is_active_session(session_id):
+                self.inactive_sessions.pop(session_id, None)
+            elif now - self.inactive_sessions.setdefault(session_id, now) >= SESSION_GRACE:
+                closed_sessions.add(session_id)
+        for session_id in list(self.inactive_sessions):
+            if session_id not in session_ids:
+                self.inactive_sessions.pop(session_id)
+
+        for job in jobs:
+            if job.session_id in closed_sessions:
+                self.cancel(job, "session closed")
+
+    def _pending_count(self):
+        return sum(len(jobs) for users in self.pending.values() for jobs in users.values())
+
+    def _fair_window(self):
+        # first model_window jobs of the highest priority class, in round-robin user order
+        for priority in JobPriority:
+            users = self.pending[priority]
+            if len(users) == 0:
+                continue
+            window = []
+            depth = 0
+            while len(window) < self.model_window:
+                layer = [jobs[depth] for jobs in users.values() if len(jobs) > depth]
+                if len(layer) == 0:
+                    break
+                window.extend(layer)
+                depth += 1
+            return users, window[:self.model_window]
+        return None, []
+
+    def _free_backends(self):
+        backends = [backend for backend, jobs in enumerate(self.inflight) if len(jobs) < self.max_inflight]
+        return sorted(backends, key=lambda backend: len(self.inflight[backend]))
+
+    def _select(self, backends):
+        users, window = self._fair_window()
+        # jobs limited to busy backends wait for them
+        window = [job for job in window if any(job.runs_on(backend) for backend in backends)]
+        if len(window) == 0:
+            return None, None
+        job = window[0]
+        if job.skipped < self.model_window:
+            # a job whose models are loaded on a free backend, else the fair head on the warmest backend
+            warm = [(candidate, backend) for candidate in window for backend in backends
+                    if candidate.models and candidate.models <= self.backend_models[backend]
+                    and candidate.runs_on(backend)]
+            if len(warm) > 0:
+                job, backend = warm[0]
+            else:
+                backend = max([backend for backend in backends if job.runs_on(backend)],
+                              key=lambda backend: len(job.models & self.backend_models[backend]))
+        else:
+            backend = [backend for backend in backends if job.runs_on(backend)][0]
+        for candidate in window[:window.index(job)]:
+            candidate.skipped += 1
+
+        # the served user moves to the end of the round-robin
+        jobs = users.pop(job.user)
+        jobs.remove(job)
+        if len(jobs) > 0:
+            users[job.user] = jobs
+        return job, backend
+
+    def _dispatch_loop(self, unfinished_jobs):
+        try:
+            self._reattach(unfinished_jobs)
+        except Exception as e:
+            logger.error(f"Failed to reattach unfinished jobs, {e}")
+        while True:
+            job = None
+            with self.cond:
+                backends = self._free_backends()
+                if len(backends) > 0 and self._pending_count() > 0:
+                    job, backend = self._select(backends)
+                if job is not None:
+                    if job.models:
+                        self.backend_models[backend] = job.models
+                    job.status = JobStatus.RUNNING
+                    job.backend = backend
+                    job.client = self.clients[backend]
+                    job.started_at = time.time()
+                    metrics.QUEUE_WAIT.observe(job.started_at - job.created_at, app=job.app)
+                    tracing.record("queue_wait", job.trace_id, job.created_at, job.started_at, track=job.job_id, backend=backend)
+                    self.inflight[backend].add(job)
+                    for follower in job.followers:
+                        follower.status = JobStatus.RUNNING
+                        follower.client = job.client
+                else:
+                    self.cond.wait(SESSION_CHECK_INTERVAL)
+            if job is not None:
+                self._start(job)
+            try:
+                self._cancel_abandoned()
+            except Exception as e:
+                logger.error(f"Failed to check abandoned jobs, {e}")
+            self._check_restarts()
+            if time.time() - self.artifacts_collected_at > ARTIFACT_GC_INTERVAL:
+                self.artifacts_collected_at = time.time()
+                try:
+                    self.artifacts.collect()
+                except Exception as e:
+                    logger.error(f"Failed to collect artifacts, {e}")
+            if time.time() - self.jobs_pruned_at > JOB_PRUNE_INTERVAL:
+                self.jobs_pruned_at = time.time()
+                self._save('prune')
+
+    def _start(self, job):
+        try:
+            with tracing.span("upload", job.trace_id, track=job.job_id, files=len(job.uploads)):
+                prompt = self._upload(job)
+            with tracing.span("queue_prompt", job.trace_id, track=job.job_id, server=job.client.server_addr):
+                prompt_id = job.client.gen_images(prompt, job)
+            with self.cond:
+                job.prompt_id = prompt_id
+                cancelled = job.status == JobStatus.CANCELLED
+            if cancelled:
+                logger.info(f"Job {job.job_id} cancelled while dispatching, prompt {prompt_id}")
+                self._cancel_prompt(job)
+                return
+            self._save('update_job_started', job)
+            logger.info(f"Dispatch job {job.job_id} to {job.client.server_addr}, prompt {job.prompt_id}, trace {job.trace_id}, models {sorted(job.models)}, waited {job.started_at - job.created_at:.2f}s")
+        except Exception as e:
+            logger.error(f"Failed to dispatch job {job.job_id}, {e}")
+            job.put({"type": "execution_error", "data": {"exception_message": str(e)}, "prompt_id": None})
+            job.put({"type": "executing", "data": None, "prompt_id": None})
+
+    def _save(self, method, *args):
+        # the jobs table is best effort, a database error never stops scheduling
+        if self.job_model is None:
+            return
+        try:
+            getattr(self.job_model, method)(*args)
+        except Exception as e:
+            logger.error(f"Failed to save jobs, {method}, {e}")
+
+    def _reattach(self, rows):
+        """
+        jobs left unfinished by the previous process: prompts still queued or running on
+        their backend are followed again, finished ones collected from /history
+        """
+        for row in rows:
+            client = self.get_client(row.server_addr)
+            job = Job.from_row(row, client)
+            job.scheduler = self
+            if job.status == JobStatus.PENDING or client is None or job.prompt_id is None:
+                job.status = JobStatus.CANCELLED
+                job.error = "not dispatched before restart"
+                self._save('update_jobs_finished', [job])
+                continue
+            # registered before subscribing, an event finishing the prompt releases it
+            with self.cond:
+                job.status = JobStatus.RUNNING
+                job.backend = self.clients.index(client)
+                self.jobs[job.job_id] = job
+                self.inflight[job.backend].add(job)
+                self.user_jobs[job.user] = self.user_jobs.get(job.user, 0) + 1
+            try:
+                client._ensure_event_loop()
+                client.subscribe(job.prompt_id, job, poll=True)
+                history = client.get_history(job.prompt_id)
+                queue = client.get_queue()
+            except Exception as e:
+                logger.error(f"Failed to reattach job {job.job_id} to {row.server_addr}, {e}")
+                client.unsubscribe(job.prompt_id, job)
+                with self.cond:
+                    self._release(job)
+                    self.jobs.pop(job.job_id, None)
+                continue
+            queued_ids = [item[1] for item in queue['queue_running'] + queue['queue_pending']]
+            if job.prompt_id in history:
+                client.unsubscribe(job.prompt_id, job)
+                self.finish(job)
+            elif job.prompt_id not in queued_ids and not job.released:
+                client.unsubscribe(job.prompt_id, job)
+                job.error = "prompt lost after restart"
+                self.finish(job)
+            logger.info(f"Reattach job {job.job_id}, prompt {job.prompt_id} on {row.server_addr}")
+
+    def _upload(self, job):
+        """
+        upload the files of a job under content-hash names, return the prompt to queue
+        with the file names replaced
+        """
+        names = {}
+        for filename, data, subfolder in job.uploads:
+            name = upload_name(filename, data)
+            uploaded = self.artifacts.is_uploaded(job.backend, subfolder, name)
+            metrics.cache_hit('upload', uploaded)
+            if not uploaded:
+                job.client.upload_image({'image': (name, data)}, subfolder, "input", 'true')
+                metrics.UPLOAD_BYTES.inc(len(data), backend=job.client.server_addr)
+            self.artifacts.acquire(job.backend, subfolder, name, created=not uploaded)
+            with self.cond:
+                if job.released:
+                    # cancelled while uploading
+                    self.artifacts.release(job.backend, subfolder, name)
+                else:
+                    job.upload_refs.append((subfolder, name))
+            names[filename] = name
+            if subfolder:
+                names[f"{subfolder}/{filename}"] = f"{subfolder}/{name}"
+        if len(names) == 0:
+            return job.prompt
+        prompt = {}
+        for node_id, node in job.prompt.items():
+            inputs = {param: names.get(value, value) if isinstance(value, str) else value for param, value in node['inputs'].items()}
+            prompt[node_id] = dict(node, inputs=inputs)
+        return prompt
@@ -0,0 +1,102 @@
+"""
+Generation timeline tracing.
+
+A generation gets a trace id when the button is clicked; the id goes with its jobs
+through validation, uploads, queue_prompt, the websocket events, the history fetch and
+the image downloads. Each step is written as a chrome trace event, one json object per
+line, to a rotating file per process in COMFYFLOW_TRACE_DIR. Tracing is off without it.
+
+Complete events ("ph": "X") carry ts and dur in microseconds; the events of a job are
+on their own track, tid derived from the job id. To open a file in chrome://tracing or
+perfetto, wrap its lines into a json array, e.g. jq -s . trace-1234.jsonl > trace.json
+"""
+
+import os
+import json
+import time
+import uuid
+import zlib
+import logging
+import threading
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+TRACE_DIR = os.getenv('COMFYFLOW_TRACE_DIR', '')
+TRACE_MAX_BYTES = int(os.getenv('COMFYFLOW_TRACE_MAX_MB', '50')) * 1024 * 1024
+TRACE_BACKUPS = 5
+
+_trace_logger = None
+_lock = threading.Lock()
+
+
+def get_trace_logger():
+    global _trace_logger
+    if not TRACE_DIR:
+        return None
+    with _lock:
+        if _trace_logger is None:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+            handler = RotatingFileHandler(os.path.join(TRACE_DIR, f"trace-{os.getpid()}.jsonl"),
+                                          maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUPS, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            trace_logger = logging.getLogger('comfyflow.trace')
+            trace_logger.setLevel(logging.INFO)
+            trace_logger.propagate = False
+            trace_logger.addHandler(handler)
+            _trace_logger = trace_logger
+    return _trace_logger
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def track_id(key):
+    # a stable integer track for a job id, the current thread otherwise
+    return zlib.crc32(key.encode('utf-8')) if key else threading.get_ident()
+
+
+def record(name, trace_id, start, end, track=None, **args):
+    """
+    write a complete event from start to end, both time.time() seconds
+    """
+    trace_logger = get_trace_logger()
+    if trace_logger is None or start is None or end is None:
+        return
+    event = {
+        'name': name,
+        'cat': 'comfyflow',
+        'ph': 'X',
+        'ts': int(start * 1e6),
+        'dur': max(int((end - start) * 1e6), 0),
+        'pid': os.getpid(),
+        'tid': track_id(track),
+        'args': dict(args, trace_id=trace_id),
+    }
+    trace_logger.info(json.dumps(event, ensure_ascii=False, default=str))
+
+
+def instant(name, trace_id, track=None, **args):
+    trace_logger = get_trace_logger()
+    if trace_logger is None:
+        return
+    event = {
+        'name': name,
+        'cat': 'comfyflow',
+        'ph': 'i',
+        's': 't',
+        'ts': int(time.time() * 1e6),
+        'pid': os.getpid(),
+        'tid': track_id(track),
+        'args': dict(args, trace_id=trace_id),
+    }
+    trace_logger.info(json.dumps(event, ensure_ascii=False, default=str))
+
+
+@contextmanager
+def span(name, trace_id, track=None, **args):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, trace_id, start, time.time(), track, **args)
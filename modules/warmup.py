@@ -0,0 +1,121 @@
+"""
+Model warm-up for installed apps.
+
+The first run of an app after it is installed, or after a comfyui backend restarts,
+pays the checkpoint load time inside the user's request. The warmer submits the
+cheapest variant of the app prompt, see prompt_graph.warmup_prompt, as a background
+job pinned to a backend:
+
+- when an app is registered, on install and when its app process starts
+- when a backend comes back after being unreachable
+- every interval seconds for hot apps, apps run in the last interval, on idle backends
+  that don't have their models loaded
+
+Warm-up jobs have no app, they are not kept in the result gallery.
+"""
+
+import time
+import threading
+from loguru import logger
+from modules.prompt_graph import warmup_prompt, prompt_models
+from modules.scheduler import Job, JobPriority, QuotaExceededError
+
+WARMUP_USER = '__warmup__'
+# seconds between backend liveness checks
+BACKEND_CHECK_INTERVAL = 10
+
+
+class ModelWarmer:
+    def __init__(self, scheduler, interval) -> None:
+        self.scheduler = scheduler
+        self.interval = interval
+        self.lock = threading.Lock()
+        # app name -> warm-up prompt
+        self.apps = {}
+        self.backend_alive = [True for _ in scheduler.clients]
+        self.warmed_at = time.time()
+        self.thread = threading.Thread(target=self._warmup_loop, daemon=True)
+        self.thread.start()
+        logger.info(f"Model warmer, interval {interval}s")
+
+    def register(self, app, api_prompt, output_node_ids):
+        """
+        keep the warm-up prompt of an app, the first registration warms it on all backends
+        """
+        with self.lock:
+            if app in self.apps:
+                return
+            prompt = warmup_prompt(api_prompt, output_node_ids)
+            self.apps[app] = prompt
+        if len(prompt_models(prompt)) == 0:
+            logger.info(f"App {app} loads no model, skip warm-up")
+            return
+        self.warm(app, range(len(self.scheduler.clients)))
+
+    def warm(self, app, backends):
+        with self.lock:
+            prompt = self.apps.get(app)
+        if prompt is None:
+            return
+        models = prompt_models(prompt)
+        jobs = [Job(WARMUP_USER, prompt, priority=JobPriority.BACKGROUND, label=f"warmup {app}", pinned_backend=backend)
+                for backend in backends if not self.scheduler.backend_has_models(backend, models)]
+        if len(jobs) == 0:
+            return
+        logger.info(f"Warm up app {app} on backends {[job.pinned_backend for job in jobs]}, models {sorted(models)}")
+        try:
+            self.scheduler.submit(jobs)
+        except QuotaExceededError as e:
+            logger.warning(f"Skip warm-up of app {app}, {e}")
+
+    def hot_apps(self, since):
+        # registered apps with jobs created since, most used first
+        counts = {}
+        for job in self.scheduler.recent_jobs():
+            if job.app in self.apps and job.created_at >= since:
+                counts[job.app] = counts.get(job.app, 0) + 1
+        return sorted(counts, key=counts.get, reverse=True)
+
+    def _check_backends(self):
+        for backend, client in enumerate(self.scheduler.clients):
+            try:
+                client.get_queue()
+                alive = True
+            except Exception:
+                alive = False
+            if alive and not self.backend_alive[backend]:
+                logger.info(f"Backend {client.server_addr} is back, warm up apps")
+                self.scheduler.reset_backend(backend)
+                with self.lock:
+                    apps = list(self.apps)
+                # only the hottest app, warm-ups of several apps would evict each other
+                for app in (self.hot_apps(self.warmed_at - self.interval) or apps)[:1]:
+                    self.warm(app, [backend])
+            self.backend_alive[backend] = alive
+
+    def _warm_hot_apps(self):
+        now = time.time()
+        if self.interval <= 0 or now - self.warmed_at < self.interval:
+            return
+        hot_apps = self.hot_apps(self.warmed_at)
+        self.warmed_at = now
+        # at most one app per idle backend, the hottest not loaded there, so warm-ups don't evict each other
+        warming = set()
+        for backend in range(len(self.scheduler.clients)):
+            if not self.backend_alive[backend] or not self.scheduler.is_backend_idle(backend):
+                continue
+            with self.lock:
+                cold_apps = [app for app in hot_apps if app not in warming
+                             and not self.scheduler.backend_has_models(backend, prompt_models(self.apps[app]))]
+            if len(cold_apps) > 0:
+                warming.add(cold_apps[0])
+                self.warm(cold_apps[0], [backend])
+
+    def _warmup_loop(self):
+        while True:
+            time.sleep(BACKEND_CHECK_INTERVAL)
+            try:
+                self._check_backends()
+                self._warm_hot_apps()
+            except Exception as e:
+                logger.error(f"Failed to warm up models, {e}")
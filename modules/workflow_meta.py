@@ -0,0 +1,208 @@
+"""
+Read the comfyui `prompt` and `workflow` metadata from uploaded files without decoding pixels.
+
+Supported uploads:
+    PNG, text chunks tEXt/iTXt/zTXt written by SaveImage, image data is skipped
+    WebP/JPEG, EXIF written by SaveAnimatedWEBP and similar nodes ("prompt:{...}", "workflow:{...}")
+    JSON, an API format prompt or a workflow exported from comfyui, utf-8 or utf-16, with or without bom
+"""
+
+import json
+import codecs
+import struct
+import zlib
+from loguru import logger
+
+META_KEYS = ('prompt', 'workflow')
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_TEXT_CHUNKS = (b'tEXt', b'iTXt', b'zTXt')
+
+EXIF_TAG_EXIF_IFD = 0x8769
+EXIF_TAG_USER_COMMENT = 0x9286
+EXIF_TYPE_ASCII = 2
+EXIF_TYPE_UNDEFINED = 7
+
+
+def read_workflow_meta(upload):
+    """
+    return a dict with the found keys of 'prompt' and 'workflow', the values are json text
+    """
+    upload.seek(0)
+    head = upload.read(12)
+    upload.seek(0)
+    try:
+        if head.startswith(PNG_SIGNATURE):
+            return _read_png_meta(upload)
+        elif head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            return _read_webp_meta(upload)
+        elif head.startswith(b'\xff\xd8'):
+            return _read_jpeg_meta(upload)
+        text = _json_text(upload.read())
+        if text is not None:
+            return _json_meta(text)
+        logger.warning(f"unknown workflow file format, {head}")
+        return {}
+    finally:
+        upload.seek(0)
+
+
+def is_api_prompt(data):
+    # api format: {node_id: {"class_type": ..., "inputs": {...}}}
+    return isinstance(data, dict) and len(data) > 0 and \
+        all(isinstance(node, dict) and 'class_type' in node for node in data.values())
+
+
+def _json_text(data):
+    # the text of a json file, after a byte order mark and leading whitespace of any length,
+    # None for other files
+    if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        encoding = 'utf-16'
+    else:
+        encoding = 'utf-8-sig'
+    try:
+        text = data.decode(encoding)
+    except UnicodeDecodeError:
+        return None
+    return text if text.lstrip().startswith('{') else None
+
+
+def _json_meta(text):
+    data = json.loads(text)
+    if is_api_prompt(data):
+        return {'prompt': text}
+    elif isinstance(data, dict) and 'nodes' in data and 'links' in data:
+        return {'workflow': text}
+    logger.warning("json is neither an api prompt nor a comfyui workflow")
+    return {}
+
+
+def _read_png_meta(f):
+    metas = {}
+    f.seek(len(PNG_SIGNATURE))
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IEND':
+            break
+        if chunk_type not in PNG_TEXT_CHUNKS:
+            # skip chunk data and crc, never touch the pixels
+            f.seek(length + 4, 1)
+            continue
+
+        data = f.read(length)
+        f.seek(4, 1)
+        keyword, _, text = data.partition(b'\x00')
+        keyword = keyword.decode('latin-1')
+        if keyword not in META_KEYS:
+            continue
+        if chunk_type == b'tEXt':
+            metas[keyword] = text.decode('latin-1')
+        elif chunk_type == b'zTXt':
+            metas[keyword] = zlib.decompress(text[1:]).decode('latin-1')
+        else:
+            # iTXt: compression flag, method, language\0, translated keyword\0, text
+            compressed = text[0] == 1
+            _, _, text = text[2:].partition(b'\x00')
+            _, _, text = text.partition(b'\x00')
+            if compressed:
+                text = zlib.decompress(text)
+            metas[keyword] = text.decode('utf-8')
+        if all(key in metas for key in META_KEYS):
+            break
+    return metas
+
+
+def _read_webp_meta(f):
+    f.seek(12)
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        fourcc, size = struct.unpack('<4sI', header)
+        if fourcc == b'EXIF':
+            return _exif_meta(f.read(size))
+        # chunks are padded to an even size
+        f.seek(size + (size & 1), 1)
+    return {}
+
+
+def _read_jpeg_meta(f):
+    metas = {}
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            break
+        # start of scan, compressed image data follows
+        if marker[1] in (0xda, 0xd9):
+            break
+        size = struct.unpack('>H', f.read(2))[0] - 2
+        if marker[1] == 0xe1:
+            data = f.read(size)
+            if data.startswith(b'Exif\x00\x00'):
+                metas.update(_exif_meta(data))
+        elif marker[1] == 0xfe:
+            comment = f.read(size).decode('utf-8', errors='ignore').strip('\x00 ')
+            if comment.startswith('{'):
+                try:
+                    metas.update(_json_meta(comment))
+                except ValueError:
+                    logger.debug("jpeg comment is not json")
+        else:
+            f.seek(size, 1)
+        if all(key in metas for key in META_KEYS):
+            break
+    return metas
+
+
+def _exif_meta(data):
+    if data.startswith(b'Exif\x00\x00'):
+        data = data[6:]
+    if data[:2] == b'II':
+        endian = '<'
+    elif data[:2] == b'MM':
+        endian = '>'
+    else:
+        return {}
+
+    metas = {}
+    values = []
+    ifd_offset = struct.unpack(endian + 'I', data[4:8])[0]
+    ifd_offsets = [ifd_offset]
+    while ifd_offsets:
+        offset = ifd_offsets.pop()
+        if offset + 2 > len(data):
+            continue
+        count = struct.unpack(endian + 'H', data[offset:offset + 2])[0]
+        for i in range(count):
+            entry = data[offset + 2 + i * 12: offset + 14 + i * 12]
+            if len(entry) < 12:
+                break
+            tag, value_type, value_count = struct.unpack(endian + 'HHI', entry[:8])
+            if tag == EXIF_TAG_EXIF_IFD:
+                ifd_offsets.append(struct.unpack(endian + 'I', entry[8:12])[0])
+            elif value_type in (EXIF_TYPE_ASCII, EXIF_TYPE_UNDEFINED):
+                if value_count <= 4:
+                    raw = entry[8:8 + value_count]
+                else:
+                    value_offset = struct.unpack(endian + 'I', entry[8:12])[0]
+                    raw = data[value_offset:value_offset + value_count]
+                if tag == EXIF_TAG_USER_COMMENT:
+                    # 8 bytes character code prefix
+                    raw = raw[8:]
+                values.append(raw.decode('utf-8', errors='ignore').strip('\x00 '))
+
+    for value in values:
+        # comfyui writes "prompt:{...}" and "workflow:{...}"
+        key, _, text = value.partition(':')
+        if key in META_KEYS and text.startswith('{'):
+            metas[key] = text
+        elif value.startswith('{'):
+            try:
+                for key, text in _json_meta(value).items():
+                    metas.setdefault(key, text)
+            except ValueError:
+                logger.debug("exif value is not json")
+    return metas
@@ -3,8 +3,6 @@ import streamlit as st
 import os
 from modules import get_workspace_model
 import modules.page as page
-from streamlit_extras.row import row
-from streamlit_extras.switch_page_button import switch_page
 from modules import AppStatus, check_comfyui_alive
 from modules.preview_app import enter_app_ui
 
@@ -19,7 +17,7 @@ def enter_app(app):
 
 
 def create_app_info_ui(app):
-    app_row = row([1, 5.4, 1.2, 1.4, 1], vertical_align="bottom")
+    app_row = page.row([1, 5.4, 1.2, 1.4, 1], vertical_align="bottom")
     try:
         if app.image is not None:
             app_row.image(app.image)
@@ -65,11 +63,12 @@ with st.container():
         enter_app_ui(app)
     else:
         with page.stylable_button_container():
-            header_row = row([0.85, 0.15], vertical_align="bottom")
+            header_row = page.row([0.85, 0.15], vertical_align="bottom")
             header_row.title("My Apps")
             explore_button = header_row.button(
                     "Install", help="Install more apps from your workspace.")
             if explore_button:
+                from streamlit_extras.switch_page_button import switch_page
                 switch_page("Workspace")
 
         with st.container():
@@ -1,22 +1,15 @@
-import os
-import requests
 from io import BytesIO
+import json
 from loguru import logger
 import streamlit as st
 import modules.page as page
-from modules import get_workspace_model, check_comfyui_alive, get_comfyflow_token
-from streamlit_extras.row import row
-from manager.app_manager import start_app, stop_app
-from modules.workspace_model import AppStatus
+from modules import get_workspace_model, check_comfyui_alive, get_comfyflow_token, get_model_warmer, AppStatus
 from streamlit import config
-from modules.new_app import new_app_ui, edit_app_ui
-from modules.preview_app import preview_app_ui
-from modules.publish_app import publish_app_ui
 import random
 
 
 def create_app_info_ui(app):
-    app_row = row([1, 4.6, 1.2, 2, 1.2], vertical_align="bottom")
+    app_row = page.row([1, 4.6, 1.2, 2, 1.2], vertical_align="bottom")
     try:
         if app.image is not None:
             
@@ -93,6 +86,11 @@ def click_install_app(app):
     
     get_workspace_model().update_app_install(app.name)
     logger.info(f"install App {app.name} success")
+    # load the app models before its first run
+    model_warmer = get_model_warmer()
+    if model_warmer is not None:
+        app_conf = json.loads(app.app_conf)
+        model_warmer.register(app.name, json.loads(app.api_conf), tuple(app_conf['outputs'].keys()))
     st.session_state['app_install_ret'] = AppStatus.INSTALLED.value
 
 def ready_start_app(status):
@@ -116,7 +114,8 @@ def click_start_app(name, id, status):
         app_port = int(id) + random.randint(10000, 20000)
         url = f"http://{app_server}:{app_port}"
 
-        ret = start_app(name, id, url)
+        from manager.app_manager import start_app
+        ret, url = start_app(name, id, url)
         st.session_state['app_start_ret'] = ret
         if ret == AppStatus.RUNNING.value:
             get_workspace_model().update_app_url(name, url)
@@ -136,6 +135,7 @@ def click_stop_app(name, status, url):
             logger.info(f"App {name} url is empty, maybe it is stopped")
             st.session_state['app_stop_ret'] = AppStatus.STOPPED.value
         else:
+            from manager.app_manager import stop_app
             ret = stop_app(name, url)
             st.session_state['app_stop_ret'] = ret
             if ret == AppStatus.STOPPING.value:
@@ -159,7 +159,7 @@ def create_operation_ui(app):
     if st.session_state.get('username', 'anonymous') == app.username:
         disabled = False
 
-    operate_row = row([1.2, 1.0, 1.1, 1.1, 4.5, 1.1], vertical_align="bottom")
+    operate_row = page.row([1.2, 1.0, 1.1, 1.1, 1.0, 1.0, 2.5, 1.1], vertical_align="bottom")
     preview_button = operate_row.button("✅ Preview", help="Preview and check the app", 
                                         key=f"{id}-button-preview", 
                                         on_click=click_preview_app, args=(app,), disabled=disabled)
@@ -195,33 +195,33 @@ def create_operation_ui(app):
                 st.error(f"Install app {name} failed, please check the log")
 
 
-    # start_button = operate_row.button("▶️ Start", help="Start the app", key=f"{id}-button-start", 
-    #                    on_click=click_start_app, args=(name, id, status), disabled=disabled)
-    # if start_button:
-    #     if ready_start_app(status):
-    #         app_preview_ret = st.session_state['app_start_ret']
-    #         if app_preview_ret == AppStatus.RUNNING.value:
-    #             st.info(f"App {name} is running yet, you could share {url} to your friends")
-    #         elif app_preview_ret == AppStatus.STARTED.value:
-    #             st.success(f"Start app {name} success, you could share {url} to your friends")
-    #         else:
-    #             st.error(f"Start app {name} failed")
-    #     else:
-    #         st.warning(f"Please preview the app {name} first")
+    start_button = operate_row.button("▶️ Start", help="Start the app", key=f"{id}-button-start", 
+                       on_click=click_start_app, args=(name, id, status), disabled=disabled)
+    if start_button:
+        if ready_start_app(status):
+            app_preview_ret = st.session_state['app_start_ret']
+            if app_preview_ret == AppStatus.RUNNING.value:
+                st.info(f"App {name} is running yet, you could share {url} to your friends")
+            elif app_preview_ret == AppStatus.STARTED.value:
+                st.success(f"Start app {name} success, you could share {url} to your friends")
+            else:
+                st.error(f"Start app {name} failed")
+        else:
+            st.warning(f"Please preview the app {name} first")
         
-    # stop_button = operate_row.button("⏹️ Stop", help="Stop the app", key=f"{id}-button-stop",
-    #                    on_click=click_stop_app, args=(name, status, url), disabled=disabled)
-    # if stop_button:
-    #     if ready_start_app(status):
-    #         app_stop_ret = st.session_state['app_stop_ret']
-    #         if app_stop_ret == AppStatus.STOPPING.value:
-    #             st.success(f"Stop app {name} success, {url}")
-    #         elif app_stop_ret == AppStatus.STOPPED.value:
-    #             st.success(f"App {name} has stopped, {url}")
-    #         else:
-    #             st.error(f"Stop app {name} failed, please check the log")
-    #     else:
-    #         st.warning(f"Please preview the app {name} first")        
+    stop_button = operate_row.button("⏹️ Stop", help="Stop the app", key=f"{id}-button-stop",
+                       on_click=click_stop_app, args=(name, status, url), disabled=disabled)
+    if stop_button:
+        if ready_start_app(status):
+            app_stop_ret = st.session_state['app_stop_ret']
+            if app_stop_ret == AppStatus.STOPPING.value:
+                st.success(f"Stop app {name} success, {url}")
+            elif app_stop_ret == AppStatus.STOPPED.value:
+                st.success(f"App {name} has stopped, {url}")
+            else:
+                st.error(f"Stop app {name} failed, please check the log")
+        else:
+            st.warning(f"Please preview the app {name} first")        
 
     operate_row.markdown("")
 
@@ -266,18 +266,23 @@ with st.container():
     else:
         cookies = st.session_state['token_cookie']
 
+    # page modules are imported on first use, the workspace list doesn't need them
     if 'new_app' in st.session_state:
+        from modules.new_app import new_app_ui
         new_app_ui()
     elif 'edit_app' in st.session_state:
+        from modules.new_app import edit_app_ui
         edit_app_ui(app=st.session_state['edit_app'])
     elif 'preview_app' in st.session_state:
+        from modules.preview_app import preview_app_ui
         preview_app_ui(st.session_state['preview_app'])
     elif 'publish_app' in st.session_state:    
+        from modules.publish_app import publish_app_ui
         publish_app_ui(app=st.session_state['publish_app'], cookies=cookies)
     
     elif is_load_workspace_page():
         with page.stylable_button_container():
-            header_row = row([0.85, 0.15], vertical_align="top")
+            header_row = page.row([0.85, 0.15], vertical_align="top")
             header_row.markdown("""
                 ### My Workspace
                 create and manage your comfyflowapps.